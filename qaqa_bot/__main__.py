@@ -8,17 +8,23 @@
 # Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
 # "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
+import datetime
 import logging
+import signal
+import urllib.parse
 
 import cherrypy
 import toml
 
 from .bot import Frontend
-from .game import GameServer
+from .game import GameServer, TRANSLATIONS
 from .web import WebEnvironment, setup_cherrypy_engine
 from .util import run_migrations
 import argparse
 
+# Number of games to process per transaction for --backfill-results and --archive-games
+BATCH_SIZE = 100
+
 
 def main():
     parser = argparse.ArgumentParser()
@@ -28,6 +34,18 @@ def main():
                         help="Don't migrate database and set Telegram Bot settings on start")
     parser.add_argument('--init-only', '-i', action='store_const', const=True, default=False,
                         help="Only run database migrations and set Telegram Bot settings, than exit.")
+    parser.add_argument('--no-outbox-dispatcher', action='store_const', const=True, default=False,
+                        help="Don't deliver messages from the transactional outbox in this process (requires "
+                             "game.outbox to be enabled and a separate process running with --outbox-dispatcher-only)")
+    parser.add_argument('--outbox-dispatcher-only', action='store_const', const=True, default=False,
+                        help="Only deliver messages from the transactional outbox, without receiving updates and "
+                             "running the web server (requires game.outbox to be enabled)")
+    parser.add_argument('--backfill-results', action='store_const', const=True, default=False,
+                        help="Write the materialized result snapshots of all finished games, which don't have one yet "
+                             "(e.g. finished before upgrading), then exit.")
+    parser.add_argument('--archive-games', type=int, metavar='DAYS',
+                        help="Archive games finished more than DAYS days ago, i.e. move their participants, sheets and "
+                             "entries to the archive tables and only keep their results, then exit.")
     parser.add_argument('--verbose', '-v', action='count', default=0,
                         help="Make log output more verbose, i.e. reduce log level.")
     parser.add_argument('--quiet', '-q', action='count', default=0,
@@ -45,12 +63,42 @@ def main():
         run_migrations(game_server.database_engine)
         frontend.set_commands()
 
-    if not args.init_only:
+    if args.backfill_results and not args.init_only:
+        total = 0
+        while True:
+            count = game_server.backfill_result_snapshots(BATCH_SIZE)
+            if not count:
+                break
+            total += count
+            logging.info("Wrote result snapshots of %s games.", total)
+        logging.warning("Backfilled result snapshots of %s games.", total)
+    elif args.archive_games is not None and not args.init_only:
+        before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=args.archive_games)
+        total = 0
+        while True:
+            count = game_server.archive_games(before, BATCH_SIZE)
+            if not count:
+                break
+            total += count
+            logging.info("Archived %s games.", total)
+        logging.warning("Archived %s games finished before %s.", total, before)
+    elif args.outbox_dispatcher_only and not args.init_only:
+        frontend.run_outbox_dispatcher()
+    elif not args.init_only:
+        # Reload translations from disk on SIGHUP, to deploy updated message catalogs without restart. Rendered result
+        # pages are discarded, if the translations (or templates) have changed.
+        def reload_translations(_signum, _frame) -> None:
+            TRANSLATIONS.reload()
+            web_data.update_render_version()
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, reload_translations)
         # Configure and start CherryPy engine and HTTP webserver
         setup_cherrypy_engine(web_data, config)
+        if frontend.webhook is not None:
+            cherrypy.tree.mount(frontend.webhook, urllib.parse.urlparse(config['bot']['webhook_url']).path)
         cherrypy.engine.start()
         # Start Telegram Bot Updater
-        frontend.run_bot()
+        frontend.run_bot(dispatch_outbox=not args.no_outbox_dispatcher)
         cherrypy.engine.exit()
 
 
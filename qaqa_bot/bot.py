@@ -9,19 +9,28 @@
 # "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
 
+import functools
+import hmac
+import json
 import logging
-from typing import List, Dict, Any
+import queue
+import threading
+from typing import List, Dict, Any, Optional, Tuple, Hashable
 import datetime
+import time
 
+import cherrypy
+import sqlalchemy.exc
 import telegram
 from telegram import BotCommand, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, messagequeue,
-                          run_async)
-from telegram.utils import promise
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler, TypeHandler, \
+    DispatcherHandlerStop
 
 from . import game
 from .game import GameServer
-from .util import GetText
+from .metrics import MetricsRegistry
+from .outgoing import MessageScheduler, RateLimits, OutboxDispatcher, OutboxEntry, coalesce_messages
+from .util import GetText, PartitionedExecutor, LRUCache
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +40,19 @@ BOOLDIS = {"dis_yes": "Yes 👍", "dis_no": "No 👎"}
 SYNC = {"syn_syn": "Synchronous mode", "syn_asyn": "Asynchronous mode"}
 
 
+def run_partitioned(handler):
+    """Decorator for handler methods of the `Frontend` to run them in the Frontend's `handler_executor`.
+
+    Updates are partitioned by their chat: The handlers of updates from the same chat (e.g. the private chat with a user
+    or the group chat of a game) are executed sequentially in the order of the updates, while updates from different
+    chats are handled in parallel. Exceptions are passed to the Dispatcher's error handlers."""
+    @functools.wraps(handler)
+    def wrapper(self: "Frontend", update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
+        self.handler_executor.submit(self._partition_key(update), self._run_handler, handler, update, context,
+                                     time.monotonic())
+    return wrapper
+
+
 class Frontend:
     def __init__(self, config: Dict[str, Any], game_server: GameServer):
         self.config = config
@@ -40,6 +62,15 @@ class Frontend:
         self.updater = Updater(token=token, use_context=True)
         self.dispatcher = self.updater.dispatcher
 
+        # Gameserver
+        self.gs = game_server
+
+        # Skip duplicate deliveries of updates before any other handler
+        self.deduplicator = UpdateDeduplicator(self.gs, config['bot'].get('dedupe_cache_size', 10000),
+                                               config['bot'].get('dedupe_persist', False),
+                                               config['bot'].get('dedupe_retention', 86400))
+        self.dispatcher.add_handler(TypeHandler(telegram.Update, self.deduplicator), group=-1)
+
         # Command general activities
         help_handler = CommandHandler(game.COMMAND_HELP, self.help, filters=~Filters.update.edited_message)
         status_handler = CommandHandler(game.COMMAND_STATUS, self.status, filters=~Filters.update.edited_message)
@@ -97,11 +128,35 @@ class Frontend:
         # Errorhandling
         self.dispatcher.add_error_handler(self.error)
 
-        # Gameserver
-        self.gs = game_server
-
-        # Flood limits avoiding delay queue
-        self._message_queue = messagequeue.MessageQueue(autostart=False)
+        # Bounded thread pool for the handlers, which keeps the order of updates from each chat (see `run_partitioned`)
+        self.handler_executor = PartitionedExecutor(config['bot'].get('handler_workers', 8),
+                                                    config['bot'].get('handler_max_pending', 1000), "handler")
+        self.gs.metrics.gauge('qaqa_handler_queue_depth', "Number of updates waiting for or running in a handler",
+                              lambda: self.handler_executor.pending)
+        self.gs.metrics.counter('qaqa_handler_backpressure_total',
+                                "Number of updates, whose dispatching was blocked by a full handler queue",
+                                lambda: self.handler_executor.blocked_submissions)
+
+        # Flood limits avoiding scheduler for outgoing messages (per-chat and global rate limits)
+        self._message_queue = MessageScheduler(self._send_message, RateLimits.from_config(config['bot']),
+                                               workers=config['bot'].get('send_workers', 4))
+        self._message_queue_depth = self.gs.metrics.gauge(
+            'qaqa_message_queue_depth', "Number of outgoing messages waiting in the MessageScheduler")
+
+        # Dispatcher for the messages from the transactional outbox (only used if `game.outbox` is enabled). If enabled,
+        # the GameServer's actions don't return any messages to be sent via `send_messages()`.
+        self.outbox_dispatcher: Optional[OutboxDispatcher] = None
+        if self.gs.outbox_enabled:
+            self.outbox_dispatcher = OutboxDispatcher(self.gs, self._deliver_outbox_messages)
+
+        # Webhook endpoint for receiving updates (only used if `bot.webhook_url` is configured)
+        self.webhook: Optional[TelegramWebhook] = None
+        if config['bot'].get('webhook_url'):
+            if not config['bot'].get('webhook_secret'):
+                raise ValueError("bot.webhook_secret must be configured for receiving updates via webhook")
+            self.webhook = TelegramWebhook(self.updater.bot, self.dispatcher.update_queue,
+                                           config['bot']['webhook_secret'], self.gs.metrics,
+                                           config['bot'].get('webhook_max_pending_updates', 1000))
 
     def set_commands(self):
         """Sends the commands to the BotFather."""
@@ -131,17 +186,71 @@ class Frontend:
         ]
         self.updater.bot.set_my_commands(commands)
 
-    def run_bot(self):
+    def run_bot(self, dispatch_outbox: bool = True):
         """Starts polling for user interaction and blocks until stopped by an interrupt signal.
 
-        This method also cares about starting the (delaying) MessageQueue and stopping it on shutdown.
+        If `bot.webhook_url` is configured, the webhook is registered with the Telegram API instead of polling and only
+        the Dispatcher is started, which processes the updates received by the `TelegramWebhook` endpoint. The endpoint
+        must be mounted to the CherryPy tree (at the path of the webhook URL) by the caller.
+
+        This method also cares about starting the (rate limiting) MessageScheduler and the OutboxDispatcher (if the
+        outbox is enabled) and stopping them on shutdown.
+
+        :param dispatch_outbox: If False, the messages from the outbox are not delivered by this process, e.g. because
+            they are delivered by a separate process, running `run_outbox_dispatcher()`.
         """
-        self._message_queue.start()
-        self.updater.start_polling()
+        self._start_sending(dispatch_outbox)
+        if self.webhook is not None:
+            bot_config = self.config['bot']
+            self.updater.bot.set_webhook(bot_config['webhook_url'],
+                                         max_connections=bot_config.get('webhook_max_connections', 40),
+                                         secret_token=bot_config['webhook_secret'])
+            self.start_dispatcher()
+        else:
+            self.handler_executor.start()
+            self.updater.start_polling()
+        self.updater.idle()
+        self.handler_executor.shutdown()
+        self._stop_sending()
+
+    def run_outbox_dispatcher(self):
+        """Only deliver the messages from the transactional outbox (without receiving any updates) and block until
+        stopped by an interrupt signal. This allows to run the sending of messages in a separate process."""
+        if self.outbox_dispatcher is None:
+            raise ValueError("game.outbox must be enabled for running the outbox dispatcher")
+        self._start_sending(True)
+        # Make Updater.idle() stop gracefully on interrupt signals
+        self.updater.running = True
         self.updater.idle()
-        self._message_queue.stop()
+        self._stop_sending()
 
-    @run_async
+    def _start_sending(self, dispatch_outbox: bool) -> None:
+        self._message_queue.start()
+        if self.outbox_dispatcher is not None and dispatch_outbox:
+            self.outbox_dispatcher.start()
+
+    def _stop_sending(self) -> None:
+        # Stop claiming messages from the outbox, try to send the queued messages and release the claims of the
+        # remaining ones.
+        if self.outbox_dispatcher is not None:
+            self.outbox_dispatcher.stop()
+        self._message_queue.stop(timeout=self.config['bot'].get('send_shutdown_timeout', 10))
+        if self.outbox_dispatcher is not None:
+            self.outbox_dispatcher.release()
+
+    def start_dispatcher(self) -> threading.Thread:
+        """Start the Dispatcher's thread to process the updates from its update queue without polling for updates.
+
+        The Dispatcher is stopped by `Updater.stop()` (e.g. via the signal handler of `Updater.idle()`). The handler
+        threads must be stopped afterwards via `handler_executor.shutdown()`."""
+        self.handler_executor.start()
+        thread = threading.Thread(target=self.dispatcher.start, name="dispatcher")
+        # Make Updater.stop() stop the Dispatcher
+        self.updater.running = True
+        thread.start()
+        return thread
+
+    @run_partitioned
     def start(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         """Send a friendly welcome message with language set to locale."""
         chat_id: int = update.effective_chat.id
@@ -154,7 +263,7 @@ class Frontend:
             self.send_messages(self.gs.register_user(update.message.chat.id, user.id, user.first_name, user.last_name,
                                                      user.username))
 
-    @run_async
+    @run_partitioned
     def new_game(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         chat_id: int = update.effective_chat.id
         logger.debug("Received /%s command in chat %s", game.COMMAND_NEW_GAME, chat_id)
@@ -165,7 +274,7 @@ class Frontend:
             self.send_messages(self.gs.get_translations(
                 [game.Message(chat_id, GetText("Games can only be spawned in group chats."))]))
 
-    @run_async
+    @run_partitioned
     def start_game(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         """Start game in current chat."""
         chat_id: int = update.effective_chat.id
@@ -177,7 +286,7 @@ class Frontend:
             self.send_messages(self.gs.get_translations(
                 [game.Message(chat_id, GetText("Games can only be started in group chats."))]))
 
-    @run_async
+    @run_partitioned
     def join_game(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         chat_id: int = update.effective_chat.id
         logger.debug("Received /%s command in chat %s from user %s", game.COMMAND_JOIN_GAME, chat_id,
@@ -189,7 +298,7 @@ class Frontend:
             self.send_messages(self.gs.get_translations(
                 [game.Message(chat_id, GetText("Games can only be joined in group chats."))]))
 
-    @run_async
+    @run_partitioned
     def leave_game(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         logger.debug("Received /%s command in chat %s from user %s", game.COMMAND_LEAVE_GAME, update.effective_chat.id,
                      update.message.from_user.id)
@@ -200,7 +309,7 @@ class Frontend:
             self.send_messages(self.gs.get_translations(
                 [game.Message(update.message.chat.id, GetText("Games can only be left in group chats."))]))
 
-    @run_async
+    @run_partitioned
     def incoming_message(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         """Parse a text-message that was send to the bot in a private chat."""
         logger.debug("Received text message %s in chat %s from Telegram user %s", update.message.message_id,
@@ -213,7 +322,7 @@ class Frontend:
                 [game.Message(update.message.chat.id, GetText("Sorry, I do not understand. Please use a command to "
                                                               "communicate with me."))]))
 
-    @run_async
+    @run_partitioned
     def edited_message(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         logger.debug("Received edit of message %s in chat %s", update.edited_message.message_id,
                      update.edited_message.chat.id)
@@ -222,25 +331,25 @@ class Frontend:
                                update.edited_message.message_id,
                                update.edited_message.text))
 
-    @run_async
+    @run_partitioned
     def stop_game(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         """Stop the game after the current round."""
         logger.debug("Received /%s command in chat %s", game.COMMAND_STOP_GAME, update.effective_chat.id)
         self.send_messages(self.gs.stop_game(chat_id=update.message.chat.id))
 
-    @run_async
+    @run_partitioned
     def stop_game_immediately(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         """Stop the game without awaiting the end of the current round."""
         logger.debug("Received /%s command in chat %s ", game.COMMAND_STOP_GAME_IMMEDIATELY, update.effective_chat.id)
         self.send_messages(self.gs.immediately_stop_game(chat_id=update.message.chat.id))
 
-    @run_async
+    @run_partitioned
     def shuffle_players(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         """Shuffle the order of players in the game."""
         logger.debug("Received /%s command in chat %s ", game.COMMAND_SHUFFLE, update.effective_chat.id)
         self.send_messages(self.gs.shuffle_players(chat_id=update.message.chat.id))
 
-    @run_async
+    @run_partitioned
     def set_rounds(self, update: telegram.Update, context: telegram.ext.CallbackContext) -> None:
         """Set the number of rounds"""
         logger.debug("Received /%s command in chat %s with args %s", game.COMMAND_SET_ROUNDS, update.effective_chat.id,
@@ -257,7 +366,8 @@ class Frontend:
                 self.send_messages(self.gs.set_rounds(chat_id, rounds))
             except ValueError:
                 self.send_messages(self.gs.get_translations(
-                    [game.Message(chat_id, GetText("‘{arg}’ is not a number of rounds!").format(arg=context.args[0]))]))
+                    [game.Message(chat_id,
+                                  GetText("‘{arg}’ is not a number of rounds!").format(arg=context.args[0]))]))
         elif len(context.args) == 0:
             self.send_messages(self.gs.get_translations(
                 [game.Message(chat_id, GetText("Please specify the number of rounds."))]))
@@ -265,7 +375,7 @@ class Frontend:
             self.send_messages(self.gs.get_translations(
                 [game.Message(chat_id, GetText("Don't you think these are too many parameters?"))]))
 
-    @run_async
+    @run_partitioned
     def set_display_name(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         logger.debug("Received /%s command in chat %s", game.COMMAND_SET_DISPLAY_NAME, update.effective_chat.id)
         if update.message.chat.type == telegram.Chat.GROUP \
@@ -279,7 +389,7 @@ class Frontend:
             self.send_messages(self.gs.get_translations(
                 [game.Message(update.message.chat_id, GetText("Games can only be edited in group chats."))]))
 
-    @run_async
+    @run_partitioned
     def set_sync(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         logger.debug("Received /%s command in chat %s", game.COMMAND_SET_SYNC, update.effective_chat.id)
         if update.message.chat.type == telegram.Chat.PRIVATE:
@@ -293,7 +403,7 @@ class Frontend:
             update.message.reply_text(self.gs.translate_string(
                 GetText("Please choose:"), update.effective_chat.id), reply_markup=reply_markup)
 
-    @run_async
+    @run_partitioned
     def set_language(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         logger.debug("Received /%s command in chat %s", game.COMMAND_SET_LANGUAGE, update.effective_chat.id)
         keyboard = [[InlineKeyboardButton(v, callback_data=k)
@@ -303,7 +413,7 @@ class Frontend:
             self.gs.translate_string(GetText("Please choose:"), update.effective_chat.id),
             reply_markup=reply_markup)
 
-    @run_async
+    @run_partitioned
     def button(self, update, _context):
         query = update.callback_query
         chat_id = update.effective_chat.id
@@ -337,7 +447,7 @@ class Frontend:
             query.edit_message_text(self.gs.translate_string(
                 GetText("Oh no! 😱 There's a problem! I don't know this button *️⃣? "), chat_id))
 
-    @run_async
+    @run_partitioned
     def help(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         """Print explanation of the game and commands."""
         logger.debug("Received /%s command in chat %s", game.COMMAND_HELP, update.effective_chat.id)
@@ -368,7 +478,7 @@ To start a new game, use /{command_new}.
             + GetText("\n\nSee {base_url}/#how-to for a full explanation of the bot's features.")
             .format(base_url=self.config['web']['base_url']))]))
 
-    @run_async
+    @run_partitioned
     def status(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
         """Print info about game states and sheets."""
         chat_id: int = update.effective_chat.id
@@ -380,14 +490,78 @@ To start a new game, use /{command_new}.
             self.send_messages(self.gs.get_group_status(chat_id))
 
     def send_messages(self, messages: List[game.TranslatedMessage]) -> None:
-        """Send the messages to the corporated chat ids."""
-        logger.debug("Queuing messages for chats ", ','.join(str(m.chat_id) for m in messages))
+        """Send the messages to the corporated chat ids.
+
+        If `bot.coalesce_messages` is enabled, adjacent messages to the same chat are merged into a single message to
+        save Telegram API calls (and rate limit budget)."""
+        if self.config['bot'].get('coalesce_messages', False):
+            num_messages = len(messages)
+            messages = coalesce_messages(messages)
+            self.gs.metrics.counter('qaqa_message_coalesced_total',
+                                    "Number of Telegram API calls saved by coalescing outgoing messages")\
+                .inc(num_messages - len(messages))
+        logger.debug("Queuing messages for chats %s", ','.join(str(m.chat_id) for m in messages))
         for msg in messages:
             chat_id, text = msg
-            prom = promise.Promise(self.updater.bot.send_message, (),
-                                   {'chat_id': chat_id, 'text': text, 'parse_mode': telegram.ParseMode.HTML})
-            self._message_queue(prom, False)
-            # TODO add limiting of group chat messages, as soon as MessageQueue supports per-group limits
+            self._message_queue_depth.inc()
+            self._message_queue.submit(chat_id, (text, time.monotonic(), None))
+
+    def _deliver_outbox_messages(self, entries: List[OutboxEntry]) -> None:
+        """Queue the messages, claimed from the outbox by the OutboxDispatcher, for sending."""
+        for entry in entries:
+            self._message_queue_depth.inc()
+            self._message_queue.submit(entry.chat_id, (entry.text, time.monotonic(), entry))
+
+    def _send_message(self, chat_id: int, message: Tuple[str, float, Optional[OutboxEntry]]) -> None:
+        """Actually send a single message via the Telegram API. Called by the MessageScheduler's sender threads.
+
+        :param message: The message text, the time when it has been queued and the outbox entry (if the message has
+            been delivered from the outbox), to be acknowledged to the OutboxDispatcher"""
+        text, queued, outbox_entry = message
+        self._message_queue_depth.dec()
+        start = time.monotonic()
+        self.gs.metrics.histogram('qaqa_message_queue_wait_seconds',
+                                  "Time of outgoing messages in the MessageScheduler").observe(start - queued)
+        try:
+            self.updater.bot.send_message(chat_id=chat_id, text=text, parse_mode=telegram.ParseMode.HTML)
+        except telegram.error.RetryAfter:
+            # The MessageScheduler will retry sending the message after the given time
+            self._message_queue_depth.inc()
+            self.gs.metrics.counter('qaqa_message_rate_limited_total',
+                                    "Number of outgoing messages rejected by Telegram's flood control").inc()
+            raise
+        except Exception:
+            if outbox_entry is not None:
+                self.outbox_dispatcher.acknowledge(outbox_entry, False)
+            raise
+        else:
+            if outbox_entry is not None:
+                self.outbox_dispatcher.acknowledge(outbox_entry, True)
+        finally:
+            self.gs.metrics.histogram('qaqa_message_send_seconds',
+                                      "Duration of Telegram API calls for sending messages")\
+                .observe(time.monotonic() - start)
+
+    @staticmethod
+    def _partition_key(update: telegram.Update) -> Hashable:
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        # Updates without chat (e.g. inline queries) are not ordered
+        return update.update_id
+
+    def _run_handler(self, handler, update: telegram.Update, context: telegram.ext.CallbackContext,
+                     queued: float) -> None:
+        """Run a handler method in a thread of the `handler_executor`, unless the update has been recorded as processed
+        in the database (see `UpdateDeduplicator`). Used by `@run_partitioned`."""
+        self.gs.metrics.histogram('qaqa_handler_queue_wait_seconds', "Time of updates waiting for a handler thread")\
+            .observe(time.monotonic() - queued)
+        if self.deduplicator.is_persisted_duplicate(update.update_id):
+            self.deduplicator.skip(update.update_id)
+            return
+        try:
+            handler(self, update, context)
+        except Exception as e:
+            self.dispatcher.dispatch_error(update, e)
 
     def error(self, update, context) -> None:
         """Log errors caused by updates."""
@@ -399,3 +573,112 @@ To start a new game, use /{command_new}.
                                       "Please forward this message to {owner} for help.").
                               format(time=datetime.datetime.now().isoformat(),
                                      owner=self.config["bot"]["owner_username"]))]))
+
+
+class UpdateDeduplicator:
+    """ Dispatcher callback (for a `TypeHandler` in a group before all other handlers) to stop the processing of
+    updates, whose `update_id` has been seen before, e.g. because Telegram delivered them again after a restart or a
+    network failure.
+
+    The ids of the recently seen updates are kept in a bounded LRU cache, which is checked in the Dispatcher's thread.
+    If `persist` is True, the update ids are additionally recorded in the database (with the GameServer's
+    `mark_update_processed()`), so duplicates are detected across restarts. These records are deleted after `retention`
+    seconds. To keep the database round trip out of the Dispatcher's thread, the persistent check is done by the
+    `Frontend` in the partitioned handler thread (see `is_persisted_duplicate()`). If the database is unavailable, the
+    update is handled as a new one. """
+    CLEANUP_INTERVAL = 3600
+
+    def __init__(self, game_server: GameServer, cache_size: int, persist: bool, retention: float):
+        self.gs = game_server
+        self.recent = LRUCache(cache_size)
+        self.persist = persist
+        self.retention = datetime.timedelta(seconds=retention)
+        self._last_cleanup = time.monotonic()
+
+    def __call__(self, update: telegram.Update, _context: telegram.ext.CallbackContext) -> None:
+        if self.is_recent_duplicate(update.update_id):
+            self.skip(update.update_id)
+            raise DispatcherHandlerStop()
+
+    def skip(self, update_id: int) -> None:
+        logger.info("Skipping duplicate update %s.", update_id)
+        self.gs.metrics.counter('qaqa_duplicate_updates_total', "Number of skipped duplicate updates").inc()
+
+    def is_recent_duplicate(self, update_id: int) -> bool:
+        """ Check if the update has been seen recently by this process and record it as seen in memory """
+        if self.recent.get(update_id, False):
+            return True
+        self.recent.put(update_id, True)
+        return False
+
+    def is_persisted_duplicate(self, update_id: int) -> bool:
+        """ Check if the update has been recorded as processed in the database and record it. Always False, if
+        persistence is disabled or fails. """
+        if not self.persist:
+            return False
+        try:
+            new = self.gs.mark_update_processed(update_id)
+        except sqlalchemy.exc.IntegrityError:
+            new = False
+        except Exception as e:
+            logger.error("Could not record update %s as processed. Handling it as a new update.", update_id,
+                         exc_info=e)
+            self.gs.metrics.counter('qaqa_dedupe_persist_errors_total',
+                                    "Number of failures to record processed updates in the database").inc()
+            return False
+        if time.monotonic() - self._last_cleanup > self.CLEANUP_INTERVAL:
+            self._last_cleanup = time.monotonic()
+            try:
+                self.gs.cleanup_processed_updates(datetime.datetime.now(datetime.timezone.utc) - self.retention)
+            except Exception as e:
+                logger.error("Could not clean up the records of processed updates:", exc_info=e)
+        return not new
+
+
+class TelegramWebhook:
+    """ CherryPy controller to receive updates from Telegram via a webhook (HTTPS POST requests with the update as JSON
+    body).
+
+    Each request is checked for the configured secret token (as set with `set_webhook()`) in the
+    `X-Telegram-Bot-Api-Secret-Token` header. Valid updates are only parsed and put into the Dispatcher's update queue,
+    so the request is acknowledged immediately and the update is handled asynchronously by the Dispatcher.
+
+    If more than `max_pending` updates are waiting in the update queue (i.e. the Dispatcher is blocked by a full handler
+    queue), new updates are rejected with HTTP status 503, so Telegram delivers them again later.
+
+    The controller object itself is exposed as a callable, so it can be mounted at an arbitrary path, e.g.
+    `cherrypy.tree.mount(frontend.webhook, '/telegram')`. """
+    exposed = True
+
+    def __init__(self, bot: telegram.Bot, update_queue: queue.Queue, secret_token: str, metrics: MetricsRegistry,
+                 max_pending: int = 1000):
+        self.bot = bot
+        self.update_queue = update_queue
+        self.secret_token = secret_token
+        self.metrics = metrics
+        self.max_pending = max_pending
+
+    def __call__(self):
+        if cherrypy.request.method != 'POST':
+            cherrypy.response.headers['Allow'] = 'POST'
+            raise cherrypy.HTTPError(405)
+        token = cherrypy.request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), self.secret_token.encode('utf-8')):
+            self._count('forbidden')
+            raise cherrypy.HTTPError(403, "Invalid secret token")
+        if self.update_queue.qsize() >= self.max_pending:
+            self._count('rejected')
+            raise cherrypy.HTTPError(503, "Too many pending updates")
+        try:
+            update = telegram.Update.de_json(json.loads(cherrypy.request.body.read()), self.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            self._count('invalid')
+            logger.warning("Received invalid update via webhook: %s", e)
+            raise cherrypy.HTTPError(400, "Invalid update")
+        self.update_queue.put(update)
+        self._count('accepted')
+        return b''
+
+    def _count(self, result: str) -> None:
+        self.metrics.counter('qaqa_webhook_updates_total', "Number of updates received via webhook",
+                             result=result).inc()
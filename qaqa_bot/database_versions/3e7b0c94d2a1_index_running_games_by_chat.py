@@ -0,0 +1,34 @@
+"""Index running games by chat only
+
+Revision ID: 3e7b0c94d2a1
+Revises: 9f2d5c81a6e4
+Create Date: 2026-10-17 11:03:18.926415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e7b0c94d2a1'
+down_revision = '9f2d5c81a6e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # `finished` is already implied by the partial index's predicate (on SQLite and PostgreSQL). The index is dropped
+    # and created again under the same name.
+    with op.batch_alter_table('games', schema=None) as batch_op:
+        batch_op.drop_index('idx_games_running')
+        batch_op.create_index('idx_games_running', ['chat_id'], unique=False,
+                              sqlite_where=sa.text('finished IS NULL'),
+                              postgresql_where=sa.text('finished IS NULL'))
+
+
+def downgrade():
+    with op.batch_alter_table('games', schema=None) as batch_op:
+        batch_op.drop_index('idx_games_running')
+        batch_op.create_index('idx_games_running', ['chat_id', 'finished'], unique=False,
+                              sqlite_where=sa.text('finished IS NULL'),
+                              postgresql_where=sa.text('finished IS NULL'))
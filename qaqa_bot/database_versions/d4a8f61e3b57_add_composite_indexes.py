@@ -0,0 +1,50 @@
+"""Add composite indexes for running games
+
+Revision ID: d4a8f61e3b57
+Revises: b71d4e2a9c05
+Create Date: 2026-10-16 21:34:51.208317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a8f61e3b57'
+down_revision = 'b71d4e2a9c05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # The new indexes are created before dropping the single-column indexes, which they supersede, since MySQL requires
+    # an index for each foreign key column.
+    with op.batch_alter_table('entries', schema=None) as batch_op:
+        batch_op.create_index('idx_entries_sheet_position', ['sheet_id', 'position'], unique=True)
+        batch_op.drop_index('ix_entries_sheet_id')
+
+    with op.batch_alter_table('games', schema=None) as batch_op:
+        batch_op.create_index('idx_games_running', ['chat_id', 'finished'], unique=False,
+                              sqlite_where=sa.text('finished IS NULL'),
+                              postgresql_where=sa.text('finished IS NULL'))
+        batch_op.drop_index('ix_games_chat_id')
+
+    with op.batch_alter_table('sheets', schema=None) as batch_op:
+        batch_op.create_index('idx_sheets_pending', ['current_user_id', 'pending_position'], unique=False,
+                              sqlite_where=sa.text('current_user_id IS NOT NULL'),
+                              postgresql_where=sa.text('current_user_id IS NOT NULL'))
+        batch_op.drop_index('ix_sheets_current_user_id')
+
+
+def downgrade():
+    with op.batch_alter_table('sheets', schema=None) as batch_op:
+        batch_op.create_index('ix_sheets_current_user_id', ['current_user_id'], unique=False)
+        batch_op.drop_index('idx_sheets_pending')
+
+    with op.batch_alter_table('games', schema=None) as batch_op:
+        batch_op.create_index('ix_games_chat_id', ['chat_id'], unique=False)
+        batch_op.drop_index('idx_games_running')
+
+    with op.batch_alter_table('entries', schema=None) as batch_op:
+        batch_op.create_index('ix_entries_sheet_id', ['sheet_id'], unique=False)
+        batch_op.drop_index('idx_entries_sheet_position')
@@ -22,29 +22,32 @@ Additionally, this module defines the `Message` tuple for passing Telegram messa
 function and the `@with_session` for magically handling (creating/committing/rolling back) the database sessions.
 """
 
+import collections
+import contextlib
 import datetime
+import enum
 import functools
-import gettext
+import json
 import math
 import random
 import statistics
 import os.path
+import time
 import logging
-from typing import NamedTuple, List, Optional, Iterable, Dict, Any, MutableMapping
+import uuid
+import zlib
+from typing import NamedTuple, List, Optional, Iterable, Dict, Any, MutableMapping, Callable, Tuple
 
 import sqlalchemy
-import sqlalchemy.exc
+import sqlalchemy.event
+import sqlalchemy.pool
 from sqlalchemy import func, and_
-from sqlalchemy.orm import Session, joinedload, selectinload, raiseload
-# We need the MySQLdb driver only to detect Deadlock-Exceptions caused by concurrent modifications.
-try:
-    import MySQLdb._exceptions
-    mysqldb_driver = True
-except ImportError:
-    mysqldb_driver = False
+from sqlalchemy.orm import Session, joinedload, contains_eager
 
 from . import model
-from .util import LazyGetTextBase, GetText, GetNoText, encode_secure_id, NGetText
+from .util import LazyGetTextBase, GetText, GetNoText, encode_secure_id, NGetText, TranslationRegistry, LRUCache, \
+    KeyedLock, RetryPolicy, is_retryable_error, engine_isolation_level
+from .metrics import MetricsRegistry, MetricsSink, LoggingSink, ActionSample, StatementStats, COUNT_BUCKETS
 
 COMMAND_HELP = "help"
 COMMAND_STATUS = "status"
@@ -62,7 +65,9 @@ COMMAND_SET_SYNC = "set_sync"
 COMMAND_SHUFFLE = "shuffle"
 
 LOCALE_DIR = os.path.join(os.path.dirname(__file__), 'i18n')
-MAX_TRANSACTION_TRYS = 30
+#: Process-wide cache of the bot's message catalogs, shared by the GameServer and the web frontend
+TRANSLATIONS = TranslationRegistry('qaqa_bot', LOCALE_DIR)
+DEFAULT_LOCALE_CACHE_SIZE = 10000
 
 logger = logging.getLogger(__name__)
 
@@ -84,13 +89,101 @@ class SheetProgressInfo(NamedTuple):
     """ A helper type, with the relevant information about a single sheet:
     * The sheet itself
     * the number of entries on it and
-    * the last of its entries.
+    * the type of its last entry (or None, if the sheet is empty).
 
-    This information may be queried together (e.g. using `_query_sheet_infos()`) and passed between functions to avoid
-    superflous SQL queries."""
+    This information is taken from the denormalized progress columns of the sheet (see `model.Sheet.append_entry()`).
+    It may be queried together (e.g. using `_game_sheet_infos()`) and passed between functions to avoid superflous SQL
+    queries."""
     sheet: model.Sheet
     num_entries: int
-    last_entry: Optional[model.Entry]
+    last_entry_type: Optional[model.EntryType]
+
+    @classmethod
+    def of(cls, sheet: model.Sheet) -> "SheetProgressInfo":
+        return cls(sheet, sheet.num_entries, sheet.last_entry_type)
+
+
+class ResultEntry(NamedTuple):
+    """ Read-only snapshot of an entry of a finished game.
+
+    The result snapshots are built from plain column queries (without loading ORM objects) by the `get_game_result*()`
+    and `get_result_*()` methods of the GameServer, to be rendered or serialized by the web frontend and cached. """
+    position: int
+    type: model.EntryType
+    text: str
+    timestamp: datetime.datetime
+    #: Short name of the author, made unambiguous among the game's participants
+    author: str
+
+
+class ResultSheet(NamedTuple):
+    """ Read-only snapshot of a sheet of a finished game with (a part of) its entries """
+    id: int
+    game_id: int
+    num_entries: int
+    entries: List[ResultEntry]
+
+
+class ResultGame(NamedTuple):
+    """ Read-only snapshot of a finished game with (a part of) its sheets """
+    id: int
+    name: str
+    started: datetime.datetime
+    finished: datetime.datetime
+    is_showing_result_names: bool
+    #: Total number of entries of all sheets
+    num_entries: int
+    sheets: List[ResultSheet]
+
+
+class TransactionRetry(NamedTuple):
+    """ Structured information about a retry of a failed transaction. Attached to the log record of each retry (as
+    `transaction_retry` attribute), logged by `@with_session`. """
+    #: Name of the GameServer method
+    action: str
+    #: Number of the next attempt (i.e. 2 for the first retry)
+    attempt: int
+    #: Backoff time in seconds before the next attempt
+    wait: float
+    #: Description of the database error, which caused the retry
+    error: str
+
+
+class ConcurrencyMode(enum.Enum):
+    """ Strategies for handling concurrent actions on the same game, configured via `game.concurrency` in the config """
+    #: Only rely on the database's SERIALIZABLE isolation and retry the transaction in case of conflicts
+    RETRY = 'retry'
+    #: Lock the game's database row (SELECT ... FOR UPDATE) at the beginning of each action on that game. Requires a
+    #: database backend with row-level locking (e.g. MySQL/MariaDB, PostgreSQL).
+    ROW_LOCK = 'row_lock'
+    #: Hold an in-process mutex for the game during each action on that game. Works with every database backend (incl.
+    #: SQLite), but only if there is a single bot process.
+    PROCESS_LOCK = 'process_lock'
+
+
+def serialized_by_game(game_lookup: Callable[..., Optional[int]]):
+    """ A decorator for methods of the GameServer class to declare which game is affected by the method call.
+
+    It must be applied below (i.e. before) `@with_session`. `game_lookup` is called by `with_session` with the session
+    and the method's arguments and should return the affected game's id (or None). Unless the GameServer uses the
+    `ConcurrencyMode.RETRY`, the game is locked before executing the method, such that concurrent actions on the same
+    game are queued instead of running into serialization conflicts (and retries) in the database.
+    """
+    def decorator(f):
+        f.game_lookup = game_lookup
+        return f
+    return decorator
+
+
+def via_outbox(f):
+    """ A decorator for methods of the GameServer class to mark them as actions, which change the state of a game, such
+    that their outgoing messages are written to the transactional outbox (if enabled, see `with_session`).
+
+    It must be applied below (i.e. before) `@with_session`. Other methods (e.g. status queries or the translation of
+    replies) return their messages directly, to avoid the overhead of the outbox.
+    """
+    f.via_outbox = True
+    return f
 
 
 def with_session(f):
@@ -101,36 +194,178 @@ def with_session(f):
     `self`, before the caller's positional and keyword arguments. The session is committed after the successful
     execution of the method and rolled back in case of an Exception.
 
-    The decorator also handles retries of failed database transactions due to concurrent modifications to the database:
-    If such an Exception is detected, the function is re-called with the same parameters up to 30 times. For this to
-    work, the wrapped method must be free from side-effects (apart from the changes in the database).
+    The decorator also handles retries of failed database transactions due to concurrent modifications to the database
+    (as detected by `util.is_retryable_error()`): If such an Exception is detected, the function is re-called with the
+    same parameters, with exponential backoff according to the GameServer's `retry_policy`. Each retry is logged with
+    a `TransactionRetry` record attached. For this to work, the wrapped method must be free from side-effects (apart
+    from the changes in the database).
+
+    Statistics of each call (number of attempts, wall time, time and number of SQL statements) are recorded as an
+    `ActionSample` in the GameServer's `metrics` registry and passed to its `metrics_sink`.
+
+    If the method has been marked with `@serialized_by_game`, the affected game is looked up in a separate transaction
+    and locked (according to the GameServer's `concurrency_mode`) before calling the method. The lock is only a means to
+    reduce the number of conflicts: Correctness is still ensured by the database's transaction isolation.
+
+    If the GameServer's transactional outbox is enabled (`game.outbox` config option) and the method has been marked
+    with `@via_outbox`, outgoing messages returned by the method (a list of `TranslatedMessage`s) are written to the
+    outbox table within the same transaction and an empty list is returned instead. The messages are then delivered by
+    the `outgoing.OutboxDispatcher`.
     """
+    game_lookup: Optional[Callable[..., Optional[int]]] = getattr(f, 'game_lookup', None)
+    use_outbox: bool = getattr(f, 'via_outbox', False)
+
     @functools.wraps(f)
     def wrapper(self: "GameServer", *args, **kwargs):
         session = self.session_maker()
-        trys = 0
-        while True:
+        # Prefix for the idempotency keys of outbox messages. It is kept for retries of the transaction, so a
+        # transaction, which has been committed in spite of a reported error, cannot add the messages again.
+        action_key = uuid.uuid4().hex
+        statement_stats = StatementStats()
+        session.info['statement_stats'] = statement_stats
+        attempt = 1
+        start = time.monotonic()
+        success = False
+        game_locked = False
+        try:
+            with contextlib.ExitStack() as game_lock:
+                while True:
+                    try:
+                        if (game_lookup is not None and not game_locked
+                                and self.concurrency_mode is not ConcurrencyMode.RETRY):
+                            game_locked = self._lock_game(session, game_lookup(session, *args, **kwargs), game_lock)
+                        result = f(self, session, *args, **kwargs)
+                        if use_outbox and self.outbox_enabled and _is_message_list(result):
+                            self._write_outbox(result, action_key, session)
+                            result = []
+                        session.commit()
+                        success = True
+                        return result
+                    except Exception as e:
+                        session.rollback()
+                        # If the wrapped function fails with a concurrent database modification, retry it.
+                        if is_retryable_error(e, self.database_engine.dialect.name,
+                                              engine_isolation_level(self.database_engine)):
+                            policy = self.retry_policy
+                            wait = policy.delay(attempt)
+                            if attempt < policy.max_attempts and time.monotonic() - start + wait <= policy.time_budget:
+                                attempt += 1
+                                retry = TransactionRetry(f.__name__, attempt, wait, str(getattr(e, 'orig', e)))
+                                logger.info("Retrying %s due to concurrent modification (attempt %s, waiting %.3fs): "
+                                            "%s", *retry, extra={'transaction_retry': retry})
+                                time.sleep(wait)
+                                continue
+                            logger.warning("Giving up %s after %s attempts in %.3fs due to concurrent "
+                                           "modifications.", f.__name__, attempt, time.monotonic() - start)
+                        raise
+                    finally:
+                        session.close()
+        finally:
+            # Metrics must never change the outcome of the action
             try:
-                result = f(self, session, *args, **kwargs)
-                session.commit()
-                return result
-            except Exception as e:
-                session.rollback()
-                # If the wrapped function fails with a concurrent database modification, retry the modification.
-                if (isinstance(e, sqlalchemy.exc.OperationalError)
-                        and mysqldb_driver
-                        and isinstance(e.orig, MySQLdb._exceptions.OperationalError)
-                        and e.orig.args[0] == 1213):  # MySQL code for "Deadlock detected"
-                    # TODO detect similar error of other database backends
-                    trys += 1
-                    if trys < MAX_TRANSACTION_TRYS:
-                        continue
-                raise
-            finally:
-                session.close()
+                self._record_action(ActionSample(f.__name__, attempt, time.monotonic() - start,
+                                                 statement_stats.db_time, statement_stats.statements, success))
+            except Exception:
+                logger.exception("Error while recording metrics of %s:", f.__name__)
     return wrapper
 
 
+def _is_message_list(result: Any) -> bool:
+    return isinstance(result, list) and all(isinstance(m, TranslatedMessage) for m in result)
+
+
+def _game_num_entries() -> Any:
+    """ SQL expression for the total number of entries of a game, correlated with the `Game` of the enclosing query """
+    sheet = sqlalchemy.orm.aliased(model.Sheet)
+    return sqlalchemy.select([func.coalesce(func.sum(sheet.num_entries), 0)])\
+        .where(sheet.game_id == model.Game.id)\
+        .as_scalar()
+
+
+RESULT_SNAPSHOT_VERSION = 1
+
+
+def _naive_utc(timestamp: datetime.datetime) -> datetime.datetime:
+    """ Convert a timestamp to a naive UTC datetime, like it is read from the database """
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def encode_result_snapshot(game: ResultGame) -> bytes:
+    """ Serialize the result snapshot of a finished game (with all sheets and entries) into compressed JSON, to be
+    stored as `model.GameResult`. """
+    data = {
+        'v': RESULT_SNAPSHOT_VERSION,
+        'game': [game.id, game.name, game.started.isoformat(), game.finished.isoformat(), game.is_showing_result_names,
+                 game.num_entries],
+        'sheets': [[sheet.id, sheet.num_entries,
+                    [[entry.position, entry.type.value, entry.text, entry.timestamp.isoformat(), entry.author]
+                     for entry in sheet.entries]]
+                   for sheet in game.sheets],
+    }
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_result_snapshot(data: bytes) -> ResultGame:
+    """ Deserialize a result snapshot, created with `encode_result_snapshot()` """
+    content = json.loads(zlib.decompress(data).decode('utf-8'))
+    if content['v'] != RESULT_SNAPSHOT_VERSION:
+        raise ValueError("Unsupported result snapshot version {}".format(content['v']))
+    game_id, name, started, finished, is_showing_result_names, num_entries = content['game']
+    return ResultGame(
+        game_id, name, datetime.datetime.fromisoformat(started), datetime.datetime.fromisoformat(finished),
+        is_showing_result_names, num_entries,
+        [ResultSheet(sheet_id, game_id, sheet_num_entries,
+                     [ResultEntry(position, model.EntryType(entry_type), text,
+                                  datetime.datetime.fromisoformat(timestamp), author)
+                      for position, entry_type, text, timestamp, author in entries])
+         for sheet_id, sheet_num_entries, entries in content['sheets']])
+
+
+def _before_cursor_execute(connection: sqlalchemy.engine.Connection, _cursor, _statement, _parameters, _context,
+                           _executemany) -> None:
+    if 'statement_stats' in connection.info:
+        connection.info.setdefault('statement_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(connection: sqlalchemy.engine.Connection, _cursor, _statement, _parameters, _context,
+                          _executemany) -> None:
+    stats: Optional[StatementStats] = connection.info.get('statement_stats')
+    if stats is not None and connection.info.get('statement_start_time'):
+        stats.db_time += time.perf_counter() - connection.info['statement_start_time'].pop()
+        stats.statements += 1
+
+
+def _on_connection_checkin(_dbapi_connection, connection_record) -> None:
+    # Detach the action's StatementStats from the connection, when it is returned to the pool
+    connection_record.info.pop('statement_stats', None)
+    connection_record.info.pop('statement_start_time', None)
+
+
+def _game_of_group_chat(session: Session, chat_id: int, *_args, **_kwargs) -> Optional[int]:
+    """ Game lookup for `@serialized_by_game`: The current game in the group chat `chat_id` """
+    return session.query(model.Game.id)\
+        .filter(model.Game.chat_id == chat_id, model.Game.finished == None)\
+        .scalar()
+
+
+def _game_of_current_sheet(session: Session, chat_id: int, *_args, **_kwargs) -> Optional[int]:
+    """ Game lookup for `@serialized_by_game`: The game of the current sheet of the user with private chat `chat_id` """
+    return session.query(model.Sheet.game_id)\
+        .join(model.User, model.User.current_sheet_id == model.Sheet.id)\
+        .filter(model.User.chat_id == chat_id)\
+        .scalar()
+
+
+def _game_of_message(session: Session, chat_id: int, message_id: int, *_args, **_kwargs) -> Optional[int]:
+    """ Game lookup for `@serialized_by_game`: The game of the entry, submitted with the given message """
+    return session.query(model.Sheet.game_id)\
+        .join(model.Entry, model.Entry.sheet_id == model.Sheet.id)\
+        .filter(model.Entry.chat_id == chat_id, model.Entry.message_id == message_id)\
+        .scalar()
+
+
 class GameServer:
     """
     Container for the game state and business logic to change the game state based on interaction events
@@ -143,12 +378,13 @@ class GameServer:
     The available game actions are provided as methods of the GameServer object. They should be called by the
     appropriate handlers of the Telegram Bot frontend.
 
-    The GameServer itself is stateless. Since all it member fields are either static (config) or thread-safe
-    (_send_callback, session_maker), it is considered to be thread-safe and may be used from thread-pool-executed
-    handlers of the Telegram and Web frontends.
+    The GameServer itself is stateless, apart from caches of database contents. Since all it member fields are either
+    static (config) or thread-safe (_send_callback, session_maker, locale_cache, game_locks), it is considered to be
+    thread-safe and may be used from thread-pool-executed handlers of the Telegram and Web frontends.
     """
     def __init__(self, config: MutableMapping[str, Any],
-                 database_engine: Optional[sqlalchemy.engine.Engine] = None):
+                 database_engine: Optional[sqlalchemy.engine.Engine] = None,
+                 metrics_sink: Optional[MetricsSink] = None):
         """
         Initialize a new
 
@@ -158,6 +394,8 @@ class GameServer:
         :param database_engine: (optional) Pre-initialized database engine. The engine should be initialized with
             isolation_level='SERIALIZABLE'. If not given, a new database engine is created, using the
             `database.connection` entry in the config.
+        :param metrics_sink: (optional) A MetricsSink to receive the statistics of each action. Defaults to a
+            `LoggingSink`, which logs them at DEBUG level.
         """
         self.config = config
 
@@ -172,6 +410,117 @@ class GameServer:
         # Create database session maker
         self.session_maker = sqlalchemy.orm.sessionmaker(bind=self.database_engine)
 
+        # Metrics of the game actions. The SQL statements of each action are counted and timed by the engine event
+        # listeners, using the StatementStats object, which is attached to the action's connection in
+        # `_on_transaction_begin()`.
+        self.metrics = MetricsRegistry()
+        self.metrics_sink = metrics_sink if metrics_sink is not None else LoggingSink()
+        sqlalchemy.event.listen(self.database_engine, 'before_cursor_execute', _before_cursor_execute)
+        sqlalchemy.event.listen(self.database_engine, 'after_cursor_execute', _after_cursor_execute)
+        sqlalchemy.event.listen(self.database_engine, 'checkin', _on_connection_checkin)
+
+        self.retry_policy = RetryPolicy.from_config(config.get('game', {}))
+        self.concurrency_mode = ConcurrencyMode(config.get('game', {}).get('concurrency', ConcurrencyMode.RETRY.value))
+        self.game_locks = KeyedLock()
+
+        # In-memory cache of the selected locale per chat_id (None for chats without selected locale). It is filled by
+        # `_get_locales()` and updated by `set_chat_locale()` after the transaction has been committed.
+        self.locale_cache = LRUCache(config.get('game', {}).get('locale_cache_size', DEFAULT_LOCALE_CACHE_SIZE))
+        sqlalchemy.event.listen(self.session_maker, 'after_begin', self._on_transaction_begin)
+        sqlalchemy.event.listen(self.session_maker, 'after_commit', self._on_transaction_commit)
+        sqlalchemy.event.listen(self.session_maker, 'after_rollback', self._on_transaction_rollback)
+
+        # In-memory cache of decoded result snapshots (see `model.GameResult`) per game id. Snapshots never change.
+        self.result_snapshot_cache = LRUCache(config.get('game', {}).get('result_snapshot_cache_size', 100))
+
+        # Transactional outbox for outgoing messages (see `with_session`). `outbox_notify` is called after new messages
+        # have been committed to the outbox, e.g. to wake up the `OutboxDispatcher`.
+        self.outbox_enabled: bool = config.get('game', {}).get('outbox', False)
+        self.outbox_notify: Optional[Callable[[], None]] = None
+
+        # Metrics of the database connection pool and caches
+        sqlalchemy.event.listen(self.database_engine, 'checkout', self._on_connection_checkout)
+        pool = self.database_engine.pool
+        if isinstance(pool, sqlalchemy.pool.QueuePool):
+            self.metrics.gauge('qaqa_db_pool_size', "Configured size of the database connection pool",
+                               pool.size)
+            self.metrics.gauge('qaqa_db_pool_checked_out', "Number of database connections currently checked out",
+                               pool.checkedout)
+            self.metrics.gauge('qaqa_db_pool_overflow', "Number of overflow connections of the database pool",
+                               pool.overflow)
+        self.metrics.counter('qaqa_locale_cache_hits_total', "Number of chat locale cache hits",
+                             lambda: self.locale_cache.hits)
+        self.metrics.counter('qaqa_locale_cache_misses_total', "Number of chat locale cache misses",
+                             lambda: self.locale_cache.misses)
+
+    def _on_connection_checkout(self, _dbapi_connection, _connection_record, _connection_proxy) -> None:
+        self.metrics.counter('qaqa_db_pool_checkouts_total', "Number of database connection pool checkouts").inc()
+
+    def _on_transaction_begin(self, session: Session, _transaction, connection: sqlalchemy.engine.Connection) -> None:
+        # Take the fill token at the beginning of the transaction, since the database might give us a snapshot from this
+        # point in time.
+        session.info['locale_cache_token'] = self.locale_cache.fill_token()
+        if 'statement_stats' in session.info:
+            connection.info['statement_stats'] = session.info['statement_stats']
+
+    def _on_transaction_commit(self, session: Session) -> None:
+        for chat_id, locale in session.info.pop('locale_cache_updates', {}).items():
+            self.locale_cache.put(chat_id, locale)
+        if session.info.pop('outbox_written', False) and self.outbox_notify is not None:
+            self.outbox_notify()
+
+    def _on_transaction_rollback(self, session: Session) -> None:
+        session.info.pop('locale_cache_updates', None)
+        session.info.pop('outbox_written', None)
+
+    def _record_action(self, sample: ActionSample) -> None:
+        """ Record the statistics of a single action call in the metrics registry and pass them to the metrics sink """
+        self.metrics.histogram('qaqa_action_duration_seconds', "Wall time of GameServer actions, including retries",
+                               action=sample.action).observe(sample.wall_time)
+        self.metrics.histogram('qaqa_action_db_duration_seconds', "Time spent executing SQL statements per action",
+                               action=sample.action).observe(sample.db_time)
+        self.metrics.histogram('qaqa_action_statements', "Number of SQL statements per action", COUNT_BUCKETS,
+                               action=sample.action).observe(sample.statements)
+        self.metrics.counter('qaqa_action_retries_total', "Number of transaction retries",
+                             action=sample.action).inc(sample.attempts - 1)
+        if not sample.success:
+            self.metrics.counter('qaqa_action_failures_total', "Number of failed actions",
+                                 action=sample.action).inc()
+        self.metrics_sink.record_action(sample)
+
+    def _lock_game(self, session: Session, game_id: Optional[int], game_lock: contextlib.ExitStack) -> bool:
+        """
+        Lock the given game for the current action according to the `concurrency_mode`. Used by `@with_session`.
+
+        :param session: The action's session. It must not contain any changes yet, since it is committed to end the
+            transaction of the game lookup (and release its database locks) before waiting for the game lock.
+        :param game_id: The id of the game to lock or None, if the action does not affect any game
+        :param game_lock: An ExitStack to hold the in-process game lock until the action is completed
+        :return: True, if the game lock is held until the end of the action (including retries). False, if it needs to
+            be acquired again in a retried transaction.
+        """
+        if game_id is None:
+            return False
+        session.commit()
+        if self.concurrency_mode is ConcurrencyMode.ROW_LOCK:
+            session.query(model.Game.id).filter(model.Game.id == game_id).with_for_update().scalar()
+            return False
+        game_lock.enter_context(self.game_locks.hold(game_id))
+        return True
+
+    def _write_outbox(self, messages: List[TranslatedMessage], action_key: str, session: Session) -> None:
+        """ Add the outgoing messages to the outbox table in the action's transaction. Used by `@with_session`.
+
+        The session is only flagged with `outbox_written` (to notify the dispatcher after the commit), if there actually
+        are messages to be sent. """
+        if not messages:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        session.add_all(model.OutboxMessage(idempotency_key="{}:{}".format(action_key, i), chat_id=m.chat_id,
+                                            text=m.text, created=now, attempts=0, next_attempt=now)
+                        for i, m in enumerate(messages))
+        session.info['outbox_written'] = True
+
     @with_session
     def translate_string(self, session: Session, message: LazyGetTextBase, chat_id: int) -> str:
         """
@@ -194,37 +543,258 @@ class GameServer:
         return self._get_translations(messages, session)
 
     @with_session
-    def get_game_result(self, session: Session, game_id: int) -> model.Game:
-        game = session.query(model.Game)\
-            .filter(model.Game.id == game_id, model.Game.finished != None)\
-            .options(raiseload('*'),
-                     selectinload(model.Game.participants)
-                     .joinedload(model.Participant.user),
-                     selectinload(model.Game.sheets)
-                     .options(
-                         selectinload(model.Sheet.game),
-                         selectinload(model.Sheet.entries)
-                         .joinedload(model.Entry.user)
-                     ))\
-            .one_or_none()
+    def get_game_result(self, session: Session, game_id: int) -> Optional[ResultGame]:
+        """
+        Get a snapshot of a finished game with all its sheets and entries or None, if there is no such finished game.
 
-        session.expunge_all()
+        The result snapshots (this and the following methods) are taken from the materialized snapshot of the game, if
+        available (see `model.GameResult`), and queried from the game's tables otherwise.
+        """
+        snapshot = self._result_snapshot(session, game_id)
+        if snapshot is not None:
+            return snapshot
+        game = self._result_game(session, game_id)
+        if game is not None:
+            game.sheets.extend(self._result_sheets(session, game_id))
         return game
 
     @with_session
-    def get_game_result_sheet(self, session: Session, sheet_id: int) -> model.Game:
-        sheet = session.query(model.Sheet)\
+    def get_game_result_sheet(self, session: Session, sheet_id: int) -> Optional[Tuple[ResultGame, ResultSheet]]:
+        """
+        Get a snapshot of a single sheet of a finished game with all its entries, together with a snapshot of its game
+        (without sheets).
+
+        :return: The game and the sheet or None, if there is no such sheet of a finished game
+        """
+        result = self._result_snapshot_of_sheet(session, sheet_id)
+        if result is not None:
+            return result
+        result = self._result_sheet(session, sheet_id)
+        if result is not None:
+            game, sheet = result
+            sheet.entries.extend(entry for _sheet_id, entry in self._query_result_entries(
+                session, game.id, model.Entry.sheet_id == sheet_id))
+        return result
+
+    @with_session
+    def get_game_result_summary(self, session: Session, game_id: int) -> Optional[ResultGame]:
+        """
+        Get a snapshot of a finished game without its sheets (but with its total number of entries) or None, if there
+        is no such finished game.
+
+        Together with `get_game_result_sheets()`, this allows to process the results of large games chunk by chunk,
+        without holding all sheets and entries in memory. The game is queried from its tables, unless its result
+        snapshot is cached or the game has been archived.
+        """
+        snapshot = self.result_snapshot_cache.get(game_id, None)
+        if snapshot is None:
+            archived = session.query(model.Game.archived).filter(model.Game.id == game_id).scalar()
+            if archived is None:
+                return self._result_game(session, game_id)
+            snapshot = self._result_snapshot(session, game_id)
+            if snapshot is None:
+                return None
+        return snapshot._replace(sheets=[])
+
+    @with_session
+    def get_game_result_sheets(self, session: Session, game_id: int, after_sheet_id: int, limit: int) \
+            -> List[ResultSheet]:
+        """
+        Get a chunk of the sheets of a finished game (see `get_game_result_summary()`) with their entries, ordered by
+        their id.
+
+        The sheets are sliced from the game's result snapshot, if it is cached or the game has been archived, and
+        queried from the tables by keyset pagination otherwise.
+
+        :param after_sheet_id: Only get sheets with an id greater than this one (i.e. the last sheet of the previous
+            chunk or 0)
+        :param limit: Maximum number of sheets in the chunk
+        """
+        snapshot = self.result_snapshot_cache.get(game_id, None)
+        if snapshot is None:
+            sheets = [ResultSheet(*row, entries=[])
+                      for row in session.query(model.Sheet.id, model.Sheet.game_id, model.Sheet.num_entries)
+                      .filter(model.Sheet.game_id == game_id, model.Sheet.id > after_sheet_id)
+                      .order_by(model.Sheet.id)
+                      .limit(limit)]
+            if sheets:
+                sheets_by_id = {sheet.id: sheet for sheet in sheets}
+                for sheet_id, entry in self._query_result_entries(session, game_id,
+                                                                  model.Entry.sheet_id.in_(list(sheets_by_id))):
+                    sheets_by_id[sheet_id].entries.append(entry)
+                return sheets
+            if session.query(model.Game.archived).filter(model.Game.id == game_id).scalar() is None:
+                return sheets
+            snapshot = self._result_snapshot(session, game_id)
+            if snapshot is None:
+                return []
+        return [sheet for sheet in snapshot.sheets if sheet.id > after_sheet_id][:limit]
+
+    @with_session
+    def backfill_result_snapshots(self, session: Session, limit: int) -> int:
+        """
+        Write the materialized result snapshots (see `model.GameResult`) of finished games, which don't have one yet,
+        e.g. as they have been finished before the snapshots were introduced.
+
+        :param limit: Maximum number of games to process in this transaction
+        :return: The number of written snapshots. 0 if all finished games have a snapshot.
+        """
+        games = session.query(model.Game)\
+            .outerjoin(model.GameResult, model.GameResult.game_id == model.Game.id)\
+            .filter(model.Game.finished != None, model.GameResult.game_id == None)\
+            .order_by(model.Game.id)\
+            .limit(limit)\
+            .all()
+        for game in games:
+            self._write_result_snapshot(game, session)
+        return len(games)
+
+    @with_session
+    def archive_games(self, session: Session, before: datetime.datetime, limit: int) -> int:
+        """
+        Archive games, which have been finished before the given time: Move their participants, sheets and entries
+        from the tables, which are also used by the running games, to the archive tables (see `model.ArchivedSheet`,
+        `model.ArchivedEntry` and `model.ArchivedParticipant`) within the same transaction. The game itself and its
+        materialized result snapshot (see `model.GameResult`, written first, if missing) are kept, so the result URLs
+        keep working.
+
+        :param before: Archive games finished before this (UTC) time
+        :param limit: Maximum number of games to archive in this transaction
+        :return: The number of archived games. 0 if there are no more games to archive.
+        """
+        games = session.query(model.Game)\
+            .filter(model.Game.finished < before, model.Game.archived == None)\
+            .order_by(model.Game.id)\
+            .limit(limit)\
+            .all()
+        if not games:
+            return 0
+        game_ids = [game.id for game in games]
+        with_snapshot = set(game_id for (game_id,) in session.query(model.GameResult.game_id)
+                            .filter(model.GameResult.game_id.in_(game_ids)))
+        for game in games:
+            if game.id not in with_snapshot:
+                self._write_result_snapshot(game, session)
+            game.archived = datetime.datetime.now(datetime.timezone.utc)
+        session.flush()
+
+        sheet_ids = session.query(model.Sheet.id).filter(model.Sheet.game_id.in_(game_ids)).as_scalar()
+        for source, target, condition in (
+                (model.Sheet, model.ArchivedSheet, model.Sheet.game_id.in_(game_ids)),
+                (model.Entry, model.ArchivedEntry, model.Entry.sheet_id.in_(sheet_ids)),
+                (model.Participant, model.ArchivedParticipant, model.Participant.game_id.in_(game_ids))):
+            columns = [column.name for column in source.__table__.columns]
+            session.execute(target.__table__.insert().from_select(
+                columns, sqlalchemy.select([source.__table__.c[name] for name in columns]).where(condition)))
+        # Remove the references to the sheets and entries first to satisfy the foreign key constraints
+        session.query(model.User)\
+            .filter(model.User.current_sheet_id.in_(sheet_ids))\
+            .update({model.User.current_sheet_id: None}, synchronize_session=False)
+        session.query(model.Sheet)\
+            .filter(model.Sheet.game_id.in_(game_ids))\
+            .update({model.Sheet.last_entry_id: None, model.Sheet.current_user_id: None}, synchronize_session=False)
+        session.query(model.Entry)\
+            .filter(model.Entry.sheet_id.in_(sheet_ids))\
+            .delete(synchronize_session=False)
+        session.query(model.Sheet)\
+            .filter(model.Sheet.game_id.in_(game_ids))\
+            .delete(synchronize_session=False)
+        session.query(model.Participant)\
+            .filter(model.Participant.game_id.in_(game_ids))\
+            .delete(synchronize_session=False)
+        logger.info("Archived games %s.", game_ids)
+        return len(games)
+
+    def _result_snapshot(self, session: Session, game_id: int) -> Optional[ResultGame]:
+        """ Get the materialized result snapshot of the given game from the `result_snapshot_cache` or the database or
+        None, if there is none (yet). """
+        snapshot = self.result_snapshot_cache.get(game_id, None)
+        if snapshot is None:
+            data = session.query(model.GameResult.data)\
+                .filter(model.GameResult.game_id == game_id)\
+                .scalar()
+            if data is None:
+                return None
+            snapshot = decode_result_snapshot(data)
+            self.result_snapshot_cache.put(game_id, snapshot)
+        return snapshot
+
+    def _result_snapshot_of_sheet(self, session: Session, sheet_id: int) -> Optional[Tuple[ResultGame, ResultSheet]]:
+        """ Get a sheet and its game (without sheets) from the game's materialized result snapshot or None, if there is
+        no such snapshot. """
+        game_id = session.query(model.Sheet.game_id).filter(model.Sheet.id == sheet_id).scalar()
+        if game_id is None:
+            game_id = session.query(model.ArchivedSheet.game_id).filter(model.ArchivedSheet.id == sheet_id).scalar()
+        snapshot = self._result_snapshot(session, game_id) if game_id is not None else None
+        if snapshot is None:
+            return None
+        for sheet in snapshot.sheets:
+            if sheet.id == sheet_id:
+                return snapshot._replace(sheets=[]), sheet
+        return None
+
+    def _write_result_snapshot(self, game: model.Game, session: Session) -> None:
+        """ Add the materialized result snapshot of the given finished game to the session. """
+        sheets = self._result_sheets(session, game.id)
+        snapshot = ResultGame(game.id, game.name, _naive_utc(game.started), _naive_utc(game.finished),
+                              game.is_showing_result_names, sum(sheet.num_entries for sheet in sheets), sheets)
+        session.add(model.GameResult(game_id=game.id, created=datetime.datetime.now(datetime.timezone.utc),
+                                     data=encode_result_snapshot(snapshot)))
+
+    @staticmethod
+    def _result_game(session: Session, game_id: int) -> Optional[ResultGame]:
+        row = session.query(model.Game.id, model.Game.name, model.Game.started, model.Game.finished,
+                            model.Game.is_showing_result_names, _game_num_entries())\
+            .filter(model.Game.id == game_id, model.Game.finished != None)\
+            .one_or_none()
+        return ResultGame(*row, sheets=[]) if row is not None else None
+
+    @staticmethod
+    def _result_sheet(session: Session, sheet_id: int) -> Optional[Tuple[ResultGame, ResultSheet]]:
+        row = session.query(model.Sheet.id, model.Sheet.num_entries, model.Game.id, model.Game.name,
+                            model.Game.started, model.Game.finished, model.Game.is_showing_result_names,
+                            _game_num_entries())\
+            .join(model.Sheet.game)\
             .filter(model.Sheet.id == sheet_id, model.Game.finished != None)\
-            .options(raiseload('*'),
-                     joinedload(model.Sheet.game)
-                     .selectinload(model.Game.participants)
-                     .joinedload(model.Participant.user),
-                     selectinload(model.Sheet.entries)
-                     .joinedload(model.Entry.user))\
             .one_or_none()
-
-        session.expunge_all()
-        return sheet
+        if row is None:
+            return None
+        return ResultGame(*row[2:], sheets=[]), ResultSheet(row[0], row[2], row[1], entries=[])
+
+    def _result_sheets(self, session: Session, game_id: int) -> List[ResultSheet]:
+        sheets = [ResultSheet(*row, entries=[])
+                  for row in session.query(model.Sheet.id, model.Sheet.game_id, model.Sheet.num_entries)
+                  .filter(model.Sheet.game_id == game_id)
+                  .order_by(model.Sheet.id)]
+        if not sheets:
+            return sheets
+        sheets_by_id = {sheet.id: sheet for sheet in sheets}
+        for sheet_id, entry in self._query_result_entries(
+                session, game_id, model.Entry.sheet_id.in_(session.query(model.Sheet.id)
+                                                           .filter(model.Sheet.game_id == game_id)
+                                                           .as_scalar())):
+            sheets_by_id[sheet_id].entries.append(entry)
+        return sheets
+
+    @staticmethod
+    def _query_result_entries(session: Session, game_id: int, condition: Any) -> List[Tuple[int, ResultEntry]]:
+        """
+        Query the entries matching the given SQL `condition` as (sheet_id, ResultEntry) tuples, ordered by sheet and
+        position, including the authors' names, which are made unambiguous among the participants of the given game.
+        """
+        first_name_count = collections.Counter(
+            first_name for (first_name,) in session.query(model.User.first_name)
+            .join(model.Participant, model.Participant.user_id == model.User.id)
+            .filter(model.Participant.game_id == game_id))
+        query = session.query(model.Entry.sheet_id, model.Entry.position, model.Entry.type, model.Entry.text,
+                              model.Entry.timestamp, model.User.first_name, model.User.last_name, model.User.username)\
+            .join(model.Entry.user)\
+            .filter(condition)\
+            .order_by(model.Entry.sheet_id, model.Entry.position)
+        return [(row.sheet_id, ResultEntry(row.position, row.type, row.text, row.timestamp,
+                                           model.format_user_name(row.first_name, row.last_name, row.username, True,
+                                                                  first_name_count[row.first_name] > 1)))
+                for row in query]
 
     @with_session
     def set_chat_locale(self, session: Session, chat_id: int, locale: str, override: bool = False) -> None:
@@ -243,6 +813,33 @@ class GameServer:
                 .filter(model.SelectedLocale.chat_id == chat_id)\
                 .scalar() is None:
             session.add(l)
+        else:
+            return
+        # Update the locale cache, as soon as the change is committed
+        session.info.setdefault('locale_cache_updates', {})[chat_id] = locale
+
+    @with_session
+    def mark_update_processed(self, session: Session, update_id: int) -> bool:
+        """
+        Record the id of a Telegram update as processed.
+
+        :return: False, if the update has already been recorded before. Concurrent calls with the same update id may
+            also fail with an `IntegrityError`.
+        """
+        if session.query(model.ProcessedUpdate.update_id)\
+                .filter(model.ProcessedUpdate.update_id == update_id)\
+                .scalar() is not None:
+            return False
+        session.add(model.ProcessedUpdate(update_id=update_id,
+                                          processed=datetime.datetime.now(datetime.timezone.utc)))
+        return True
+
+    @with_session
+    def cleanup_processed_updates(self, session: Session, before: datetime.datetime) -> int:
+        """ Delete the records of processed updates, which have been processed before the given time """
+        return session.query(model.ProcessedUpdate)\
+            .filter(model.ProcessedUpdate.processed < before)\
+            .delete(synchronize_session=False)
 
     @with_session
     def register_user(self, session: Session, chat_id: int, user_id: int, first_name: str, last_name: str,
@@ -285,6 +882,7 @@ class GameServer:
                 "start a game."))], session)
 
     @with_session
+    @via_outbox
     def new_game(self, session: Session, chat_id: int, name: str) -> List[TranslatedMessage]:
         """
         Create a new game in the given group chat and inform the group about success or cause of failure of this action.
@@ -308,6 +906,8 @@ class GameServer:
                                      .format(command=COMMAND_JOIN_GAME))], session)
 
     @with_session
+    @serialized_by_game(_game_of_group_chat)
+    @via_outbox
     def set_rounds(self, session: Session, chat_id: int, rounds: int) -> List[TranslatedMessage]:
         game = session.query(model.Game).filter(model.Game.chat_id == chat_id,
                                                 model.Game.finished == None).one_or_none()
@@ -326,6 +926,8 @@ class GameServer:
             "Number of rounds set: {number_rounds}").format(number_rounds=game.rounds))], session)
 
     @with_session
+    @serialized_by_game(_game_of_group_chat)
+    @via_outbox
     def set_synchronous(self, session: Session, chat_id: int, state: bool) -> List[TranslatedMessage]:
         game = session.query(model.Game).filter(model.Game.chat_id == chat_id,
                                                 model.Game.finished == None).one_or_none()
@@ -340,6 +942,8 @@ class GameServer:
         return self._get_translations([Message(chat_id, GetText(f"✅ Set game mode."))], session)
 
     @with_session
+    @serialized_by_game(_game_of_group_chat)
+    @via_outbox
     def set_show_result_names(self, session: Session, chat_id: int, state: bool) -> List[TranslatedMessage]:
         game = session.query(model.Game).filter(model.Game.chat_id == chat_id,
                                                 model.Game.finished == None).one_or_none()
@@ -354,6 +958,8 @@ class GameServer:
         return self._get_translations([Message(chat_id, GetNoText("✅"))], session)
 
     @with_session
+    @serialized_by_game(_game_of_group_chat)
+    @via_outbox
     def join_game(self, session: Session, chat_id: int, user_id: int) -> List[TranslatedMessage]:
         game = session.query(model.Game)\
             .filter(model.Game.chat_id == chat_id, model.Game.finished == None)\
@@ -404,11 +1010,13 @@ class GameServer:
         messages = [Message(chat_id, GetText("Yay! Welcome {name} 🤗").format(name=user.first_name))]
 
         if new_sheet:
-            user.pending_sheets.append(model.Sheet(game=game))
+            self._enqueue_sheets([(model.Sheet(game=game), user)], session)
             messages.extend(self._next_sheet([user], session))
         return self._get_translations(messages, session)
 
     @with_session
+    @serialized_by_game(_game_of_group_chat)
+    @via_outbox
     def start_game(self, session: Session, chat_id: int) -> List[TranslatedMessage]:
         game = session.query(model.Game)\
             .filter(model.Game.chat_id == chat_id, model.Game.finished == None)\
@@ -427,8 +1035,7 @@ class GameServer:
                 "No games with less than two participants permitted 🙅‍♀️"))], session)
 
         # Create sheets and start game
-        for participant in game.participants:
-            participant.user.pending_sheets.append(model.Sheet(game=game))
+        self._enqueue_sheets([(model.Sheet(game=game), participant.user) for participant in game.participants], session)
         game.started = datetime.datetime.now(datetime.timezone.utc)
 
         # Set number of rounds if unset
@@ -443,6 +1050,8 @@ class GameServer:
         return self._get_translations(result, session)
 
     @with_session
+    @serialized_by_game(_game_of_group_chat)
+    @via_outbox
     def leave_game(self, session: Session, chat_id: int, user_id: int) -> List[TranslatedMessage]:
         game = session.query(model.Game)\
             .filter(model.Game.chat_id == chat_id, model.Game.finished == None)\
@@ -478,17 +1087,20 @@ class GameServer:
         if user.current_sheet is not None and user.current_sheet.game_id == game.id:
             logger.debug("Retracting sheet %s from user %s, who left the game.", user.current_sheet_id, user.id)
             result.append(Message(user.chat_id, GetText("You left the game. No answer required anymore.")))
-            result.extend(self._next_sheet([user], session))
+            user.current_sheet = None
         obsolete_sheets = [sheet
                            for sheet in user.pending_sheets
                            if sheet.game_id == game.id]
         logger.debug("Passing sheets %s from user %s, who left the game.",
                      ",".join(str(s.id) for s in obsolete_sheets), user.id)
         self._assign_sheet_to_next(obsolete_sheets, game, session)
-        result.extend(self._next_sheet([sheet.current_user for sheet in obsolete_sheets if sheet.current_user], session))
+        result.extend(self._next_sheet([user] + [sheet.current_user for sheet in obsolete_sheets if sheet.current_user],
+                                       session))
         return self._get_translations(result, session)
 
     @with_session
+    @serialized_by_game(_game_of_group_chat)
+    @via_outbox
     def stop_game(self, session: Session, chat_id: int) -> List[TranslatedMessage]:
         """
         Handle a request for a normal game stop in the given group chat.
@@ -517,7 +1129,7 @@ class GameServer:
             # their current_sheet)
             users_to_update = set()
             for sheet_info in sheet_infos:
-                if not sheet_info.num_entries or sheet_info.last_entry.type == model.EntryType.ANSWER:
+                if not sheet_info.num_entries or sheet_info.last_entry_type == model.EntryType.ANSWER:
                     sheet_user: Optional[model.User] = sheet_info.sheet.current_user
                     if sheet_user is not None:
                         logger.debug("Removing sheet %s from user %s's queue due to game stop.",
@@ -535,6 +1147,8 @@ class GameServer:
         return self._get_translations(messages, session)
 
     @with_session
+    @serialized_by_game(_game_of_group_chat)
+    @via_outbox
     def immediately_stop_game(self, session: Session, chat_id: int) -> List[TranslatedMessage]:
         """
         Handle a request for an immediate game stop in the given group chat.
@@ -552,6 +1166,8 @@ class GameServer:
         return self._get_translations(self._finalize_game(game, session), session)
 
     @with_session
+    @serialized_by_game(_game_of_current_sheet)
+    @via_outbox
     def submit_text(self, session: Session, chat_id: int, message_id: int, text: str) -> List[TranslatedMessage]:
         """
         Process a message send by a user in their private chat.
@@ -562,9 +1178,15 @@ class GameServer:
 
         :param chat_id: The chat_id in which the message has been received. Should be the private chat with a user.
         :param message_id: Telegram's message id (within the chat). It is stored in the database and used to identify
-            the message on edits.
+            the message on edits. If an entry with this message id is already stored, the message is ignored.
         :param text: The messages text.
         """
+        # The same message may be delivered twice by Telegram (e.g. after a restart), so ignore it, if it is known
+        if session.query(model.Entry.id)\
+                .filter(model.Entry.chat_id == chat_id, model.Entry.message_id == message_id)\
+                .first() is not None:
+            logger.info("Ignoring duplicate message %s in chat %s.", message_id, chat_id)
+            return []
         user = session.query(model.User).filter(model.User.chat_id == chat_id).one_or_none()
         if user is None:
             return self._get_translations([Message(chat_id,
@@ -582,11 +1204,11 @@ class GameServer:
         logger.info("Adding entry by user %s to sheet %s in game %s.",
                     user.id, current_sheet.id, current_sheet.game.id)
         entry_type = (model.EntryType.QUESTION
-                      if not current_sheet.entries or current_sheet.entries[-1].type == model.EntryType.ANSWER
+                      if current_sheet.last_entry_type in (None, model.EntryType.ANSWER)
                       else model.EntryType.ANSWER)
-        current_sheet.entries.append(model.Entry(user=user, text=text, type=entry_type, chat_id=chat_id,
-                                                 message_id=message_id,
-                                                 timestamp=datetime.datetime.now(datetime.timezone.utc)))
+        current_sheet.append_entry(model.Entry(user=user, text=text, type=entry_type, chat_id=chat_id,
+                                               message_id=message_id,
+                                               timestamp=datetime.datetime.now(datetime.timezone.utc)))
         result.append(Message(chat_id, GetNoText("🆗")))
         user.current_sheet = None
         current_sheet.current_user = None
@@ -597,13 +1219,13 @@ class GameServer:
         result.extend(self._finish_if_complete(game, sheet_infos, session))
         result.extend(self._finish_if_stopped_and_all_answered(game, sheet_infos, session))
 
-        if game.finished is None and len(current_sheet.entries) < game.rounds:
+        if game.finished is None and current_sheet.num_entries < game.rounds:
             # In a synchronous game: Check if the round is finished and pass sheets on
             if game.is_synchronous:
                 logger.debug("Checking if new round in synchronous game %s should be triggered.", game.id)
-                if all(num_entries == len(current_sheet.entries) for sheet, num_entries, last_entry in sheet_infos):
+                if all(si.num_entries == current_sheet.num_entries for si in sheet_infos):
                     logger.info("Triggering new round %s in synchronous game %s.",
-                                len(current_sheet.entries) + 1, game.id)
+                                current_sheet.num_entries + 1, game.id)
                     # TODO don't assign answered sheets in stopped games? Might be relevant for leaving/joining in-game
                     self._assign_sheet_to_next(list(game.sheets), game, session)
                     result.extend(self._next_sheet(list(p.user for p in game.participants), session))
@@ -618,6 +1240,8 @@ class GameServer:
         return self._get_translations(result, session)
 
     @with_session
+    @serialized_by_game(_game_of_message)
+    @via_outbox
     def edit_submitted_message(self, session: Session, chat_id: int, message_id: int, new_text: str) \
             -> List[TranslatedMessage]:
         entry = session.query(model.Entry)\
@@ -634,10 +1258,7 @@ class GameServer:
                                                                     "because the relevant game is already finished.")
                                                    .format(old_text=truncate_string(entry.text)))], session)
 
-        last_entry_pos = session.query(func.max(model.Entry.position))\
-            .filter(model.Entry.sheet_id == entry.sheet_id)\
-            .scalar()
-        if entry.position < last_entry_pos:
+        if entry.sheet.last_entry_id != entry.id:
             return self._get_translations([Message(chat_id,
                                                    GetText("Changing message “{old_text}” is not accepted, "
                                                            "because the next player already responded to that entry.")
@@ -768,6 +1389,8 @@ class GameServer:
         return self._get_translations([Message(chat_id, status)], session)
 
     @with_session
+    @serialized_by_game(_game_of_group_chat)
+    @via_outbox
     def shuffle_players(self, session: Session, chat_id: int) -> List[TranslatedMessage]:
         game = session.query(model.Game).filter(model.Game.chat_id == chat_id,
                                                 model.Game.finished == None).one_or_none()
@@ -791,16 +1414,30 @@ class GameServer:
         """
         Helper function to look up a the target language for a list of `Message`s and translate them.
         """
-        locales = dict(session.query(model.SelectedLocale.chat_id, model.SelectedLocale.locale)
-                       .filter(model.SelectedLocale.chat_id.in_(set(m.chat_id for m in messages)))
-                       .all())
-        return [TranslatedMessage(m.chat_id,
-                                  m.text.get_translation(gettext.translation('qaqa_bot',
-                                                                             LOCALE_DIR,
-                                                                             (locales.get(m.chat_id, 'en'),),
-                                                                             fallback=True)))
+        locales = self._get_locales(set(m.chat_id for m in messages), session)
+        return [TranslatedMessage(m.chat_id, m.text.get_translation(
+            TRANSLATIONS.get(TRANSLATIONS.match(locales[m.chat_id] or 'en'))))
                 for m in messages]
 
+    def _get_locales(self, chat_ids: Iterable[int], session: Session) -> Dict[int, Optional[str]]:
+        """
+        Helper function to look up the selected locales of the given chats.
+
+        The locales are taken from the `locale_cache`, if possible. All remaining chats are queried at once and added to
+        the cache, including chats without a selected locale (negative caching).
+
+        :return: A dict, mapping each of the chat_ids to its selected locale or None, if no locale has been selected
+        """
+        locales, missing = self.locale_cache.get_many(chat_ids)
+        if missing:
+            queried_locales: Dict[int, Optional[str]] = dict.fromkeys(missing)
+            queried_locales.update(session.query(model.SelectedLocale.chat_id, model.SelectedLocale.locale)
+                                   .filter(model.SelectedLocale.chat_id.in_(missing)))
+            if 'locale_cache_token' in session.info:
+                self.locale_cache.fill(queried_locales, session.info['locale_cache_token'])
+            locales.update(queried_locales)
+        return locales
+
     # ###########################################################################
     # Helper methods for managing sheets
 
@@ -808,32 +1445,18 @@ class GameServer:
                           ) -> List[SheetProgressInfo]:
         """ Helper function to get the `SheetProgressInfo` for all sheets of a given Game.
 
-        This list is required by some of the helper functions below. It is generated with an optimized SQL query and may
-        be used multiple times, e.g. for checking if a game is finished by `_finish_if_complete` and
-        `_finish_if_stopped_and_all_answered`.
+        This list is required by some of the helper functions below. It is generated with a single query of the game's
+        sheets, using their denormalized progress columns, and may be used multiple times, e.g. for checking if a game
+        is finished by `_finish_if_complete` and `_finish_if_stopped_and_all_answered`.
 
         :param eager_current_user: If True, the Sheet.current_user field is loaded eagerly (using Joined Eager Loading)
         """
-        num_subquery = session.query(model.Entry.sheet_id,
-                                     func.count().label('num_entries')) \
-            .group_by(model.Entry.sheet_id) \
-            .subquery()
-        max_pos_subquery = session.query(model.Entry.sheet_id,
-                                         func.max(model.Entry.position).label('max_position')) \
-            .group_by(model.Entry.sheet_id) \
-            .subquery()
-        query = session.query(model.Sheet, num_subquery.c.num_entries, model.Entry)\
-            .outerjoin(num_subquery, model.Sheet.id == num_subquery.c.sheet_id)\
-            .outerjoin(max_pos_subquery)\
-            .outerjoin(model.Entry, and_(model.Entry.sheet_id == model.Sheet.id,
-                                         model.Entry.position == max_pos_subquery.c.max_position)) \
-            .filter(model.Sheet.game == game)
+        query = session.query(model.Sheet)\
+            .filter(model.Sheet.game_id == game.id)
         if eager_current_user:
             query = query.options(joinedload(model.Sheet.current_user))
 
-        return [SheetProgressInfo(sheet, num_entries if num_entries is not None else 0, last_entry)
-                for sheet, num_entries, last_entry
-                in query]
+        return [SheetProgressInfo.of(sheet) for sheet in query]
 
     def _next_sheet(self, users: Iterable[model.User], session: Session, repeat: bool = False) -> List[Message]:
         """ Helper function to check for a list of users, if they have no current sheet, pick the next sheet from their
@@ -842,64 +1465,50 @@ class GameServer:
         :param users: The users to check for pending sheets and send messages to
         :param repeat: If True, resend the request for submission to all given users, even if they already have a sheet
             assigned."""
-        # The following manually crafted SQL query is basically and extended version of _game_sheet_infos() to
-        # efficiently query sheets, their entry numbers and last entries along with each User object.
+        # The following manually crafted SQL query efficiently fetches the next sheet of each user's queue along with
+        # each User object. The sheet's last entry is loaded with the same query, to be shown to the user.
+        user_ids = [u.id for u in users]
         min_sheet_pos_subquery = session.query(model.Sheet.current_user_id,
                                                func.min(model.Sheet.pending_position).label('min_position')) \
+            .filter(model.Sheet.current_user_id.in_(user_ids)) \
             .group_by(model.Sheet.current_user_id) \
             .subquery()
-        num_subquery = session.query(model.Entry.sheet_id,
-                                     func.count().label('num_entries')) \
-            .group_by(model.Entry.sheet_id) \
-            .subquery()
-        max_pos_subquery = session.query(model.Entry.sheet_id,
-                                         func.max(model.Entry.position).label('max_position')) \
-            .group_by(model.Entry.sheet_id) \
-            .subquery()
-        query = session.query(model.User,
-                              model.Sheet,
-                              num_subquery.c.num_entries,
-                              model.Entry)\
+        query = session.query(model.User, model.Sheet)\
             .outerjoin(min_sheet_pos_subquery)\
             .outerjoin(model.Sheet, and_(model.Sheet.current_user_id == model.User.id,
                                          model.Sheet.pending_position == min_sheet_pos_subquery.c.min_position))\
-            .outerjoin(num_subquery, model.Sheet.id == num_subquery.c.sheet_id)\
-            .outerjoin(max_pos_subquery)\
-            .outerjoin(model.Entry, and_(model.Entry.sheet_id == model.Sheet.id,
-                                         model.Entry.position == max_pos_subquery.c.max_position))\
-            .filter(model.User.id.in_(u.id for u in users))
+            .outerjoin(model.Entry, model.Entry.id == model.Sheet.last_entry_id)\
+            .options(contains_eager(model.Sheet.last_entry))\
+            .filter(model.User.id.in_(user_ids))
 
         result = []
         logger.debug("Checking %s to users %s.",
                      "current sheet to be processed" if repeat else "if a new sheets should be passed",
                      ",".join(str(u.id) for u in users))
-        for user, next_sheet, next_sheet_num_entries, next_sheet_last_entry in query:
+        for user, next_sheet in query:
             if (user.current_sheet_id is None or repeat) and next_sheet is not None:
                 user.current_sheet = next_sheet
                 logger.debug("Giving sheet %s to user %s.", next_sheet.id, user.id)
-                result.append(Message(user.chat_id, self._format_for_next(
-                    SheetProgressInfo(next_sheet,
-                                      next_sheet_num_entries if next_sheet_num_entries is not None else 0,
-                                      next_sheet_last_entry),
-                    user.current_sheet_id is not None)))
+                result.append(Message(user.chat_id, self._format_for_next(next_sheet,
+                                                                          user.current_sheet_id is not None)))
         return result
 
-    def _format_for_next(self, sheet_info: SheetProgressInfo, repeat: bool) -> LazyGetTextBase:
+    def _format_for_next(self, sheet: model.Sheet, repeat: bool) -> LazyGetTextBase:
         """ Create the message content for showing a sheet to a user and ask them for their next submission. The message
         contains the last entry of the sheet or a request to write the initial question if the sheet is empty.
 
         :param repeat: True, if this a repeated message for the same sheet and user"""
-        if sheet_info.num_entries == 0:
+        if not sheet.num_entries:
             return GetText("Please ask a question to begin a new sheet for game <i>{game_name}</i>.")\
-                .format(game_name=sheet_info.sheet.game.name)
+                .format(game_name=sheet.game.name)
         else:
-            assert(sheet_info.last_entry is not None)
-            if sheet_info.last_entry.type == model.EntryType.ANSWER:
+            assert(sheet.last_entry is not None)
+            if sheet.last_entry.type == model.EntryType.ANSWER:
                 return GetText("Please ask a question that may be answered with:\n“{text}”")\
-                    .format(text=sheet_info.last_entry.text)
+                    .format(text=sheet.last_entry.text)
             else:
                 return GetText("Please answer the following question:\n“{text}”")\
-                    .format(text=sheet_info.last_entry.text)
+                    .format(text=sheet.last_entry.text)
 
     def _assign_sheet_to_next(self, sheets: List[model.Sheet], game: model.Game, session: Session):
         """ Assign a list of sheets of a single game to the next user according the game's participant order
@@ -908,35 +1517,63 @@ class GameServer:
         sheet for submissions in an asynchronous game.
 
         The list of sheets is processed at once for optimization reasons: The order of game participants is generated
-        only once and an optimized query is used to fetch all required information about the sheets' entries at once."""
+        only once and a single query is used to fetch the authors of all sheets' last entries at once."""
+        if not sheets:
+            return
         next_mapping = {p1.user_id: p2.user for p1, p2 in zip(game.participants, game.participants[1:])}
         next_mapping[game.participants[-1].user_id] = game.participants[0].user
 
-        # Fetch the last entry of all sheets with a single query. It is basically a manual version of SQLAlchemy's
-        # `selectinload`
-        max_pos_subquery = session.query(model.Entry.sheet_id,
-                                         func.max(model.Entry.position).label('max_position')) \
-            .group_by(model.Entry.sheet_id)\
-            .subquery()
-        query = session.query(model.Sheet.id, model.Entry)\
-            .outerjoin(max_pos_subquery)\
-            .outerjoin(model.Entry, and_(model.Entry.sheet_id == model.Sheet.id,
-                                         model.Entry.position == max_pos_subquery.c.max_position))\
-            .filter(model.Sheet.id.in_(sheet.id for sheet in sheets))
-        last_entry_by_sheet_id: Dict[int, model.Entry] = dict(query.all())
+        # Fetch the author of the last entry of all sheets with a single query
+        last_entry_ids = [sheet.last_entry_id for sheet in sheets if sheet.last_entry_id is not None]
+        last_author_by_entry_id: Dict[int, int] = dict(
+            session.query(model.Entry.id, model.Entry.user_id)
+            .filter(model.Entry.id.in_(last_entry_ids))
+            .all())
 
+        assignments = []
         for sheet in sheets:
-            sheet.current_user = None
-            sheet.pending_position = None
-            if last_entry_by_sheet_id[sheet.id] is None:
+            if sheet.last_entry_id is None:
                 # Passing on an empty sheet, means something unusual happend (e.g. the user left the game before writing
                 # something). Let's get rid of those sheets.
+                sheet.current_user = None
+                sheet.pending_position = None
                 session.delete(sheet)
                 continue
 
-            next_user = next_mapping[last_entry_by_sheet_id[sheet.id].user_id]
+            next_user = next_mapping.get(last_author_by_entry_id[sheet.last_entry_id])
+            if next_user is None:
+                # The last author has left the game in the meantime (e.g. after their submission in the current round
+                # of a synchronous game). Pass the sheet to the participant with the fewest sheets in this batch.
+                next_user = min((p.user for p in game.participants),
+                                key=lambda u: sum(1 for _sheet, user in assignments if user is u))
             logger.debug("Assigning sheet %s to user %s ...", sheet.id, next_user.id)
-            next_user.pending_sheets.append(sheet)
+            assignments.append((sheet, next_user))
+        self._enqueue_sheets(assignments, session)
+
+    def _enqueue_sheets(self, assignments: List[Tuple[model.Sheet, model.User]], session: Session) -> None:
+        """ Append sheets to the end of the given users' queues of pending sheets.
+
+        In contrast to `user.pending_sheets.append(sheet)`, this does not load the `User.pending_sheets` collection of
+        each user (and does not renumber the remaining sheets of the previous user's queue). Instead, the current end of
+        all users' queues is fetched with a single query and the sheets' `current_user` and `pending_position` are set
+        directly. Thus, the queue positions may contain gaps, which is fine, since only their order is relevant.
+
+        :param assignments: A list of (sheet, user) tuples: Each sheet is appended to the queue of the respective user
+        """
+        user_ids = {user.id for _sheet, user in assignments}
+        if not user_ids:
+            return
+        last_position: Dict[int, Optional[int]] = dict(
+            session.query(model.Sheet.current_user_id, func.max(model.Sheet.pending_position))
+            .filter(model.Sheet.current_user_id.in_(user_ids))
+            .group_by(model.Sheet.current_user_id)
+            .all())
+        for sheet, user in assignments:
+            position = last_position.get(user.id)
+            position = 0 if position is None else position + 1
+            last_position[user.id] = position
+            sheet.current_user = user
+            sheet.pending_position = position
 
     # ###########################################################################
     # Helper methods for ending the game
@@ -963,7 +1600,7 @@ class GameServer:
         """
         if game.is_waiting_for_finish:
             logger.debug("Checking if opportunity to stop game %s is give n...", game.id)
-            if all(sheet_info.last_entry is None or sheet_info.last_entry.type == model.EntryType.ANSWER
+            if all(sheet_info.last_entry_type is None or sheet_info.last_entry_type == model.EntryType.ANSWER
                    for sheet_info in sheet_infos):
                 return self._finalize_game(game, session)
         return []
@@ -996,10 +1633,7 @@ class GameServer:
         messages.extend(self._next_sheet(list(users_to_update), session))
 
         # Generate result URL message
-        locale = session.query(model.SelectedLocale.locale)\
-            .filter(model.SelectedLocale.chat_id == game.chat_id)\
-            .scalar()
-        locale = locale or 'en'
+        locale = self._get_locales([game.chat_id], session)[game.chat_id] or 'en'
         messages.append(
             Message(game.chat_id, GetText("Game finished. View results at <a href=\"{url}\">{url}</a>.").format(
                 url="{}/game/{}/?lang={}{}".format(
@@ -1009,6 +1643,7 @@ class GameServer:
                     locale,
                     "&authors=1" if game.is_showing_result_names else ""))))
         game.finished = datetime.datetime.now(datetime.timezone.utc)
+        self._write_result_snapshot(game, session)
         return messages
 
     def _entry_to_string(self, game: model.Game, entry: model.Entry) -> str:
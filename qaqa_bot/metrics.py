@@ -0,0 +1,274 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Simple in-process metrics for the QAQA game bot.
+
+This module provides thread-safe `Counter`, `Gauge` and `Histogram` metrics, which are created and kept by a
+`MetricsRegistry`, identified by a name and a set of labels (like Prometheus metrics). They can be exported in
+Prometheus' text format with `format_prometheus()`. The GameServer records the statistics of each game
+action (see `ActionSample`) into its registry and additionally passes them to a pluggable `MetricsSink`, e.g. the
+`LoggingSink` to log each sample or the `InMemorySink` to collect them for tests and benchmarks.
+"""
+
+import abc
+import bisect
+import logging
+import threading
+from typing import NamedTuple, Tuple, Dict, List, Sequence, Union, Optional, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+#: Default histogram buckets for durations in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+#: Default histogram buckets for counts, e.g. the number of SQL statements
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Counter:
+    """ A thread-safe, monotonically increasing value. Alternatively, the value may be provided by a callback function,
+    which is called whenever the value is read. """
+    def __init__(self, function: Optional[Callable[[], float]] = None):
+        self._lock = threading.Lock()
+        self._value = 0.0
+        self.function = function
+
+    @property
+    def value(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+
+class Gauge:
+    """ A thread-safe value, which may go up and down. Alternatively, the value may be provided by a callback function,
+    which is called whenever the value is read. """
+    def __init__(self, function: Optional[Callable[[], float]] = None):
+        self._lock = threading.Lock()
+        self._value = 0.0
+        self.function = function
+
+    @property
+    def value(self) -> float:
+        if self.function is not None:
+            return self.function()
+        return self._value
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+
+class HistogramSnapshot(NamedTuple):
+    """ A consistent copy of a histogram's state. `counts[i]` is the number of observations `<= buckets[i]`
+    (cumulative, like in Prometheus); the last entry of `counts` is the total number of observations. """
+    buckets: Tuple[float, ...]
+    counts: Tuple[int, ...]
+    sum: float
+    count: int
+
+
+class Histogram:
+    """ A thread-safe histogram of observed values with fixed bucket upper bounds """
+    def __init__(self, buckets: Sequence[float] = DURATION_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def snapshot(self) -> HistogramSnapshot:
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = []
+        count = 0
+        for c in counts:
+            count += c
+            cumulative.append(count)
+        return HistogramSnapshot(self.buckets, tuple(cumulative), total, count)
+
+
+Metric = Union[Counter, Gauge, Histogram]
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class MetricFamily(NamedTuple):
+    """ All metrics with the same name (but different labels), as returned by `MetricsRegistry.collect()` """
+    name: str
+    type: str
+    help: str
+    metrics: List[Tuple[Labels, Metric]]
+
+
+class MetricsRegistry:
+    """
+    A thread-safe collection of metrics, identified by name and labels.
+
+    Metrics are created on first use by `counter()`, `gauge()` or `histogram()`. Subsequent calls with the same name
+    and labels return the same metric object.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families: Dict[str, MetricFamily] = {}
+
+    def counter(self, name: str, help: str = "", function: Optional[Callable[[], float]] = None, **labels: str
+                ) -> Counter:
+        return self._get(name, 'counter', help, labels, lambda: Counter(function))
+
+    def gauge(self, name: str, help: str = "", function: Optional[Callable[[], float]] = None, **labels: str) -> Gauge:
+        return self._get(name, 'gauge', help, labels, lambda: Gauge(function))
+
+    def histogram(self, name: str, help: str = "", buckets: Sequence[float] = DURATION_BUCKETS, **labels: str
+                  ) -> Histogram:
+        return self._get(name, 'histogram', help, labels, lambda: Histogram(buckets))
+
+    def collect(self) -> List[MetricFamily]:
+        """ Get a list of all metric families, sorted by name """
+        with self._lock:
+            return [family._replace(metrics=list(family.metrics))
+                    for _name, family in sorted(self._families.items())]
+
+    def _get(self, name: str, type_: str, help: str, labels: Dict[str, str], factory) -> Metric:
+        label_tuple: Labels = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = MetricFamily(name, type_, help, [])
+                self._families[name] = family
+            elif family.type != type_:
+                raise ValueError("Metric {} is already registered as {}".format(name, family.type))
+            for metric_labels, metric in family.metrics:
+                if metric_labels == label_tuple:
+                    return metric
+            metric = factory()
+            family.metrics.append((label_tuple, metric))
+            return metric
+
+
+def format_prometheus(families: Iterable[MetricFamily]) -> str:
+    """ Format the given metric families (e.g. from `MetricsRegistry.collect()`) in Prometheus' text format """
+    lines = []
+    for family in families:
+        if family.help:
+            lines.append("# HELP {} {}".format(family.name, family.help.replace('\\', r'\\').replace('\n', r'\n')))
+        lines.append("# TYPE {} {}".format(family.name, family.type))
+        for labels, metric in family.metrics:
+            if isinstance(metric, Histogram):
+                snapshot = metric.snapshot()
+                for bound, count in zip(snapshot.buckets + (float('inf'),), snapshot.counts):
+                    lines.append("{}_bucket{} {}".format(family.name, _format_labels(labels + (('le', bound),)),
+                                                         count))
+                lines.append("{}_sum{} {}".format(family.name, _format_labels(labels), _format_value(snapshot.sum)))
+                lines.append("{}_count{} {}".format(family.name, _format_labels(labels), snapshot.count))
+            else:
+                lines.append("{}{} {}".format(family.name, _format_labels(labels), _format_value(metric.value)))
+    return "\n".join(lines) + "\n"
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    if value == float('-inf'):
+        return "-Inf"
+    return repr(float(value))
+
+
+def _format_labels(labels: Iterable[Tuple[str, Union[str, float]]]) -> str:
+    parts = []
+    for key, value in labels:
+        if isinstance(value, (int, float)):
+            value = _format_value(value)
+        value = str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        parts.append('{}="{}"'.format(key, value))
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class StatementStats:
+    """ Mutable accumulator for the number and execution time of SQL statements, e.g. of a single GameServer action """
+    __slots__ = ('statements', 'db_time')
+
+    def __init__(self):
+        self.statements = 0
+        self.db_time = 0.0
+
+
+class ActionSample(NamedTuple):
+    """ Statistics of a single call of a GameServer action (i.e. a method wrapped by `@with_session`) """
+    #: Name of the GameServer method, e.g. 'submit_text'
+    action: str
+    #: Number of transaction attempts (1 if no retry was required)
+    attempts: int
+    #: Total wall time of the action in seconds, including all attempts and backoff times
+    wall_time: float
+    #: Total time spent executing SQL statements in seconds
+    db_time: float
+    #: Number of executed SQL statements
+    statements: int
+    #: False, if the action failed with an exception
+    success: bool
+
+
+class MetricsSink(metaclass=abc.ABCMeta):
+    """ Abstract base class for receivers of the GameServer's action statistics """
+    @abc.abstractmethod
+    def record_action(self, sample: ActionSample) -> None:
+        pass
+
+
+class LoggingSink(MetricsSink):
+    """ A MetricsSink, which logs each action sample, by default at DEBUG level to the `qaqa_bot.metrics` logger """
+    def __init__(self, level: int = logging.DEBUG, log: Optional[logging.Logger] = None):
+        self.level = level
+        self.logger = log or logger
+
+    def record_action(self, sample: ActionSample) -> None:
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level,
+                            "Action %s %s after %s attempt(s) in %.1f ms (%.1f ms in %s SQL statements)",
+                            sample.action, "succeeded" if sample.success else "failed", sample.attempts,
+                            sample.wall_time * 1000, sample.db_time * 1000, sample.statements,
+                            extra={'action_sample': sample})
+
+
+class InMemorySink(MetricsSink):
+    """ A MetricsSink, which keeps all action samples in a list, e.g. for tests and benchmarks """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: List[ActionSample] = []
+
+    def record_action(self, sample: ActionSample) -> None:
+        with self._lock:
+            self.samples.append(sample)
+
+    def by_action(self, action: str) -> List[ActionSample]:
+        with self._lock:
+            return [s for s in self.samples if s.action == action]
+
+    def clear(self) -> None:
+        with self._lock:
+            self.samples = []
@@ -25,9 +25,21 @@ A brief overview of the model:
 +-------+  0..* pending_sheets
   1 |
     | *
-+-------+                                                   +----------------+
-| Entry |                                                   | SelectedLocale |
-+-------+                                                   +----------------+
++-------+                                                   +----------------+  +---------------+
+| Entry |                                                   | SelectedLocale |  | OutboxMessage |
++-------+                                                   +----------------+  +---------------+
+                                                            +-----------------+  +------------+
+                                                            | ProcessedUpdate |  | GameResult |
+                                                            +-----------------+  +------------+
+                                                                                 +---------------+
+                                                                                 | ArchivedSheet |
+                                                                                 +---------------+
+                                                                                 +---------------+
+                                                                                 | ArchivedEntry |
+                                                                                 +---------------+
+                                                                             +---------------------+
+                                                                             | ArchivedParticipant |
+                                                                             +---------------------+
 
 A database schema according to the model can be creating using `Base.metadata.create_all(engine)` with an SQLAlchemy
 database engine. However, this should typically done through Alembic migrations, provided in the `database_versions/`
@@ -35,9 +47,10 @@ directory. Use `alembic upgrade head` on the CLI or `util.run_migrations()`.
 """
 
 import enum
-from typing import Iterable
+from typing import Iterable, Optional
 
-from sqlalchemy import Column, Integer, BigInteger, String, Boolean, Enum, ForeignKey, DateTime, Index, Unicode
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, Enum, ForeignKey, DateTime, Index, Unicode, \
+    UnicodeText, LargeBinary
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.orderinglist import ordering_list
@@ -50,7 +63,7 @@ class Game(Base):
     __tablename__ = 'games'
     id = Column(Integer, primary_key=True)
     name = Column(Unicode(512), nullable=False)
-    chat_id = Column(BigInteger, nullable=False, index=True)
+    chat_id = Column(BigInteger, nullable=False)
     # Game state:
     started = Column(DateTime)
     finished = Column(DateTime, index=True)
@@ -59,12 +72,22 @@ class Game(Base):
     rounds = Column(Integer)  # May be NULL until game start. In this case it is set to the number of players
     is_synchronous = Column(Boolean, nullable=False)
     is_showing_result_names = Column(Boolean, nullable=False)
+    # Time of archival, i.e. the moving of the finished game's participants, sheets and entries to the archive tables
+    # (see `ArchivedSheet`)
+    archived = Column(DateTime)
 
     participants = relationship('Participant', back_populates='game', order_by='Participant.game_order',
                                 collection_class=ordering_list('game_order'))
     sheets = relationship('Sheet', back_populates='game')
 
 
+# Nearly all actions look up the running game of a chat (`chat_id == … AND finished IS NULL`). On SQLite and PostgreSQL
+# the index only covers running games, so `finished` is implied by its predicate. On other backends (MySQL) it covers
+# all games, which are filtered by `finished` after the lookup of the chat's few games.
+Index('idx_games_running', Game.chat_id,
+      sqlite_where=Game.finished.is_(None), postgresql_where=Game.finished.is_(None))
+
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
@@ -96,19 +119,31 @@ class User(Base):
         :return: The user's combined name
         """
         ambiguous = sum(1 for u in make_unambiuous_in if u.first_name == self.first_name) > 1
-        # TODO make multiple last_names that start with the same letters unambiguous
-        result = self.first_name
-        if not short:
-            if self.last_name:
-                result += " " + self.last_name
-            if self.username:
-                result += " (@" + self.username + ")"
-        elif ambiguous:
-            if self.last_name:
-                result += " " + self.last_name[0] + "."
-            elif self.username:
-                result += " (@" + self.username + ")"
-        return result
+        return format_user_name(self.first_name, self.last_name, self.username, short, ambiguous)
+
+
+def format_user_name(first_name: str, last_name: Optional[str], username: Optional[str], short: bool = False,
+                     ambiguous: bool = False) -> str:
+    """
+    Format a user's name from the single columns, like `User.format_name()`, e.g. for names queried without loading
+    the User object.
+
+    :param ambiguous: If True and `short` is True, the last_name's first letter (if available) or the username is shown
+        in addition to the first_name
+    """
+    # TODO make multiple last_names that start with the same letters unambiguous
+    result = first_name
+    if not short:
+        if last_name:
+            result += " " + last_name
+        if username:
+            result += " (@" + username + ")"
+    elif ambiguous:
+        if last_name:
+            result += " " + last_name[0] + "."
+        elif username:
+            result += " (@" + username + ")"
+    return result
 
 
 class Participant(Base):
@@ -127,6 +162,11 @@ class Participant(Base):
     user = relationship('User', back_populates='participations', lazy='joined')
 
 
+class EntryType(enum.Enum):
+    QUESTION = 1
+    ANSWER = 2
+
+
 class Sheet(Base):
     __tablename__ = 'sheets'
     id = Column(Integer, primary_key=True)
@@ -134,25 +174,47 @@ class Sheet(Base):
     hint = Column(Unicode(4096))
     # In which user's queue (`User.pending_sheets`) does this sheet wait? May be NULL, if the sheet is finished or the
     # game is synchronous and the sheet is waiting for the next round.
-    current_user_id = Column(Integer, ForeignKey('users.id'), index=True)
+    current_user_id = Column(Integer, ForeignKey('users.id'))
     # Position of this Sheet in the `current_user`'s queue of sheets. Lower sheets are taken first.
     pending_position = Column(Integer, index=True)
+    # Denormalized progress of the sheet: The number of entries and the last entry (and its type). They are maintained
+    # by `append_entry()` and allow to check the state of all sheets of a game without aggregating the entries table.
+    num_entries = Column(Integer, nullable=False, default=0)
+    last_entry_id = Column(Integer, ForeignKey('entries.id', name='fk_sheets_last_entry_id', use_alter=True))
+    last_entry_type = Column(Enum(EntryType))
 
     game = relationship('Game', back_populates='sheets')
-    entries = relationship('Entry', back_populates='sheet', order_by='Entry.position',
+    entries = relationship('Entry', back_populates='sheet', order_by='Entry.position', foreign_keys='Entry.sheet_id',
                            collection_class=ordering_list('position'))
     current_user = relationship('User', back_populates='pending_sheets', foreign_keys=current_user_id)
+    last_entry = relationship('Entry', foreign_keys=last_entry_id, post_update=True)
 
+    def append_entry(self, entry: "Entry") -> None:
+        """
+        Add a new entry to the end of this sheet and update the denormalized progress columns accordingly.
+
+        Entries must always be added to sheets using this method (instead of appending them to `Sheet.entries`) to
+        keep `num_entries`, `last_entry` and `last_entry_type` consistent. This does not load the sheet's entries from
+        the database.
+        """
+        num_entries = self.num_entries or 0
+        entry.sheet = self
+        entry.position = num_entries
+        self.num_entries = num_entries + 1
+        self.last_entry = entry
+        self.last_entry_type = entry.type
 
-class EntryType(enum.Enum):
-    QUESTION = 1
-    ANSWER = 2
+
+# The users' queues of pending sheets: Used to find the first and last sheet of each queue. Sheets in no queue (most
+# sheets of finished games) are left out on SQLite and PostgreSQL.
+Index('idx_sheets_pending', Sheet.current_user_id, Sheet.pending_position,
+      sqlite_where=Sheet.current_user_id.isnot(None), postgresql_where=Sheet.current_user_id.isnot(None))
 
 
 class Entry(Base):
     __tablename__ = 'entries'
     id = Column(Integer, primary_key=True)
-    sheet_id = Column(Integer, ForeignKey('sheets.id'), nullable=False, index=True)
+    sheet_id = Column(Integer, ForeignKey('sheets.id'), nullable=False)
     # Position (sort key) of the entry on the sheet. `Sheet.entries` is sorted by this.
     position = Column(Integer, nullable=False, index=True)
     # The user, who wrote this entry
@@ -164,14 +226,107 @@ class Entry(Base):
     chat_id = Column(BigInteger)
     message_id = Column(Integer)
 
-    sheet = relationship('Sheet', back_populates='entries')
+    sheet = relationship('Sheet', back_populates='entries', foreign_keys=sheet_id)
     user = relationship('User')
 
 
 Index('idx_chat_message_id', Entry.chat_id, Entry.message_id, unique=True)
+Index('idx_entries_sheet_position', Entry.sheet_id, Entry.position, unique=True)
 
 
 class SelectedLocale(Base):
     __tablename__ = 'selected_locales'
     chat_id = Column(BigInteger, nullable=False, primary_key=True, autoincrement=False)
     locale = Column(String(length=20), nullable=False)
+
+
+class OutboxMessage(Base):
+    """
+    An outgoing Telegram message in the transactional outbox: It is written in the same database transaction as the
+    game state change, which triggered it, and delivered afterwards by the `outgoing.OutboxDispatcher`.
+    """
+    __tablename__ = 'outbox'
+    id = Column(Integer, primary_key=True)
+    # Unique key of the message, generated once per action call (i.e. stable across transaction retries). It is used
+    # to detect duplicate deliveries.
+    idempotency_key = Column(String(64), nullable=False, unique=True)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(UnicodeText, nullable=False)
+    created = Column(DateTime, nullable=False)
+    # Delivery state: The message is due for (another) delivery attempt after `next_attempt`, as long as it is neither
+    # sent nor failed. When claimed by a dispatcher, `next_attempt` is set to the end of the dispatcher's lease.
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, nullable=False)
+    claimed_by = Column(String(32))
+    sent = Column(DateTime)
+    failed = Column(DateTime)  # Set when giving up after the maximum number of attempts
+
+
+Index('idx_outbox_pending', OutboxMessage.sent, OutboxMessage.failed, OutboxMessage.next_attempt)
+
+
+class ProcessedUpdate(Base):
+    """
+    The id of a Telegram update, which has already been processed. Used by the bot frontend to skip duplicate deliveries
+    of the same update across restarts (if enabled).
+    """
+    __tablename__ = 'processed_updates'
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    processed = Column(DateTime, nullable=False, index=True)
+
+
+class GameResult(Base):
+    """
+    Materialized snapshot of the result of a finished game: all sheets and entries, including the authors' names, as
+    compressed JSON (see `game.encode_result_snapshot()`). It is written when the game is finalized, so the result can
+    be read from a single row instead of joining games, sheets, entries, users and participants.
+    """
+    __tablename__ = 'game_results'
+    game_id = Column(Integer, ForeignKey('games.id'), primary_key=True, autoincrement=False)
+    created = Column(DateTime, nullable=False)
+    data = Column(LargeBinary(2**32 - 1), nullable=False)  # LONGBLOB on MySQL
+
+
+class ArchivedSheet(Base):
+    """
+    A sheet, which has been removed from the sheets table together with the participants and entries of its game, when
+    the long finished game has been archived (see `GameServer.archive_games()`). The result of the game is kept in its
+    `GameResult` snapshot. This table allows to find it for the sheet's result URL and keeps the sheet's raw data.
+
+    The columns besides `game_id` are copies of the `Sheet`'s columns. They are NULL for sheets archived before they
+    were added.
+    """
+    __tablename__ = 'archived_sheets'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    game_id = Column(Integer, ForeignKey('games.id'), nullable=False)
+    hint = Column(Unicode(4096))
+    current_user_id = Column(Integer)
+    pending_position = Column(Integer)
+    num_entries = Column(Integer)
+    last_entry_id = Column(Integer)
+    last_entry_type = Column(Enum(EntryType))
+
+
+class ArchivedEntry(Base):
+    """
+    Copy of an `Entry` of an archived game (see `ArchivedSheet`), including its author and Telegram message, which are
+    not part of the game's `GameResult` snapshot.
+    """
+    __tablename__ = 'archived_entries'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    sheet_id = Column(Integer, ForeignKey('archived_sheets.id'), nullable=False, index=True)
+    position = Column(Integer, nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    text = Column(Unicode(4096), nullable=False)
+    type = Column(Enum(EntryType), nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+    chat_id = Column(BigInteger)
+    message_id = Column(Integer)
+
+
+class ArchivedParticipant(Base):
+    """ Copy of a `Participant` of an archived game (see `ArchivedSheet`) """
+    __tablename__ = 'archived_participants'
+    game_id = Column(Integer, ForeignKey('games.id'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    game_order = Column(Integer)
@@ -0,0 +1,533 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Rate-limited scheduling and durable delivery of outgoing messages for the Telegram bot frontend.
+
+The Telegram Bot API limits the number of messages a bot may send: About one message per second to each chat, 20
+messages per minute to each group and 30 messages per second in total. Exceeding these limits results in HTTP 429
+errors with a `retry_after` time. The `MessageScheduler` in this module enforces these limits with a token bucket for
+each chat plus a global token bucket, keeps the order of messages within each chat and serves the chats with pending
+messages in round-robin order, so a single busy chat (e.g. the group chat of a large game) cannot starve the others.
+
+The `OutboxDispatcher` delivers the messages from the transactional outbox table (see `model.OutboxMessage`), if it is
+enabled in the GameServer.
+"""
+
+import collections
+import datetime
+import heapq
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Any, Dict, Deque, Optional, Mapping, NamedTuple, List, Tuple
+
+from sqlalchemy import or_
+
+from . import model
+from .game import TranslatedMessage, GameServer
+from .util import LRUCache, session_scope, is_retryable_error, engine_isolation_level
+
+logger = logging.getLogger(__name__)
+
+#: Maximum length of a Telegram message text (in UTF-16 code units, after parsing the HTML entities)
+MAX_MESSAGE_LENGTH = 4096
+
+
+def _message_length(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+
+def coalesce_messages(messages: List[TranslatedMessage], max_length: int = MAX_MESSAGE_LENGTH,
+                      separator: str = "\n\n") -> List[TranslatedMessage]:
+    """
+    Merge adjacent messages to the same chat into a single message, as long as the merged message does not exceed
+    `max_length`.
+
+    Messages are only joined as a whole (never split), so the HTML markup of each message stays intact. The length is
+    measured on the HTML source, which is an upper bound for the length of the text, checked by Telegram.
+    """
+    result: List[TranslatedMessage] = []
+    for message in messages:
+        if result and result[-1].chat_id == message.chat_id:
+            merged = result[-1].text + separator + message.text
+            if _message_length(merged) <= max_length:
+                result[-1] = TranslatedMessage(message.chat_id, merged)
+                continue
+        result.append(message)
+    return result
+
+
+class TokenBucket:
+    """ A token bucket: Tokens are refilled continuously with `rate` tokens per second up to `capacity` tokens (the
+    maximum burst). Not thread-safe. """
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = now
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_update) * self.rate)
+        self.last_update = now
+
+    def available(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= 1
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self.tokens -= 1
+
+    def wait_time(self, now: float) -> float:
+        """ Get the time in seconds until the next token is available """
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+    def full_time(self, now: float) -> float:
+        """ Get the time in seconds until the bucket is full again """
+        self._refill(now)
+        return max(0.0, (self.capacity - self.tokens) / self.rate)
+
+
+class RateLimits(NamedTuple):
+    """ Rate limits (messages per second) and burst sizes for the `MessageScheduler`. The defaults follow the limits,
+    documented by Telegram. """
+    global_rate: float = 30.0
+    global_burst: float = 30.0
+    private_rate: float = 1.0
+    private_burst: float = 3.0
+    group_rate: float = 20 / 60
+    group_burst: float = 5.0
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> "RateLimits":
+        """ Create RateLimits from the `send_*` entries of the given config section, e.g. `send_private_rate`. """
+        return cls(**{field: config['send_' + field] for field in cls._fields if 'send_' + field in config})
+
+
+class _ChatState:
+    __slots__ = ('queue', 'bucket', 'blocked_until', 'in_flight', 'idle_until')
+
+    def __init__(self, bucket: TokenBucket):
+        self.queue: Deque[Any] = collections.deque()
+        self.bucket = bucket
+        self.blocked_until = 0.0
+        self.in_flight = False
+        # For idle chats: The time, after which the chat's bucket is full and no retry_after is pending anymore
+        self.idle_until: Optional[float] = None
+
+
+class MessageScheduler:
+    """
+    Scheduler for sending messages to chats with per-chat and global rate limits.
+
+    Messages are queued per chat with `submit()`. A scheduler thread picks the next message to be sent and hands it to a
+    pool of `workers` sender threads, which call `send_function(chat_id, message)`. To keep the order of messages
+    within a chat, only one message per chat is sent at a time. The chats with pending messages are served in
+    round-robin order.
+
+    If the send function raises an exception with a `retry_after` attribute (like `telegram.error.RetryAfter`), the
+    message is kept at the head of the chat's queue and the chat is paused for the given number of seconds. All other
+    exceptions are logged and the message is dropped.
+
+    Negative chat ids are considered group chats (and use the group rate limits), positive chat ids are private chats.
+
+    The state of idle chats (without pending messages) is forgotten as soon as their token bucket would have been
+    refilled, so the scheduler's memory usage does not grow with the number of chats ever written to.
+    """
+    def __init__(self, send_function: Callable[[int, Any], None], limits: RateLimits = RateLimits(),
+                 workers: int = 4, clock: Callable[[], float] = time.monotonic):
+        self.send_function = send_function
+        self.limits = limits
+        self.workers = workers
+        self.clock = clock
+        self._condition = threading.Condition()
+        self._chats: Dict[int, _ChatState] = {}
+        # Chats with pending messages (and not currently sending), in round-robin order
+        self._round_robin: Deque[int] = collections.deque()
+        # Heap of (idle_until, chat_id) of idle chats to be evicted from `_chats`. May contain outdated entries of
+        # chats, which have been active again in the meantime.
+        self._idle: List[Tuple[float, int]] = []
+        self._global_bucket = TokenBucket(limits.global_rate, limits.global_burst, clock())
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        #: Number of queued messages (including messages being sent)
+        self.pending = 0
+        #: Number of messages, which have been postponed due to a `retry_after` error
+        self.retries = 0
+
+    def start(self) -> None:
+        self._running = True
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="MessageScheduler-sender")
+        self._thread = threading.Thread(target=self._run, name="MessageScheduler")
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """ Stop the scheduler, after all pending messages have been sent or the timeout (in seconds) has passed """
+        deadline = None if timeout is None else self.clock() + timeout
+        with self._condition:
+            while self.pending and (deadline is None or self.clock() < deadline):
+                self._condition.wait(None if deadline is None else deadline - self.clock())
+            if self.pending:
+                logger.warning("Dropping %s pending outgoing messages on shutdown.", self.pending)
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def submit(self, chat_id: int, message: Any) -> None:
+        """ Queue a message to be sent to the given chat """
+        with self._condition:
+            self._evict_idle(self.clock())
+            state = self._chats.get(chat_id)
+            if state is None:
+                rate, burst = ((self.limits.group_rate, self.limits.group_burst) if chat_id < 0
+                               else (self.limits.private_rate, self.limits.private_burst))
+                state = _ChatState(TokenBucket(rate, burst, self.clock()))
+                self._chats[chat_id] = state
+            state.idle_until = None
+            if not state.queue and not state.in_flight:
+                self._round_robin.append(chat_id)
+            state.queue.append(message)
+            self.pending += 1
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        with self._condition:
+            while self._running:
+                now = self.clock()
+                self._evict_idle(now)
+                wait = self._global_bucket.wait_time(now)
+                if not wait:
+                    chat_id, wait = self._pick_chat(now)
+                    if chat_id is not None:
+                        state = self._chats[chat_id]
+                        message = state.queue.popleft()
+                        state.in_flight = True
+                        state.bucket.consume(now)
+                        self._global_bucket.consume(now)
+                        self._executor.submit(self._send, chat_id, message)
+                        continue
+                self._condition.wait(wait)
+
+    def _pick_chat(self, now: float):
+        """ Find the next chat in round-robin order, which may be sent a message now, and remove it from the
+        round-robin queue. Returns the chat id (or None) and the time to wait for the next chat to become ready. """
+        wait = None
+        for _i in range(len(self._round_robin)):
+            chat_id = self._round_robin.popleft()
+            state = self._chats[chat_id]
+            chat_wait = max(state.blocked_until - now, state.bucket.wait_time(now))
+            if chat_wait <= 0:
+                return chat_id, None
+            self._round_robin.append(chat_id)
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
+    def _evict_idle(self, now: float) -> None:
+        """ Forget about the chats, which have been idle long enough to have their token bucket refilled """
+        while self._idle and self._idle[0][0] <= now:
+            _idle_until, chat_id = heapq.heappop(self._idle)
+            state = self._chats.get(chat_id)
+            if state is not None and state.idle_until is not None and state.idle_until <= now:
+                del self._chats[chat_id]
+
+    def _send(self, chat_id: int, message: Any) -> None:
+        retry_after = None
+        try:
+            self.send_function(chat_id, message)
+        except Exception as e:
+            retry_after = getattr(e, 'retry_after', None)
+            if retry_after is None:
+                logger.error("Error while sending message to chat %s:", chat_id, exc_info=e)
+            else:
+                logger.warning("Sending message to chat %s has been rate-limited. Retrying after %ss.",
+                               chat_id, retry_after)
+        with self._condition:
+            state = self._chats[chat_id]
+            state.in_flight = False
+            if retry_after is not None:
+                state.queue.appendleft(message)
+                state.blocked_until = self.clock() + retry_after
+                self.retries += 1
+            else:
+                self.pending -= 1
+            if state.queue:
+                self._round_robin.append(chat_id)
+            else:
+                # Forget about the idle chat later, as soon as this does not allow it to exceed its rate limit
+                now = self.clock()
+                state.idle_until = max(state.blocked_until, now + state.bucket.full_time(now))
+                heapq.heappush(self._idle, (state.idle_until, chat_id))
+            self._condition.notify_all()
+
+
+class OutboxEntry(NamedTuple):
+    """ A message from the outbox, claimed by the `OutboxDispatcher` for delivery """
+    id: int
+    idempotency_key: str
+    chat_id: int
+    text: str
+
+
+class _Lease(NamedTuple):
+    claim_token: str
+    expires: datetime.datetime
+
+
+class OutboxDispatcher:
+    """
+    Background dispatcher for delivering the messages from the transactional outbox (`model.OutboxMessage`).
+
+    The dispatcher thread claims batches of due messages from the outbox table (in the order of their creation) and
+    hands them to the `deliver` function, e.g. for submitting them to the `MessageScheduler`. The outcome of each
+    delivery must be reported via `acknowledge()`. Acknowledgements are written back to the database in batches.
+    Failed messages are retried with exponential backoff, up to `outbox_max_attempts` attempts. Sent and failed messages
+    are deleted after `outbox_retention` seconds.
+
+    Claimed messages are leased for `outbox_lease` seconds: If they are not acknowledged in time (e.g. due to a crash of
+    the process), they are claimed again. Thus, delivery is at-least-once. As long as the dispatcher is running, the
+    leases of delivered, but not yet acknowledged messages (e.g. waiting in the `MessageScheduler`'s queue for a rate
+    limit) are renewed when half of the lease time has passed, so they are not claimed and sent by another dispatcher.
+    The idempotency keys of recently delivered messages are remembered to skip duplicate deliveries within the same
+    process. To limit the number of pending messages in the `deliver`ed queue, at most `outbox_batch_size` messages are
+    claimed but not acknowledged at any time.
+
+    Multiple dispatchers (e.g. in separate sender processes) may work on the same outbox table, since messages are
+    claimed with a conditional UPDATE. However, the order of messages to the same chat is only kept within each
+    dispatcher.
+
+    The dispatcher's parameters are taken from the `game` section of the GameServer's config (`outbox_*` entries).
+    """
+    def __init__(self, game_server: GameServer, deliver: Callable[[List[OutboxEntry]], None]):
+        config = game_server.config.get('game', {})
+        self.session_maker = game_server.session_maker
+        self.dialect = game_server.database_engine.dialect.name
+        self.isolation_level = engine_isolation_level(game_server.database_engine)
+        self.metrics = game_server.metrics
+        self.deliver = deliver
+        self.batch_size: int = config.get('outbox_batch_size', 100)
+        self.poll_interval: float = config.get('outbox_poll_interval', 1.0)
+        self.lease = datetime.timedelta(seconds=config.get('outbox_lease', 600))
+        self.max_attempts: int = config.get('outbox_max_attempts', 10)
+        self.retry_base_delay: float = config.get('outbox_retry_base_delay', 1.0)
+        self.retry_max_delay: float = config.get('outbox_retry_max_delay', 300.0)
+        self.retention = datetime.timedelta(seconds=config.get('outbox_retention', 86400))
+        self.cleanup_interval: float = config.get('outbox_cleanup_interval', 60.0)
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._in_flight: Dict[int, _Lease] = {}
+        self._sent: List[OutboxEntry] = []
+        self._failed: List[OutboxEntry] = []
+        self._delivered_keys = LRUCache(config.get('outbox_delivered_keys_cache_size', 10000))
+        self._last_cleanup = 0.0
+        # Get notified by the GameServer when new messages have been committed to the outbox
+        game_server.outbox_notify = self._wakeup.set
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="OutboxDispatcher")
+        self._thread.start()
+
+    def stop(self) -> None:
+        """ Stop the dispatcher thread and write back the pending acknowledgements """
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._flush_acknowledgements()
+
+    def release(self) -> None:
+        """ Write back the pending acknowledgements and release the claims of all messages, which have not been
+        acknowledged, so they can be claimed again immediately (e.g. by the next process after shutdown). """
+        self._flush_acknowledgements()
+        with self._lock:
+            ids = list(self._in_flight)
+            self._in_flight.clear()
+        if ids:
+            with session_scope(self.session_maker) as session:
+                session.query(model.OutboxMessage)\
+                    .filter(model.OutboxMessage.id.in_(ids), model.OutboxMessage.sent == None)\
+                    .update({model.OutboxMessage.next_attempt: datetime.datetime.now(datetime.timezone.utc),
+                             model.OutboxMessage.claimed_by: None}, synchronize_session=False)
+            logger.info("Released %s unsent messages in the outbox.", len(ids))
+
+    def acknowledge(self, entry: OutboxEntry, success: bool) -> None:
+        """ Report the outcome of the delivery of a message, which has been passed to the `deliver` function """
+        with self._lock:
+            self._in_flight.pop(entry.id, None)
+            (self._sent if success else self._failed).append(entry)
+        if success:
+            self._delivered_keys.put(entry.idempotency_key, True)
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                claimed = self.run_once()
+            except Exception as e:
+                if is_retryable_error(e, self.dialect, self.isolation_level):
+                    logger.info("Outbox dispatching conflicted with a concurrent transaction: %s",
+                                getattr(e, 'orig', e))
+                else:
+                    logger.error("Error while dispatching messages from the outbox:", exc_info=e)
+                claimed = 0
+            # Continue immediately, if the last batch was full, otherwise wait for new messages or acknowledgements
+            if claimed < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+
+    def run_once(self) -> int:
+        """ Do a single iteration of the dispatcher: Write back acknowledgements, renew the leases of delivered messages
+        (if due), clean up old messages (if due) and claim and deliver a batch of due messages.
+
+        :return: The number of claimed messages
+        """
+        self._flush_acknowledgements()
+        self._renew_leases()
+        if time.monotonic() - self._last_cleanup >= self.cleanup_interval:
+            self._cleanup()
+        with self._lock:
+            limit = self.batch_size - len(self._in_flight)
+        if limit <= 0:
+            return 0
+        lease, entries = self._claim(limit)
+        if not entries:
+            return 0
+        to_deliver = []
+        duplicates = []
+        for entry in entries:
+            if self._delivered_keys.get(entry.idempotency_key, False):
+                duplicates.append(entry)
+            else:
+                to_deliver.append(entry)
+        with self._lock:
+            self._in_flight.update((entry.id, lease) for entry in to_deliver)
+            self._sent.extend(duplicates)
+        if duplicates:
+            logger.warning("Skipping %s already delivered messages from the outbox.", len(duplicates))
+            self.metrics.counter('qaqa_outbox_duplicates_total',
+                                 "Number of outbox messages skipped as already delivered").inc(len(duplicates))
+        self.metrics.counter('qaqa_outbox_claimed_total', "Number of messages claimed from the outbox")\
+            .inc(len(entries))
+        if to_deliver:
+            self.deliver(to_deliver)
+        return len(entries)
+
+    def _claim(self, limit: int) -> Tuple[_Lease, List[OutboxEntry]]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        claim_token = uuid.uuid4().hex
+        lease = _Lease(claim_token, now + self.lease)
+        due = (model.OutboxMessage.sent == None, model.OutboxMessage.failed == None,
+               model.OutboxMessage.next_attempt <= now)
+        with session_scope(self.session_maker) as session:
+            ids = [id_ for (id_,) in session.query(model.OutboxMessage.id)
+                   .filter(*due)
+                   .order_by(model.OutboxMessage.id)
+                   .limit(limit)]
+            if not ids:
+                return lease, []
+            session.query(model.OutboxMessage)\
+                .filter(model.OutboxMessage.id.in_(ids), *due)\
+                .update({model.OutboxMessage.claimed_by: claim_token,
+                         model.OutboxMessage.next_attempt: lease.expires,
+                         model.OutboxMessage.attempts: model.OutboxMessage.attempts + 1},
+                        synchronize_session=False)
+            return lease, [OutboxEntry(*row) for row in session.query(model.OutboxMessage.id,
+                                                               model.OutboxMessage.idempotency_key,
+                                                               model.OutboxMessage.chat_id,
+                                                               model.OutboxMessage.text)
+                    .filter(model.OutboxMessage.id.in_(ids), model.OutboxMessage.claimed_by == claim_token)
+                    .order_by(model.OutboxMessage.id)]
+
+    def _renew_leases(self) -> None:
+        """ Extend the leases of all delivered, but not yet acknowledged messages, whose lease is half expired """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            due = {id_: lease for id_, lease in self._in_flight.items() if lease.expires - now <= self.lease / 2}
+        if not due:
+            return
+        ids_by_token: Dict[str, List[int]] = {}
+        for id_, lease in due.items():
+            ids_by_token.setdefault(lease.claim_token, []).append(id_)
+        renewed = 0
+        with session_scope(self.session_maker) as session:
+            for claim_token, ids in ids_by_token.items():
+                renewed += session.query(model.OutboxMessage)\
+                    .filter(model.OutboxMessage.id.in_(ids), model.OutboxMessage.claimed_by == claim_token,
+                            model.OutboxMessage.sent == None)\
+                    .update({model.OutboxMessage.next_attempt: now + self.lease}, synchronize_session=False)
+        with self._lock:
+            for id_, lease in due.items():
+                if id_ in self._in_flight:
+                    self._in_flight[id_] = _Lease(lease.claim_token, now + self.lease)
+        if renewed < len(due):
+            logger.warning("Lost the claim of %s delivered, but unacknowledged messages in the outbox.",
+                           len(due) - renewed)
+        self.metrics.counter('qaqa_outbox_lease_renewals_total',
+                             "Number of renewed leases of messages waiting for delivery").inc(renewed)
+
+    def _flush_acknowledgements(self) -> None:
+        with self._lock:
+            sent, self._sent = self._sent, []
+            failed, self._failed = self._failed, []
+        if not sent and not failed:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            with session_scope(self.session_maker) as session:
+                if sent:
+                    session.query(model.OutboxMessage)\
+                        .filter(model.OutboxMessage.id.in_([entry.id for entry in sent]))\
+                        .update({model.OutboxMessage.sent: now}, synchronize_session=False)
+                if failed:
+                    for message in session.query(model.OutboxMessage)\
+                            .filter(model.OutboxMessage.id.in_([entry.id for entry in failed])):
+                        if message.attempts >= self.max_attempts:
+                            logger.error("Giving up delivery of message %s to chat %s after %s attempts.",
+                                         message.id, message.chat_id, message.attempts)
+                            message.failed = now
+                        else:
+                            message.next_attempt = now + datetime.timedelta(seconds=min(
+                                self.retry_base_delay * 2 ** (message.attempts - 1), self.retry_max_delay))
+        except Exception:
+            # Keep the acknowledgements for the next try
+            with self._lock:
+                self._sent[0:0] = sent
+                self._failed[0:0] = failed
+            raise
+        self.metrics.counter('qaqa_outbox_sent_total', "Number of delivered messages from the outbox").inc(len(sent))
+        self.metrics.counter('qaqa_outbox_failed_total', "Number of failed delivery attempts of outbox messages")\
+            .inc(len(failed))
+
+    def _cleanup(self) -> None:
+        """ Delete sent and failed messages, which are older than the retention time """
+        threshold = datetime.datetime.now(datetime.timezone.utc) - self.retention
+        with session_scope(self.session_maker) as session:
+            deleted = session.query(model.OutboxMessage)\
+                .filter(or_(model.OutboxMessage.sent < threshold, model.OutboxMessage.failed < threshold))\
+                .delete(synchronize_session=False)
+        self._last_cleanup = time.monotonic()
+        if deleted:
+            logger.debug("Deleted %s old messages from the outbox.", deleted)
@@ -13,15 +13,24 @@ import base64
 import binascii
 import gettext
 import hashlib
+import logging
 import os.path
+import random
+import threading
+from collections import OrderedDict, deque
 from contextlib import contextmanager
-from typing import Dict, Any, Iterable, List, Union, Optional
+from typing import Dict, Any, Iterable, List, Union, Optional, Hashable, Mapping, Tuple, Callable, NamedTuple, Deque, \
+    FrozenSet
 
 import alembic
 import alembic.config
 import alembic.script
+import sqlalchemy.exc
+import sqlalchemy.orm.exc
 import sqlalchemy.orm
 
+logger = logging.getLogger(__name__)
+
 
 @contextmanager
 def session_scope(Session: sqlalchemy.orm.sessionmaker):
@@ -71,6 +80,82 @@ def run_migrations(engine: sqlalchemy.engine.Engine):
             context.run_migrations()
 
 
+def _is_retryable_mysql_error(error: sqlalchemy.exc.DBAPIError) -> bool:
+    # 1213: "Deadlock found when trying to get lock" (error code is the first argument in MySQLdb and PyMySQL)
+    args = getattr(error.orig, 'args', ())
+    return bool(args) and args[0] == 1213
+
+
+def _is_retryable_postgresql_error(error: sqlalchemy.exc.DBAPIError) -> bool:
+    # 40001: serialization_failure, 40P01: deadlock_detected (`pgcode` in psycopg2, `sqlstate` in psycopg 3)
+    sqlstate = getattr(error.orig, 'pgcode', None) or getattr(error.orig, 'sqlstate', None)
+    return sqlstate in ('40001', '40P01')
+
+
+def _is_retryable_sqlite_error(error: sqlalchemy.exc.DBAPIError) -> bool:
+    return isinstance(error, sqlalchemy.exc.OperationalError) and "database is locked" in str(error.orig)
+
+
+#: Functions to detect database errors, which are caused by concurrent transactions and should be handled by retrying
+#: the transaction, by SQLAlchemy dialect name. Add an entry to support further database backends.
+RETRYABLE_ERROR_CLASSIFIERS: Dict[str, Callable[[sqlalchemy.exc.DBAPIError], bool]] = {
+    'mysql': _is_retryable_mysql_error,
+    'postgresql': _is_retryable_postgresql_error,
+    'sqlite': _is_retryable_sqlite_error,
+}
+
+
+def engine_isolation_level(engine: sqlalchemy.engine.Engine) -> Optional[str]:
+    """ Get the transaction isolation level configured for the given database engine (via `create_engine()`'s
+    `isolation_level` or `execution_options`) or None, if the database's default is used. """
+    return engine.get_execution_options().get('isolation_level') or getattr(engine.dialect, 'isolation_level', None)
+
+
+def is_retryable_error(error: Exception, dialect_name: str, isolation_level: Optional[str] = None) -> bool:
+    """
+    Check if the given exception is a database error, caused by a concurrent transaction (deadlock, serialization
+    failure, etc.), such that the failed transaction should be retried.
+
+    An ORM `StaleDataError` (an UPDATE or DELETE did not match the expected row, since it has been changed by a
+    concurrent transaction) is only considered retryable, if the database cannot report the conflict itself: with
+    SQLite (pysqlite does not BEGIN the transaction before the first SELECT) or isolation levels weaker than
+    SERIALIZABLE. Otherwise, it indicates a bug, which should not be hidden by silent retries.
+
+    :param error: The exception raised by SQLAlchemy
+    :param dialect_name: The name of the database engine's SQLAlchemy dialect (e.g. 'mysql'), see
+        `RETRYABLE_ERROR_CLASSIFIERS`
+    :param isolation_level: The engine's transaction isolation level (see `engine_isolation_level()`) or None for
+        the database's default
+    """
+    if isinstance(error, sqlalchemy.orm.exc.StaleDataError):
+        return dialect_name == 'sqlite' or (isolation_level or '').upper() != 'SERIALIZABLE'
+    classifier = RETRYABLE_ERROR_CLASSIFIERS.get(dialect_name)
+    return isinstance(error, sqlalchemy.exc.DBAPIError) and classifier is not None and classifier(error)
+
+
+class RetryPolicy(NamedTuple):
+    """
+    Parameters for retrying failed database transactions with exponential backoff and (full) jitter.
+
+    A transaction is retried until it succeeds, `max_attempts` attempts have been made, or the next retry would exceed
+    the overall `time_budget` (in seconds). Before the n-th retry, we wait for a random time between 0 and
+    `min(max_delay, base_delay * 2**(n-1))` seconds.
+    """
+    max_attempts: int = 30
+    base_delay: float = 0.01
+    max_delay: float = 1.0
+    time_budget: float = 10.0
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> "RetryPolicy":
+        """ Create a RetryPolicy from the `retry_*` entries of the given config section, e.g. `retry_max_attempts`. """
+        return cls(**{field: config['retry_' + field] for field in cls._fields if 'retry_' + field in config})
+
+    def delay(self, retry: int) -> float:
+        """ Get a (random) delay in seconds before the given retry (counted from 1) """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry - 1)))
+
+
 def encode_secure_id(value: int, secret: str, realm: bytes = b"") -> str:
     """
     Secure a (postive 32-bit) integer id from manipulation/bruteforce testing, by hashing it together with a
@@ -118,6 +203,335 @@ def decode_secure_id(secure_id: str, secret: str, realm: bytes = b"") -> Optiona
     return int.from_bytes(value_bytes, 'big')
 
 
+class LRUCache:
+    """
+    A simple thread-safe, size-bounded mapping, which evicts the least recently used entries when full.
+
+    `get()` and `get_many()` count cache hits and misses in the `hits` and `misses` attributes. Any value, including
+    None, may be cached, so callers can cache negative results ("there is no such thing") as well.
+
+    To avoid caching stale values, which have been read from the database concurrently to a modification, callers
+    should take a token via `fill_token()` *before* reading the values from the database and pass it to `fill()`
+    afterwards. The values are discarded by `fill()`, if any entry has been changed via `put()` or `invalidate()` in the
+    meantime.
+
+    :param maxsize: The maximum number of cached entries. 0 disables caching.
+    """
+    MISSING = object()
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        """ Get the cached value for `key` or `default` (`LRUCache.MISSING` by default), if it is not cached. """
+        with self._lock:
+            return self._get(key, default)
+
+    def get_many(self, keys: Iterable[Hashable]) -> Tuple[Dict[Hashable, Any], List[Hashable]]:
+        """
+        Look up multiple keys at once.
+
+        :return: A dict of the cached values and a list of the keys, which are not cached
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                value = self._get(key, self.MISSING)
+                if value is self.MISSING:
+                    missing.append(key)
+                else:
+                    found[key] = value
+        return found, missing
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """ Store (or update) a value in the cache (write-through). """
+        with self._lock:
+            self._generation += 1
+            self._store(key, value)
+
+    def invalidate(self, key: Hashable) -> None:
+        """ Remove the entry for `key` from the cache, if present. """
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+
+    def fill_token(self) -> int:
+        """ Get a token to be passed to `fill()`, for adding values, which are about to be read from the source. """
+        return self._generation
+
+    def fill(self, values: Mapping[Hashable, Any], token: int) -> None:
+        """
+        Add values, which have been read from the source after taking `token` with `fill_token()`, to the cache.
+
+        If the cache has been modified via `put()`, `invalidate()` or `clear()` since `token` was taken, the values are
+        discarded, as they might be outdated.
+        """
+        with self._lock:
+            if token != self._generation:
+                return
+            for key, value in values.items():
+                self._store(key, value)
+
+    def _get(self, key: Hashable, default: Any) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+class KeyedLock:
+    """
+    A registry of mutexes, identified by arbitrary (hashable) keys, e.g. to serialize all actions on the same object.
+
+    Locks are created on demand and removed when they are no longer held or waited for, so the registry does not grow
+    with the number of keys ever used.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks: Dict[Hashable, Tuple[threading.Lock, int]] = {}
+
+    @contextmanager
+    def hold(self, key: Hashable):
+        """ Context manager to acquire the lock for `key` and release it when leaving the context. """
+        with self._lock:
+            lock, users = self._locks.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._locks[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, users = self._locks[key]
+                if users > 1:
+                    self._locks[key] = (lock, users - 1)
+                else:
+                    del self._locks[key]
+
+
+class PartitionedExecutor:
+    """
+    A thread pool, which executes the tasks of each partition sequentially in the order of submission, while tasks of
+    different partitions are executed in parallel.
+
+    Tasks are submitted with a (hashable) partition key, e.g. the chat id of a Telegram update. Each partition has its
+    own FIFO queue. Partitions with pending tasks are served by the `workers` threads in round-robin order, but each
+    partition is only processed by one thread at a time. Thus, a busy partition cannot block other partitions and
+    partition queues are removed as soon as they are empty.
+
+    The total number of pending tasks is limited to `max_pending`: `submit()` blocks, while this limit is reached, to
+    apply backpressure to the submitting thread.
+
+    Exceptions raised by tasks are passed to the `error_callback` (or logged, if not given).
+    """
+    def __init__(self, workers: int, max_pending: int, name: str = "PartitionedExecutor",
+                 error_callback: Optional[Callable[[Exception], None]] = None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.name = name
+        self.error_callback = error_callback
+        self._condition = threading.Condition()
+        self._partitions: Dict[Hashable, Deque[Tuple[Callable, tuple]]] = {}
+        self._ready: Deque[Hashable] = deque()
+        self._threads: List[threading.Thread] = []
+        self._shutdown = False
+        #: Number of pending tasks (queued or running)
+        self.pending = 0
+        #: Number of calls to `submit()`, which had to wait for free space in the queue
+        self.blocked_submissions = 0
+
+    def start(self) -> None:
+        """ Start the worker threads (if not already started) """
+        with self._condition:
+            if self._threads:
+                return
+            self._shutdown = False
+            self._threads = [threading.Thread(target=self._work, name="{}-{}".format(self.name, i), daemon=True)
+                             for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """ Stop the worker threads after all pending tasks have been executed """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+            threads, self._threads = self._threads, []
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def submit(self, key: Hashable, function: Callable, *args) -> None:
+        """ Queue a call of `function(*args)` in the given partition. Blocks while `max_pending` tasks are pending. """
+        with self._condition:
+            if self.pending >= self.max_pending:
+                self.blocked_submissions += 1
+                while self.pending >= self.max_pending:
+                    self._condition.wait()
+            queue = self._partitions.get(key)
+            if queue is None:
+                queue = self._partitions[key] = deque()
+                self._ready.append(key)
+            queue.append((function, args))
+            self.pending += 1
+            self._condition.notify_all()
+
+    def _work(self) -> None:
+        while True:
+            with self._condition:
+                while not self._ready and not (self._shutdown and not self.pending):
+                    self._condition.wait()
+                if not self._ready:
+                    return
+                # The partition is not in `_ready` while its task is running, so no other worker takes it
+                key = self._ready.popleft()
+                function, args = self._partitions[key][0]
+            try:
+                function(*args)
+            except Exception as e:
+                if self.error_callback is not None:
+                    self.error_callback(e)
+                else:
+                    logger.error("Error in task of %s:", self.name, exc_info=e)
+            with self._condition:
+                queue = self._partitions[key]
+                queue.popleft()
+                if queue:
+                    self._ready.append(key)
+                else:
+                    del self._partitions[key]
+                self.pending -= 1
+                self._condition.notify_all()
+
+
+class TranslationRegistry:
+    """
+    A thread-safe, process-wide cache of the gettext message catalogs of one gettext domain.
+
+    `gettext.translation()` searches the filesystem for the catalog files on every call, so we use this registry to load
+    each locale's catalog only once and share it between all users (the GameServer and the web frontend). Catalogs are
+    looked up with gettext's usual fallback rules (e.g. 'de_DE' falls back to 'de'). If no catalog is found for a
+    locale, a shared `NullTranslations` object is returned, i.e. the original (English) strings are used. It is only
+    cached for the locales returned by `match()` (i.e. the default locale 'en'), so looking up arbitrary (e.g.
+    user-supplied) locale strings does not grow the cache. Thus, locale strings should be mapped with `match()` first,
+    to avoid searching the filesystem on every lookup.
+
+    To deploy updated translations without restarting the process, call `reload()`. It drops all cached catalogs, such
+    that they are read from disk again upon next use.
+    """
+    def __init__(self, domain: str, localedir: str):
+        self.domain = domain
+        self.localedir = localedir
+        self._catalogs: Dict[str, gettext.NullTranslations] = {}
+        self._available: Optional[FrozenSet[str]] = None
+        self._null_translations = gettext.NullTranslations()
+        self._lock = threading.Lock()
+
+    def get(self, locale: str) -> gettext.NullTranslations:
+        """
+        Get the translations for the given locale, loading them from disk, if they are not cached yet.
+
+        :param locale: A language string like 'de', 'en' or 'de_DE'
+        """
+        # Fast path without locking: dict lookups are atomic
+        translations = self._catalogs.get(locale)
+        if translations is not None:
+            return translations
+        with self._lock:
+            translations = self._catalogs.get(locale)
+            if translations is None:
+                translations = self._load(locale)
+                if translations is None:
+                    translations = self._null_translations
+                    if self.match(locale) != locale:
+                        return translations
+                self._catalogs[locale] = translations
+            return translations
+
+    def available_locales(self) -> FrozenSet[str]:
+        """ Get the locales (e.g. 'de'), for which a compiled message catalog of the domain exists """
+        available = self._available
+        if available is None:
+            available = frozenset(
+                locale for locale in (os.listdir(self.localedir) if os.path.isdir(self.localedir) else ())
+                if os.path.isfile(os.path.join(self.localedir, locale, 'LC_MESSAGES', self.domain + '.mo')))
+            self._available = available
+        return available
+
+    def match(self, locale: str, default: str = 'en') -> str:
+        """
+        Map a (possibly user-supplied) language string to one of the `available_locales()`.
+
+        :param locale: A language string like 'de' or 'de_DE'
+        :param default: The locale to return, if neither the locale nor its language has a catalog
+        """
+        available = self.available_locales()
+        if locale in available:
+            return locale
+        language = locale.split('_')[0]
+        return language if language in available else default
+
+    def version(self) -> str:
+        """ Get a hash of all compiled message catalog files of the domain (e.g. to detect updated translations) """
+        version_hash = hashlib.sha256()
+        for dir_path, _dir_names, file_names in sorted(os.walk(self.localedir)):
+            if self.domain + '.mo' in file_names:
+                file_name = os.path.join(dir_path, self.domain + '.mo')
+                with open(file_name, 'rb') as f:
+                    version_hash.update(os.path.relpath(file_name, self.localedir).encode('utf-8') + b'\0'
+                                        + hashlib.sha256(f.read()).digest())
+        return version_hash.hexdigest()[:12]
+
+    def reload(self) -> None:
+        """ Drop all cached catalogs to have them reloaded from disk upon next use. """
+        with self._lock:
+            logger.info("Reloading %s message catalogs (%s locales cached).", self.domain, len(self._catalogs))
+            self._catalogs = {}
+            self._available = None
+
+    def _load(self, locale: str) -> Optional[gettext.NullTranslations]:
+        # We don't use `gettext.translation()` here, since it keeps its own module-level cache of parsed catalog files,
+        # which would defeat `reload()`.
+        translations: Optional[gettext.NullTranslations] = None
+        for mo_file in gettext.find(self.domain, self.localedir, (locale,), all=True):
+            with open(mo_file, 'rb') as fp:
+                catalog = gettext.GNUTranslations(fp)
+            if translations is None:
+                translations = catalog
+            else:
+                translations.add_fallback(catalog)
+        logger.debug("Loaded %s message catalog for locale %s%s.", self.domain, locale,
+                     "" if translations is not None else " (not found, using untranslated strings)")
+        return translations
+
+
 class LazyGetTextBase(metaclass=abc.ABCMeta):
     """
     Abstract base class for the lazy GNU gettext implementation.
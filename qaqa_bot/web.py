@@ -18,6 +18,13 @@ object of the class `WebRoot`, which can be registered with the CherryPy engine:
 * /
 * /game/<game_id>/
 * /game/<game_id>/sheet/<sheet_id>/
+* /static/<version>/<file> (static files with far-future caching, see `StaticFiles`)
+* /api/game/<game_id> and /api/sheet/<sheet_id> (JSON API, see `Api`)
+* /metrics (Prometheus metrics, only if enabled via `web.metrics_token` or `web.metrics_socket_port`)
+
+The result pages of finished games never change, so they are rendered only once and kept in a `ResultPageCache`. They
+are served with a strong ETag, Last-Modified and `Cache-Control: immutable` headers. Conditional GET requests for cached
+pages are answered with 304 Not Modified without accessing the database.
 
 Since I don't like global (or magic thread-local) data, all global (i.e. application-local) data for the frontend
 methods (esp. the GameServer object as a backend, the config and the template rendering engine) are encapsulated in an
@@ -26,19 +33,38 @@ methods (esp. the GameServer object as a backend, the config and the template re
 To simplify setup of the cherrypy engine (including the WebRoot Controller, HTTP server config, no autoreload and custom
 error page), the `setup_cherrypy_engine()` function is provided.
 """
+import calendar
 import datetime
 import functools
 import gettext
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import mimetypes
 import os
-from typing import Dict, Any, Optional
+import tempfile
+import threading
+import time
+from typing import Dict, Any, Optional, NamedTuple, Tuple, List, Iterator, Callable, BinaryIO
 
 import babel.dates
+import cheroot.wsgi
 import cherrypy
+import cherrypy.lib.static
+import cherrypy.process.servers
 import mako.lookup
+import mako.template
 import markupsafe
 
-from .game import GameServer, LOCALE_DIR
-from .util import decode_secure_id, encode_secure_id
+from .game import GameServer, TRANSLATIONS, ResultGame, ResultEntry
+from .metrics import format_prometheus
+from .util import decode_secure_id, encode_secure_id, LRUCache
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIRECTORY = os.path.join(os.path.dirname(__file__), 'templates')
 
 
 def setup_cherrypy_engine(env: "WebEnvironment", config: Dict[str, Any]) -> None:
@@ -51,6 +77,10 @@ def setup_cherrypy_engine(env: "WebEnvironment", config: Dict[str, Any]) -> None
     * Mounts an instance of the `WebRoot` Controller class with the given WebEnvironment to  `/`, with static files
       served from `web_static/`.
     * Register a `before_finalize` CherryPy tool to add a Content-Security-Policy header.
+    * Compiles all templates in advance (see `WebEnvironment.warm_up()`).
+    * If `web.metrics_socket_port` is configured, start an additional HTTP server on that port (and
+      `web.metrics_socket_host`, defaulting to localhost), which only serves the /metrics endpoint (without token) from
+      a separate `MetricsRoot` application.
     """
     cherrypy.config.update({'engine.autoreload.on': False,
                             'checker.on': False,
@@ -69,12 +99,304 @@ def setup_cherrypy_engine(env: "WebEnvironment", config: Dict[str, Any]) -> None
                                                                    'favicon.ico')},
     })
 
+    if 'metrics_socket_port' in config['web']:
+        bind_addr = (config['web'].get('metrics_socket_host', '127.0.0.1'), config['web']['metrics_socket_port'])
+        metrics_app = cherrypy.Application(MetricsRoot(env), '', {'/': {'tools.secure_headers.on': True}})
+        metrics_server = cherrypy.process.servers.ServerAdapter(
+            cherrypy.engine, cheroot.wsgi.Server(bind_addr, metrics_app), bind_addr)
+        metrics_server.subscribe()
+
+    start = time.monotonic()
+    num_templates = env.warm_up()
+    logger.info("Compiled %s templates in %.3fs.", num_templates, time.monotonic() - start)
+
     @cherrypy.tools.register('before_finalize', priority=60)
     def secure_headers():
         headers = cherrypy.response.headers
         headers['Content-Security-Policy'] = "default-src 'self';"
 
 
+class CachedPage(NamedTuple):
+    body: bytes
+    etag: str
+    last_modified: datetime.datetime
+
+
+class ResultPageCache:
+    """
+    A cache of rendered result pages of finished games, which never change.
+
+    The pages are identified by a key like `('game', game_id, lang, authors)` and kept in memory in a size-bounded
+    `LRUCache`. If a `directory` is given, they are additionally stored on disk (one file per page, with the file's
+    mtime set to the page's last modification time), so they survive restarts and evictions from the in-memory cache.
+    At most `max_files` pages are kept on disk: When exceeded, the least recently written files are removed.
+
+    All pages are stored for the current render `version` (see `WebEnvironment.render_version`), which is part of the
+    cache keys, the file names and the ETags. Thus, after changing the templates, translations or static files, pages
+    rendered before are neither served nor validated by conditional requests anymore. Pages of other versions are
+    removed from the disk when the version is set.
+
+    :param maxsize: Maximum number of pages in memory. 0 disables the in-memory cache.
+    :param directory: Optional directory for storing the rendered pages on disk
+    :param max_files: Maximum number of pages on disk
+    :param version: The initial render version
+    """
+    def __init__(self, maxsize: int, directory: Optional[str] = None, max_files: int = 10000, version: str = ''):
+        self._pages = LRUCache(maxsize)
+        self.directory = directory
+        self.max_files = max_files
+        self.version = version
+        self._lock = threading.Lock()
+        self._num_files = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.set_version(version)
+
+    @property
+    def hits(self) -> int:
+        return self._pages.hits
+
+    @property
+    def misses(self) -> int:
+        return self._pages.misses
+
+    def set_version(self, version: str) -> None:
+        """ Switch to a new render version: Drop the pages in memory and remove the pages of other versions from
+        disk """
+        with self._lock:
+            if version != self.version:
+                self._pages.clear()
+            self.version = version
+            if self.directory is None:
+                return
+            self._num_files = 0
+            for file_name in os.listdir(self.directory):
+                if not file_name.endswith('.html'):
+                    continue
+                if file_name.startswith(version + '-'):
+                    self._num_files += 1
+                else:
+                    self._remove_file(file_name)
+
+    def etag(self, key: Tuple) -> str:
+        """ Get the ETag of the page with the given key in the current version. It is known before rendering the page,
+        since the results of finished games never change. """
+        return '"{}"'.format(hashlib.sha256(repr((self.version, key)).encode('utf-8')).hexdigest()[:32])
+
+    def get(self, key: Tuple) -> Optional[CachedPage]:
+        """ Get the cached page for `key` from memory or disk or None, if it has not been rendered yet. """
+        version = self.version
+        page = self._pages.get((version,) + key, None)
+        if page is not None or self.directory is None:
+            return page
+        file_name = self._file_name(version, key)
+        try:
+            with open(file_name, 'rb') as f:
+                body = f.read()
+            mtime = os.stat(file_name).st_mtime
+        except FileNotFoundError:
+            return None
+        page = CachedPage(body, self.etag(key), datetime.datetime.utcfromtimestamp(mtime))
+        self._pages.put((version,) + key, page)
+        return page
+
+    def put(self, key: Tuple, content: str, last_modified: datetime.datetime) -> CachedPage:
+        """ Store a rendered page in the cache and return it as a `CachedPage` object.
+
+        :param last_modified: The (naive UTC) time of the last modification of the page's content, i.e. the end of the
+            game """
+        page = CachedPage(content.encode('utf-8'), self.etag(key), last_modified.replace(microsecond=0))
+        self._pages.put((self.version,) + key, page)
+        page_file = self.open_file(key, last_modified)
+        if page_file is not None:
+            page_file.write(page.body)
+            page_file.commit()
+        return page
+
+    def open_file(self, key: Tuple, last_modified: datetime.datetime) -> Optional["PageFile"]:
+        """ Start storing a page on disk part by part (e.g. while streaming it to the client), without keeping it in
+        memory. The page is only stored on disk, not in memory.
+
+        :return: A `PageFile` to write the page to or None, if there is no cache `directory` or the file could not be
+            created """
+        if self.directory is None:
+            return None
+        try:
+            fd, temp_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        except OSError as e:
+            logger.warning("Could not store rendered page on disk: %s", e)
+            return None
+        return PageFile(self, self._file_name(self.version, key), temp_name, os.fdopen(fd, 'wb'),
+                        calendar.timegm(last_modified.replace(microsecond=0).utctimetuple()))
+
+    def _add_file(self, temp_name: str, file_name: str) -> None:
+        with self._lock:
+            if not os.path.exists(file_name):
+                self._num_files += 1
+            os.replace(temp_name, file_name)
+            if self._num_files > self.max_files:
+                self._evict_files()
+
+    def clear(self) -> None:
+        """ Remove all pages from the cache, e.g. after updating the translations or templates. """
+        with self._lock:
+            self._pages.clear()
+            if self.directory is not None:
+                for file_name in os.listdir(self.directory):
+                    if file_name.endswith('.html'):
+                        self._remove_file(file_name)
+                self._num_files = 0
+
+    def _evict_files(self) -> None:
+        """ Remove the least recently written pages from disk, to get 10% below `max_files`. Requires the `_lock`. """
+        files = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.html'):
+                try:
+                    # The mtime is set to the page's last modification, but the ctime is updated by writing the file
+                    files.append((os.stat(os.path.join(self.directory, file_name)).st_ctime_ns, file_name))
+                except FileNotFoundError:
+                    pass
+        files.sort()
+        num_remove = max(len(files) - self.max_files * 9 // 10, 0)
+        for _ctime, file_name in files[:num_remove]:
+            self._remove_file(file_name)
+        self._num_files = len(files) - num_remove
+
+    def _remove_file(self, file_name: str) -> None:
+        try:
+            os.remove(os.path.join(self.directory, file_name))
+        except FileNotFoundError:
+            pass
+
+    def _file_name(self, version: str, key: Tuple) -> str:
+        return os.path.join(self.directory,
+                            "{}-{}.html".format(version, hashlib.sha256(repr(key).encode('utf-8')).hexdigest()))
+
+
+class PageFile:
+    """ A page, which is being written to the disk cache of a `ResultPageCache` (see `ResultPageCache.open_file()`).
+
+    The page is written to a temporary file, which is renamed on `commit()`, so concurrent readers never see incomplete
+    pages. Write errors are logged and discard the page. """
+    def __init__(self, cache: ResultPageCache, file_name: str, temp_name: str, file: BinaryIO, timestamp: int):
+        self._cache = cache
+        self._file_name = file_name
+        self._temp_name = temp_name
+        self._file: Optional[BinaryIO] = file
+        self._timestamp = timestamp
+
+    def write(self, data: bytes) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.write(data)
+        except OSError as e:
+            logger.warning("Could not store rendered page on disk: %s", e)
+            self.abort()
+
+    def commit(self) -> None:
+        """ Finish the page and add it to the cache """
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+            self._file = None
+            os.utime(self._temp_name, (self._timestamp, self._timestamp))
+            self._cache._add_file(self._temp_name, self._file_name)
+        except OSError as e:
+            logger.warning("Could not store rendered page on disk: %s", e)
+            self.abort()
+
+    def abort(self) -> None:
+        """ Discard the page, e.g. if streaming it has been aborted """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        try:
+            os.remove(self._temp_name)
+        except FileNotFoundError:
+            pass
+
+
+def serve_cached_page(page: CachedPage) -> bytes:
+    """ Set the caching headers for an immutable, cached page in the current CherryPy response and return its body.
+
+    Raises a 304 Not Modified redirect, if the request's `If-None-Match` or `If-Modified-Since` header matches. """
+    headers = cherrypy.response.headers
+    headers['ETag'] = page.etag
+    headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(calendar.timegm(page.last_modified.utctimetuple()))
+    headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    cherrypy.lib.cptools.validate_etags()
+    cherrypy.lib.cptools.validate_since()
+    return page.body
+
+
+class StaticFiles:
+    """
+    The static files of the web frontend (from `web_static/`), fingerprinted by their content at startup.
+
+    All files share a single `version`, a hash of all file names and contents, which is part of their URLs:
+    `/static/<version>/<file>`. Thus, relative URLs between the static files (like the fonts in the style sheet) keep
+    working and the files can be cached by browsers forever (`Cache-Control: immutable`): Any change of any file results
+    in new URLs.
+
+    Compressible files are additionally gzip-compressed in memory at startup. Brotli-compressed variants are served if
+    present as `<file>.br` next to the original file (e.g. created with the `brotli` tool at deploy time).
+    """
+    COMPRESSIBLE_TYPES = ('.css', '.js', '.svg', '.ttf', '.eot', '.txt')
+
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        self._gzipped: Dict[str, bytes] = {}
+        version_hash = hashlib.sha256()
+        for file_name in self._list_files():
+            with open(os.path.join(self.directory, file_name), 'rb') as f:
+                content = f.read()
+            version_hash.update(file_name.encode('utf-8') + b'\0' + hashlib.sha256(content).digest())
+            if file_name.endswith(self.COMPRESSIBLE_TYPES):
+                self._gzipped[file_name] = gzip.compress(content, mtime=0)
+        self.version = version_hash.hexdigest()[:12]
+
+    def _list_files(self) -> List[str]:
+        result = []
+        for dir_path, _dir_names, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if not file_name.endswith(('.gz', '.br')):
+                    result.append(os.path.relpath(os.path.join(dir_path, file_name), self.directory)
+                                  .replace(os.sep, '/'))
+        return sorted(result)
+
+    def url_path(self, file_name: str) -> str:
+        """ Get the versioned URL path (without base_url) of a static file, e.g. `/static/0123456789ab/style.css` """
+        return "/static/{}/{}".format(self.version, file_name)
+
+    def serve(self, version: str, file_name: str) -> Any:
+        """ Serve the given static file as response to the current CherryPy request.
+
+        If the `version` is outdated (e.g. requested from a cached page), the current file is served without long-term
+        caching. """
+        path = os.path.normpath(os.path.join(self.directory, file_name))
+        if not path.startswith(self.directory + os.sep) or not os.path.isfile(path):
+            raise cherrypy.NotFound()
+        headers = cherrypy.response.headers
+        if version == self.version:
+            headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            headers['Cache-Control'] = 'no-cache'
+        headers['Vary'] = 'Accept-Encoding'
+        accepted_encodings = [e.value for e in cherrypy.request.headers.elements('Accept-Encoding')]
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if 'br' in accepted_encodings and os.path.isfile(path + '.br'):
+            headers['Content-Encoding'] = 'br'
+            return cherrypy.lib.static.serve_file(path + '.br', content_type)
+        if 'gzip' in accepted_encodings and file_name in self._gzipped:
+            headers['Content-Type'] = content_type
+            headers['Content-Encoding'] = 'gzip'
+            return self._gzipped[file_name]
+        return cherrypy.lib.static.serve_file(path, content_type)
+
+
 class WebEnvironment:
     """ Shared env for all CherryPy controller objects
 
@@ -85,27 +407,81 @@ class WebEnvironment:
     def __init__(self, config: Dict[str, Any], game_server: GameServer):
         self.game_server = game_server
         self.config = config
+        self.static_files = StaticFiles(os.path.join(os.path.dirname(__file__), 'web_static'))
         self.template_lookup = mako.lookup.TemplateLookup(
-            directories=[os.path.join(os.path.dirname(__file__), 'templates')],
+            directories=[TEMPLATE_DIRECTORY],
+            module_directory=config['web'].get('template_cache_dir'),
             default_filters=['h'],
             input_encoding='utf-8')
         self.template_globals = {
             'bot_username': config['bot']['username'],
             'base_url': config['web']['base_url'],
-            'static_url': lambda file_name: "{}/static/{}".format(config['web']['base_url'], file_name),  # TODO add version to control caching
+            'static_url': lambda file_name: config['web']['base_url'] + self.static_files.url_path(file_name),
             'encode_id': lambda realm, val: encode_secure_id(val, config['secret'], realm),
             'format_date': babel.dates.format_date,
             'format_datetime': functools.partial(babel.dates.format_datetime, tzinfo=datetime.timezone.utc),
         }
+        self.render_version = self._compute_render_version()
+        self.result_cache = ResultPageCache(config['web'].get('result_cache_size', 1000),
+                                            config['web'].get('result_cache_dir'),
+                                            config['web'].get('result_cache_max_files', 10000),
+                                            self.render_version)
+        metrics = game_server.metrics
+        metrics.counter('qaqa_web_result_cache_hits_total', "Number of result pages served from the cache",
+                        lambda: self.result_cache.hits)
+        metrics.counter('qaqa_web_result_cache_misses_total', "Number of result pages not found in the cache",
+                        lambda: self.result_cache.misses)
+
+    def _compute_render_version(self) -> str:
+        """ Hash of everything that the rendered result pages depend on, apart from the game results themselves: the
+        templates, the translations, the version of the static files (which is part of their URLs) and the base URL """
+        version_hash = hashlib.sha256()
+        for template_name in sorted(os.listdir(TEMPLATE_DIRECTORY)):
+            if template_name.endswith('.mako.html'):
+                with open(os.path.join(TEMPLATE_DIRECTORY, template_name), 'rb') as f:
+                    version_hash.update(template_name.encode('utf-8') + b'\0' + hashlib.sha256(f.read()).digest())
+        for part in (TRANSLATIONS.version(), self.static_files.version, self.config['web']['base_url']):
+            version_hash.update(part.encode('utf-8') + b'\0')
+        return version_hash.hexdigest()[:12]
+
+    def update_render_version(self) -> None:
+        """ Recompute the `render_version` (e.g. after reloading the translations) and switch the `result_cache` to it,
+        if it has changed """
+        self.render_version = self._compute_render_version()
+        self.result_cache.set_version(self.render_version)
+
+    def warm_up(self) -> int:
+        """ Compile all templates (or load them from the `web.template_cache_dir`) in advance, so the first requests
+        don't pay for the compilation.
+
+        :return: The number of templates """
+        template_names = sorted(name for name in os.listdir(TEMPLATE_DIRECTORY) if name.endswith('.mako.html'))
+        for template_name in template_names:
+            self.template_lookup.get_template(template_name)
+        return len(template_names)
 
     def render_template(self, template_name: str, params: Dict[str, Any], locale: Optional[str] = None) -> str:
+        return self._render(template_name, self.template_lookup.get_template(template_name), params, locale)
+
+    def render_def(self, template_name: str, def_name: str, params: Dict[str, Any],
+                   locale: Optional[str] = None) -> str:
+        """ Render a single `<%def>` of a template, e.g. a part of a page, which is streamed to the client. """
+        return self._render(template_name, self.template_lookup.get_template(template_name).get_def(def_name), params,
+                            locale)
+
+    def _render(self, template_name: str, template: mako.template.Template, params: Dict[str, Any],
+                locale: Optional[str]) -> str:
         if locale is None:
             translations = gettext.NullTranslations()
         else:
-            translations = gettext.translation('qaqa_bot', LOCALE_DIR, (locale,), fallback=True)
-        template = self.template_lookup.get_template(template_name)
-        return template.render(**self.template_globals, **params,
-                               gettext=translations.gettext, ngettext=translations.ngettext, lang=locale or 'en')
+            locale = TRANSLATIONS.match(locale)
+            translations = TRANSLATIONS.get(locale)
+        start = time.monotonic()
+        result = template.render(**self.template_globals, **params,
+                                 gettext=translations.gettext, ngettext=translations.ngettext, lang=locale or 'en')
+        self.game_server.metrics.histogram('qaqa_web_render_seconds', "Rendering time of web page templates",
+                                           template=template_name).observe(time.monotonic() - start)
+        return result
 
 
 class WebRoot:
@@ -113,16 +489,41 @@ class WebRoot:
         self._env = env
         self.game = Game(env)
         self.sheet = Sheet(env)
+        self.metrics = Metrics(env)
+        self.static = Static(env)
+        self.api = Api(env)
 
     @cherrypy.expose
     def index(self, lang='en'):
+        if '/' in lang:
+            raise cherrypy.HTTPError(422, "Invalid language code")
         return self._env.render_template('index.mako.html', {}, lang)
 
 
+class MetricsRoot:
+    """ Root Controller of the separate metrics HTTP server (`web.metrics_socket_port`), which only serves /metrics
+    without token """
+    def __init__(self, env: WebEnvironment):
+        self.metrics = Metrics(env, internal=True)
+
+
 @cherrypy.popargs('game_id')
 class Game:
+    """ Controller for the result page of a game.
+
+    The game's summary is read first (see `GameServer.get_game_result_summary()`). Results of small games are then read
+    at once (from their materialized snapshot, see `GameServer.get_game_result()`). Result pages of large games (with at
+    least `web.stream_min_entries` entries) are streamed to the client sheet by sheet, while the sheets are read in
+    chunks of `web.stream_chunk_size` sheets (see `GameServer.get_game_result_sheets()`). This reduces the time to first
+    byte and the peak memory usage, since neither the whole game nor the whole page is held in memory. The streamed page
+    is sent with the same ETag as the cached page (see `ResultPageCache.etag()`) and written to the `ResultPageCache`'s
+    disk cache part by part, if it is enabled. """
+    STREAM_PLACEHOLDER = "<!-- sheets -->"
+
     def __init__(self, env: WebEnvironment):
         self._env = env
+        self.stream_min_entries = env.config['web'].get('stream_min_entries', 1000)
+        self.stream_chunk_size = env.config['web'].get('stream_chunk_size', 20)
 
     @cherrypy.expose
     def index(self, game_id, lang='en', authors=False):
@@ -131,12 +532,70 @@ class Game:
         game_id_decoded = decode_secure_id(game_id, self._env.config['secret'], b'game+' if authors else b'game')
         if game_id_decoded is None:
             raise cherrypy.HTTPError(404, "Invalid game id string")
-        game = self._env.game_server.get_game_result(game_id_decoded)
-        if game is None:
-            raise cherrypy.HTTPError(404, "Game with given id not found")
-        if authors and not game.is_showing_result_names:
-            raise cherrypy.HTTPError(404, "Game view with authors not available")
-        return self._env.render_template('game_result.mako.html', {'game': game, 'show_authors': authors}, lang)
+        # Only known locales are cached, so arbitrary language codes cannot flood the cache
+        lang = TRANSLATIONS.match(lang)
+        cache_key = ('game', game_id_decoded, lang, bool(authors))
+        page = self._env.result_cache.get(cache_key)
+        if page is None:
+            game = self._env.game_server.get_game_result_summary(game_id_decoded)
+            if game is None:
+                raise cherrypy.HTTPError(404, "Game with given id not found")
+            if authors and not game.is_showing_result_names:
+                raise cherrypy.HTTPError(404, "Game view with authors not available")
+            if game.num_entries >= self.stream_min_entries:
+                return self._stream(cache_key, game, authors, lang)
+            game = self._env.game_server.get_game_result(game_id_decoded)
+            page = self._env.result_cache.put(
+                cache_key, self._env.render_template('game_result.mako.html', {'game': game, 'show_authors': authors},
+                                                     lang),
+                game.finished)
+        return serve_cached_page(page)
+
+    def _stream(self, cache_key: Tuple, game: ResultGame, authors: bool, lang: str) -> Iterator[bytes]:
+        """ Stream the result page of the given game (without sheets, see `get_game_result_summary()`) to the client,
+        reading and rendering it sheet by sheet """
+        response = cherrypy.response
+        response.headers['ETag'] = self._env.result_cache.etag(cache_key)
+        response.headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(
+            calendar.timegm(game.finished.replace(microsecond=0).utctimetuple()))
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        cherrypy.lib.cptools.validate_etags()
+        cherrypy.lib.cptools.validate_since()
+        head, tail = self._env.render_template(
+            'game_result.mako.html', {'game': game, 'show_authors': authors,
+                                      'sheets_placeholder': self.STREAM_PLACEHOLDER},
+            lang).split(self.STREAM_PLACEHOLDER)
+        response.stream = True
+        response.headers['Content-Type'] = 'text/html;charset=utf-8'
+
+        def parts() -> Iterator[bytes]:
+            yield head.encode('utf-8')
+            last_sheet_id = 0
+            while True:
+                sheets = self._env.game_server.get_game_result_sheets(game.id, last_sheet_id, self.stream_chunk_size)
+                for sheet in sheets:
+                    yield self._env.render_def('util.mako.html', 'print_sheet',
+                                               {'sheet': sheet, 'show_authors': authors}, lang).encode('utf-8')
+                if len(sheets) < self.stream_chunk_size:
+                    break
+                last_sheet_id = sheets[-1].id
+            yield tail.encode('utf-8')
+
+        def generate() -> Iterator[bytes]:
+            page_file = self._env.result_cache.open_file(cache_key, game.finished)
+            if page_file is None:
+                yield from parts()
+                return
+            try:
+                for part in parts():
+                    page_file.write(part)
+                    yield part
+            except BaseException:
+                # Including GeneratorExit, if the client has disconnected
+                page_file.abort()
+                raise
+            page_file.commit()
+        return generate()
 
 
 @cherrypy.popargs('sheet_id')
@@ -151,9 +610,222 @@ class Sheet:
         sheet_id_decoded = decode_secure_id(sheet_id, self._env.config['secret'], b'sheet+' if authors else b'sheet')
         if sheet_id_decoded is None:
             raise cherrypy.HTTPError(404, "Invalid sheet id string")
-        sheet = self._env.game_server.get_game_result_sheet(sheet_id_decoded)
-        if sheet is None:
+        # Only known locales are cached, so arbitrary language codes cannot flood the cache
+        lang = TRANSLATIONS.match(lang)
+        cache_key = ('sheet', sheet_id_decoded, lang, bool(authors))
+        page = self._env.result_cache.get(cache_key)
+        if page is None:
+            result = self._env.game_server.get_game_result_sheet(sheet_id_decoded)
+            if result is None:
+                raise cherrypy.HTTPError(404, "Sheet with given sheet id not found")
+            game, sheet = result
+            if authors and not game.is_showing_result_names:
+                raise cherrypy.HTTPError(404, "Sheet view with authors not available")
+            page = self._env.result_cache.put(
+                cache_key, self._env.render_template('sheet_result.mako.html',
+                                                     {'game': game, 'sheet': sheet, 'show_authors': authors}, lang),
+                game.finished)
+        return serve_cached_page(page)
+
+
+class Api:
+    """ JSON API for the results of finished games.
+
+    * `/api/game/<game_id>[?authors=1]`: The game with its sheets (including their entries)
+    * `/api/sheet/<sheet_id>[?authors=1]`: A single sheet with its entries and basic information about the game
+
+    The ids are the same secure ids as for the HTML pages (from the realms `game`/`game+` and `sheet`/`sheet+`, the
+    latter ones with `authors=1`, which adds the authors' names to the entries). The sheets of a game resp. the entries
+    of a sheet are paginated: Each response contains up to `limit` items and a `next_cursor`, which can be passed as
+    `cursor` parameter to get the next page (or null for the last page). The `limit` is rounded up to the next of a few
+    allowed page sizes.
+
+    The pages are sliced from the game's result snapshot, which is cached per game by the GameServer (see
+    `GameServer.get_game_result()`), so they are not cached themselves. Responses have ETag and Last-Modified headers
+    for conditional requests, which are answered before serializing the response.
+    """
+    def __init__(self, env: WebEnvironment):
+        self.game = ApiGame(env)
+        self.sheet = ApiSheet(env)
+
+
+def _parse_page_args(secret: str, cursor: Optional[str], limit: Optional[str], page_sizes: Tuple[int, ...],
+                     default_limit: int, start: int) -> Tuple[int, int]:
+    """ Parse and check the `cursor` and `limit` parameters of a paginated API request.
+
+    :return: The decoded cursor (or `start`, if not given) and the limit, rounded up to the next of the `page_sizes`
+        (or the largest one) """
+    try:
+        limit_value = int(limit) if limit is not None else default_limit
+    except ValueError:
+        raise cherrypy.HTTPError(400, "Invalid limit")
+    limit_value = next((size for size in page_sizes if size >= limit_value), page_sizes[-1])
+    if cursor is None:
+        return start, limit_value
+    cursor_value = decode_secure_id(cursor, secret, b'cursor')
+    if cursor_value is None:
+        raise cherrypy.HTTPError(400, "Invalid cursor")
+    return cursor_value, limit_value
+
+
+def _format_timestamp(timestamp: datetime.datetime) -> str:
+    return timestamp.replace(tzinfo=datetime.timezone.utc).isoformat()
+
+
+def _entry_json(entry: ResultEntry, authors: bool) -> Dict[str, Any]:
+    result = {'position': entry.position,
+              'type': entry.type.name.lower(),
+              'text': entry.text,
+              'timestamp': _format_timestamp(entry.timestamp)}
+    if authors:
+        result['author'] = entry.author
+    return result
+
+
+def _serve_json(env: WebEnvironment, key: Tuple, last_modified: datetime.datetime,
+                build: Callable[[], Dict[str, Any]]) -> bytes:
+    """ Serve a JSON API response with caching headers (the ETag derived from the `key`, see `ResultPageCache.etag()`),
+    using the `build` function to create the JSON data, unless the request's validators match. """
+    headers = cherrypy.response.headers
+    headers['ETag'] = env.result_cache.etag(key)
+    headers['Last-Modified'] = cherrypy.lib.httputil.HTTPDate(
+        calendar.timegm(last_modified.replace(microsecond=0).utctimetuple()))
+    headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    cherrypy.lib.cptools.validate_etags()
+    cherrypy.lib.cptools.validate_since()
+    headers['Content-Type'] = 'application/json'
+    return json.dumps(build(), ensure_ascii=False).encode('utf-8')
+
+
+@cherrypy.popargs('game_id')
+class ApiGame:
+    PAGE_SIZES = (10, 20, 50, 100)
+    DEFAULT_LIMIT = 20
+
+    exposed = True
+
+    def __init__(self, env: WebEnvironment):
+        self._env = env
+
+    def __call__(self, game_id, authors=False, cursor=None, limit=None):
+        secret = self._env.config['secret']
+        game_id_decoded = decode_secure_id(game_id, secret, b'game+' if authors else b'game')
+        if game_id_decoded is None:
+            raise cherrypy.HTTPError(404, "Invalid game id string")
+        after_sheet_id, limit_value = _parse_page_args(secret, cursor, limit, self.PAGE_SIZES, self.DEFAULT_LIMIT, 0)
+        game = self._env.game_server.get_game_result(game_id_decoded)
+        if game is None:
+            raise cherrypy.HTTPError(404, "Game with given id not found")
+        if authors and not game.is_showing_result_names:
+            raise cherrypy.HTTPError(404, "Game view with authors not available")
+
+        def build() -> Dict[str, Any]:
+            # Take one more sheet to find out, if there is a next page
+            sheets = [sheet for sheet in game.sheets if sheet.id > after_sheet_id][:limit_value + 1]
+            has_more = len(sheets) > limit_value
+            sheets = sheets[:limit_value]
+            return {
+                'id': game_id,
+                'name': game.name,
+                'started': _format_timestamp(game.started),
+                'finished': _format_timestamp(game.finished),
+                'url': "{}/game/{}/{}".format(self._env.config['web']['base_url'], game_id,
+                                              "?authors=1" if authors else ""),
+                'sheets': [{'id': encode_secure_id(sheet.id, secret, b'sheet+' if authors else b'sheet'),
+                            'num_entries': sheet.num_entries,
+                            'entries': [_entry_json(entry, bool(authors)) for entry in sheet.entries]}
+                           for sheet in sheets],
+                'next_cursor': encode_secure_id(sheets[-1].id, secret, b'cursor') if has_more else None,
+            }
+
+        return _serve_json(self._env, ('api-game', game_id_decoded, bool(authors), after_sheet_id, limit_value),
+                           game.finished, build)
+
+
+@cherrypy.popargs('sheet_id')
+class ApiSheet:
+    PAGE_SIZES = (50, 100, 500, 1000)
+    DEFAULT_LIMIT = 100
+
+    exposed = True
+
+    def __init__(self, env: WebEnvironment):
+        self._env = env
+
+    def __call__(self, sheet_id, authors=False, cursor=None, limit=None):
+        secret = self._env.config['secret']
+        sheet_id_decoded = decode_secure_id(sheet_id, secret, b'sheet+' if authors else b'sheet')
+        if sheet_id_decoded is None:
+            raise cherrypy.HTTPError(404, "Invalid sheet id string")
+        after_position, limit_value = _parse_page_args(secret, cursor, limit, self.PAGE_SIZES, self.DEFAULT_LIMIT, -1)
+        result = self._env.game_server.get_game_result_sheet(sheet_id_decoded)
+        if result is None:
             raise cherrypy.HTTPError(404, "Sheet with given sheet id not found")
-        if authors and not sheet.game.is_showing_result_names:
+        game, sheet = result
+        if authors and not game.is_showing_result_names:
             raise cherrypy.HTTPError(404, "Sheet view with authors not available")
-        return self._env.render_template('sheet_result.mako.html', {'sheet': sheet, 'show_authors': authors}, lang)
+
+        def build() -> Dict[str, Any]:
+            entries = [entry for entry in sheet.entries if entry.position > after_position][:limit_value + 1]
+            has_more = len(entries) > limit_value
+            entries = entries[:limit_value]
+            return {
+                'id': sheet_id,
+                'game': {'name': game.name,
+                         'started': _format_timestamp(game.started),
+                         'finished': _format_timestamp(game.finished)},
+                'url': "{}/sheet/{}/{}".format(self._env.config['web']['base_url'], sheet_id,
+                                               "?authors=1" if authors else ""),
+                'num_entries': sheet.num_entries,
+                'entries': [_entry_json(entry, bool(authors)) for entry in entries],
+                'next_cursor': encode_secure_id(entries[-1].position, secret, b'cursor') if has_more else None,
+            }
+
+        return _serve_json(self._env, ('api-sheet', sheet_id_decoded, bool(authors), after_position, limit_value),
+                           game.finished, build)
+
+
+class Static:
+    """ Controller for versioned static files at `/static/<version>/<file>`, see `StaticFiles`.
+
+    Unversioned paths (`/static/<file>`) are still served by CherryPy's staticdir tool (see `setup_cherrypy_engine()`),
+    which takes precedence for all existing files. """
+    exposed = True
+
+    def __init__(self, env: WebEnvironment):
+        self._env = env
+
+    def __call__(self, version, *path):
+        if not path:
+            raise cherrypy.NotFound()
+        return self._env.static_files.serve(version, '/'.join(path))
+
+
+class Metrics:
+    """ Controller for the /metrics endpoint, serving the GameServer's metrics in Prometheus' text format.
+
+    On the main application, the endpoint is only available if a `web.metrics_token` is configured, which must be given
+    as Bearer token in the Authorization header. The `MetricsRoot` application of the separate metrics HTTP server
+    (configured with `web.metrics_socket_port`), which should only be reachable by the Prometheus server, mounts it with
+    `internal=True` to serve the metrics without token.
+
+    The controller object itself is exposed as a callable (instead of providing an `index()` method), so it is
+    available at `/metrics` without trailing slash. """
+    exposed = True
+
+    def __init__(self, env: WebEnvironment, internal: bool = False):
+        self._env = env
+        self._internal = internal
+
+    def __call__(self):
+        token = self._env.config['web'].get('metrics_token')
+        if self._internal:
+            pass
+        elif token:
+            authorization = cherrypy.request.headers.get('Authorization', '')
+            if not hmac.compare_digest(authorization.encode('utf-8'), "Bearer {}".format(token).encode('utf-8')):
+                raise cherrypy.HTTPError(401, "Invalid or missing metrics token")
+        else:
+            raise cherrypy.NotFound()
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return format_prometheus(self._env.game_server.metrics.collect()).encode('utf-8')
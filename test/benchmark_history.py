@@ -0,0 +1,124 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Benchmark of GameServer action latency in relation to the amount of historical (finished) games in the database.
+
+The game progress queries should only depend on the size of the active game. This benchmark fills the database with an
+increasing number of finished games and measures the mean latency of each action of a small synchronous game on top of
+that history. Run it from the repository root with:
+
+    python -m test.benchmark_history [--sizes 0 10000 100000] [--database sqlite:///bench.db]
+"""
+
+import argparse
+import collections
+import datetime
+import statistics
+import time
+from typing import Dict, List
+
+import sqlalchemy
+
+from qaqa_bot import game, model
+from .util import CONFIG, create_sample_users
+
+HISTORY_PLAYERS = 4
+HISTORY_ROUNDS = 6
+
+
+def fill_history(engine: sqlalchemy.engine.Engine, num_entries: int) -> None:
+    """ Insert finished games with a total of (approximately) `num_entries` entries, using plain bulk INSERTs. """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    entries_per_game = HISTORY_PLAYERS * HISTORY_ROUNDS
+    with engine.begin() as connection:
+        user_ids = [row[0] for row in connection.execute(sqlalchemy.select([model.User.id]))]
+        for game_index in range(num_entries // entries_per_game):
+            game_id = connection.execute(model.Game.__table__.insert().values(
+                name="History {}".format(game_index), chat_id=-1000 - game_index, started=now, finished=now,
+                is_waiting_for_finish=False, rounds=HISTORY_ROUNDS, is_synchronous=True,
+                is_showing_result_names=False)).inserted_primary_key[0]
+            entries = []
+            last_entry_type = (model.EntryType.QUESTION if HISTORY_ROUNDS % 2 else model.EntryType.ANSWER)
+            for sheet_index in range(HISTORY_PLAYERS):
+                sheet_id = connection.execute(model.Sheet.__table__.insert().values(
+                    game_id=game_id, num_entries=HISTORY_ROUNDS, last_entry_type=last_entry_type))\
+                    .inserted_primary_key[0]
+                entries.extend({'sheet_id': sheet_id, 'position': position,
+                                'user_id': user_ids[(sheet_index + position) % len(user_ids)],
+                                'text': "Some historic text", 'timestamp': now,
+                                'type': (model.EntryType.QUESTION if position % 2 == 0 else model.EntryType.ANSWER)}
+                               for position in range(HISTORY_ROUNDS))
+            connection.execute(model.Entry.__table__.insert(), entries)
+            connection.execute(model.Sheet.__table__.update()
+                               .where(model.Sheet.game_id == game_id)
+                               .values(last_entry_id=sqlalchemy.select([sqlalchemy.func.max(model.Entry.id)])
+                                       .where(model.Entry.sheet_id == model.Sheet.id)
+                                       .as_scalar()))
+
+
+def play_game(game_server: game.GameServer, chat_id: int) -> Dict[str, List[float]]:
+    """ Play a synchronous game with all four sample users and return the measured latencies per action. """
+    timings: Dict[str, List[float]] = collections.defaultdict(list)
+
+    def timed(action: str, *args):
+        start = time.perf_counter()
+        result = getattr(game_server, action)(*args)
+        timings[action].append(time.perf_counter() - start)
+        return result
+
+    timed('new_game', chat_id, "Benchmark Group")
+    for user_id in range(1, 5):
+        timed('join_game', chat_id, user_id)
+    timed('set_rounds', chat_id, HISTORY_ROUNDS)
+    timed('start_game', chat_id)
+    message_id = 0
+    for round_ in range(HISTORY_ROUNDS):
+        for user_chat_id in range(11, 15):
+            message_id += 1
+            timed('submit_text', user_chat_id, chat_id * 1000 + message_id, "Text {}".format(message_id))
+        timed('get_group_status', chat_id)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[0, 10000, 50000, 200000],
+                        help="Numbers of historical entries to benchmark with")
+    parser.add_argument('--database', default="sqlite://",
+                        help="SQLAlchemy database URL. Must point to an empty database. Defaults to in-memory SQLite.")
+    parser.add_argument('--games', type=int, default=3, help="Number of games to play per history size")
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes:
+        engine = sqlalchemy.create_engine(args.database, isolation_level='SERIALIZABLE')
+        model.Base.metadata.create_all(engine)
+        create_sample_users(engine)
+        fill_history(engine, size)
+        game_server = game.GameServer(CONFIG, engine)
+        timings: Dict[str, List[float]] = collections.defaultdict(list)
+        for i in range(args.games):
+            for action, values in play_game(game_server, 21 + i).items():
+                timings[action].extend(values)
+        results[size] = {action: statistics.mean(values) for action, values in timings.items()}
+        model.Base.metadata.drop_all(engine)
+        engine.dispose()
+
+    actions = sorted(results[args.sizes[0]])
+    print("{:>18}".format("entries") + "".join("{:>12}".format(size) for size in args.sizes))
+    for action in actions:
+        print("{:>18}".format(action) + "".join("{:>10.2f}ms".format(results[size][action] * 1000)
+                                                for size in args.sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Benchmark of the cold versus warm render latency of the game result page.
+
+For each iteration, a new `WebEnvironment` (like in a newly started process) renders the result page of a finished game
+(loaded from the database only once) in three situations:
+* cold: the templates are compiled in-process upon the first request (no `web.template_cache_dir`)
+* disk: the compiled templates are loaded from a prefilled `web.template_cache_dir` upon the first request
+* warm: the templates have been compiled by `WebEnvironment.warm_up()` in advance
+
+Run it from the repository root with:
+
+    python -m test.benchmark_render [--iterations 20]
+"""
+
+import argparse
+import statistics
+import tempfile
+import time
+from typing import Dict, Any, Optional
+
+import sqlalchemy
+
+from qaqa_bot import game, model, web
+from .benchmark_history import fill_history
+from .util import CONFIG, create_sample_users
+
+
+def first_render(config: Dict[str, Any], game_server: game.GameServer, result: game.ResultGame,
+                 warm_up: bool) -> float:
+    """ Measure the latency of the first rendering of the result page by a new WebEnvironment with the given config """
+    env = web.WebEnvironment(config, game_server)
+    if warm_up:
+        env.warm_up()
+    start = time.perf_counter()
+    env.render_template('game_result.mako.html', {'game': result, 'show_authors': False}, 'en')
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20, help="Number of new WebEnvironments per situation")
+    args = parser.parse_args()
+
+    engine = sqlalchemy.create_engine("sqlite://")
+    model.Base.metadata.create_all(engine)
+    create_sample_users(engine)
+    fill_history(engine, 24)
+    game_server = game.GameServer(CONFIG, engine)
+    result: Optional[game.ResultGame] = game_server.get_game_result(1)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        disk_config = {**CONFIG, 'web': {**CONFIG['web'], 'template_cache_dir': tempdir}}
+        web.WebEnvironment(disk_config, game_server).warm_up()
+        timings = {
+            'cold': [first_render(CONFIG, game_server, result, False) for _ in range(args.iterations)],
+            'disk': [first_render(disk_config, game_server, result, False) for _ in range(args.iterations)],
+            'warm': [first_render(CONFIG, game_server, result, True) for _ in range(args.iterations)],
+        }
+
+    for situation, values in timings.items():
+        print("{:>5}: median {:8.2f} ms, max {:8.2f} ms".format(situation, statistics.median(values) * 1000,
+                                                                max(values) * 1000))
+
+
+if __name__ == '__main__':
+    main()
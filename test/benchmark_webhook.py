@@ -0,0 +1,227 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Offline benchmark of the Telegram webhook intake, using a fake Telegram client.
+
+The benchmark starts the bot Frontend in webhook mode with its `TelegramWebhook` endpoint on a local CherryPy HTTP
+server and the Dispatcher, but without any connection to the Telegram API: Outgoing messages are only counted. A fake
+Telegram client POSTs the updates to the webhook over a number of concurrent keep-alive connections (like Telegram does,
+see `webhook_max_connections`). The updates are read from a file with one JSON-serialized update per line (e.g.
+recorded from a real bot) or generated for a number of games (/start, /new_game, /join_game, /start_game and text
+submissions).
+
+It reports the latency of the webhook's acknowledgements, the throughput of the intake, the time until all updates
+have been dispatched and handled and the number of transaction retries of the GameServer actions. With `--burst`, each
+player sends multiple messages in quick succession. Use `--unordered` to compare the chat-partitioned handler execution
+with an unordered thread pool (like ptb's former `@run_async`). Run it from the repository root with:
+
+    python -m test.benchmark_webhook [--games 10] [--players 5] [--connections 40] [--updates recorded.jsonl]
+"""
+
+import argparse
+import http.client
+import json
+import math
+import os
+import queue
+import tempfile
+import threading
+import time
+from typing import List, Dict, Any, Iterator
+
+import cherrypy
+import sqlalchemy
+import telegram
+import telegram.ext
+
+from qaqa_bot import bot, game, model
+from .util import CONFIG
+
+SECRET = "benchmark-secret"
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': "QAQA", 'username': CONFIG['bot']['username']}
+
+
+def generate_updates(num_games: int, num_players: int, rounds: int, burst: int = 1) -> Iterator[Dict[str, Any]]:
+    """ Generate the updates of `num_games` games with `num_players` players each, playing `rounds` rounds. In each
+    round, each player sends `burst` messages in a row. """
+    update_ids = iter(range(1, 10**9))
+    message_ids: Dict[int, int] = {}
+
+    def message(chat: Dict[str, Any], user_id: int, text: str) -> Dict[str, Any]:
+        message_ids[chat['id']] = message_ids.get(chat['id'], 0) + 1
+        result = {'message_id': message_ids[chat['id']], 'date': int(time.time()), 'chat': chat, 'text': text,
+                  'from': {'id': user_id, 'is_bot': False, 'first_name': "Player {}".format(user_id),
+                           'language_code': 'en'}}
+        if text.startswith('/'):
+            result['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(update_ids), 'message': result}
+
+    def private_chat(user_id: int) -> Dict[str, Any]:
+        return {'id': 1000 + user_id, 'type': 'private', 'first_name': "Player {}".format(user_id)}
+
+    for index in range(num_games):
+        group = {'id': -(index + 1), 'type': 'group', 'title': "Benchmark Group {}".format(index)}
+        players = [index * num_players + i for i in range(num_players)]
+        for user_id in players:
+            yield message(private_chat(user_id), user_id, "/" + game.COMMAND_REGISTER)
+        yield message(group, players[0], "/" + game.COMMAND_NEW_GAME)
+        for user_id in players:
+            yield message(group, user_id, "/" + game.COMMAND_JOIN_GAME)
+        yield message(group, players[0], "/" + game.COMMAND_START_GAME)
+    for round_ in range(rounds):
+        for index in range(num_games):
+            for user_id in range(index * num_players, (index + 1) * num_players):
+                for i in range(burst):
+                    yield message(private_chat(user_id), user_id,
+                                  "Text {}.{} of player {}".format(round_, i, user_id))
+
+
+def post_updates(port: int, path: str, updates: List[bytes], num_connections: int) -> List[float]:
+    """ POST all updates to the webhook in order, using `num_connections` concurrent keep-alive connections, and return
+    the latency of each request. """
+    work: queue.Queue = queue.Queue()
+    for update in updates:
+        work.put(update)
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def worker() -> None:
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        while True:
+            try:
+                body = work.get_nowait()
+            except queue.Empty:
+                break
+            start = time.perf_counter()
+            for attempt in range(3):
+                try:
+                    connection.request('POST', path, body, {'Content-Type': 'application/json',
+                                                            'X-Telegram-Bot-Api-Secret-Token': SECRET})
+                    response = connection.getresponse()
+                    response.read()
+                    break
+                except (ConnectionError, http.client.HTTPException):
+                    # Reconnect and retry (like Telegram does) if the server closed the keep-alive connection
+                    connection.close()
+                    connection = http.client.HTTPConnection('127.0.0.1', port)
+                    if attempt == 2:
+                        raise
+            latency = time.perf_counter() - start
+            if response.status != 200:
+                raise RuntimeError("Webhook responded with HTTP status {}".format(response.status))
+            with lock:
+                latencies.append(latency)
+        connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(num_connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """ Get the p-th percentile of a sorted list of values, using the nearest-rank method """
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run(database: str, updates: List[bytes], args: argparse.Namespace) -> None:
+    config = {**CONFIG,
+              'bot': {**CONFIG['bot'], 'api_key': "123456:BENCHMARK-TOKEN",
+                      'webhook_url': "https://example.com/telegram", 'webhook_secret': SECRET}}
+    engine = sqlalchemy.create_engine(database, isolation_level='SERIALIZABLE')
+    model.Base.metadata.create_all(engine)
+    frontend = bot.Frontend(config, game.GameServer(config, engine))
+    # Don't ask the Telegram API for the bot's user and commands and don't send messages
+    frontend.updater.bot.bot = telegram.User.de_json(BOT_USER, frontend.updater.bot)
+    frontend.updater.bot._commands = []
+    handled = threading.Semaphore(0)
+    outgoing = []
+
+    def send_messages(messages: List[game.TranslatedMessage]) -> None:
+        outgoing.extend(messages)
+        handled.release()
+    frontend.send_messages = send_messages
+    dispatched = threading.Semaphore(0)
+    frontend.dispatcher.add_handler(telegram.ext.TypeHandler(telegram.Update, lambda *_args: dispatched.release()),
+                                    group=1)
+    if args.unordered:
+        frontend._partition_key = lambda update: update.update_id
+
+    cherrypy.config.update({'engine.autoreload.on': False, 'log.screen': False, 'server.socket_host': '127.0.0.1',
+                            'server.socket_port': args.port, 'server.thread_pool': args.connections})
+    cherrypy.tree.mount(frontend.webhook, '/telegram')
+    cherrypy.engine.start()
+    dispatcher_thread = frontend.start_dispatcher()
+    try:
+        start = time.perf_counter()
+        latencies = sorted(post_updates(args.port, '/telegram', updates, args.connections))
+        posted = time.perf_counter() - start
+        for _ in updates:
+            dispatched.acquire()
+        all_dispatched = time.perf_counter() - start
+        for _ in updates:
+            handled.acquire(timeout=args.timeout)
+        all_handled = time.perf_counter() - start
+    finally:
+        frontend.updater.stop()
+        dispatcher_thread.join()
+        frontend.handler_executor.shutdown()
+        cherrypy.engine.exit()
+        engine.dispose()
+
+    print("{} updates via {} connections".format(len(updates), args.connections))
+    print("Acknowledgement latency: p50 {:.2f} ms, p95 {:.2f} ms, p99 {:.2f} ms".format(
+        percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000))
+    print("All updates posted after {:.2f}s ({:.1f} updates/s)".format(posted, len(updates) / posted))
+    print("All updates dispatched after {:.2f}s ({:.1f} updates/s)".format(all_dispatched,
+                                                                          len(updates) / all_dispatched))
+    print("All updates handled after {:.2f}s ({:.1f} updates/s, {} outgoing messages)".format(
+        all_handled, len(updates) / all_handled, len(outgoing)))
+    retries = sum(metric.value
+                  for family in frontend.gs.metrics.collect() if family.name == 'qaqa_action_retries_total'
+                  for _labels, metric in family.metrics)
+    print("{} transaction retries ({} handler execution)".format(
+        int(retries), "unordered" if args.unordered else "chat-partitioned"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=argparse.FileType('r'),
+                        help="File with one JSON-serialized Telegram update per line. If not given, updates are "
+                             "generated.")
+    parser.add_argument('--games', type=int, default=10, help="Number of games for generating updates")
+    parser.add_argument('--players', type=int, default=5, help="Number of players per game for generating updates")
+    parser.add_argument('--rounds', type=int, default=5, help="Number of rounds per game for generating updates")
+    parser.add_argument('--burst', type=int, default=2,
+                        help="Number of consecutive messages of each player per round for generating updates")
+    parser.add_argument('--unordered', action='store_true',
+                        help="Don't partition the handler execution by chat, i.e. handle all updates in parallel")
+    parser.add_argument('--connections', type=int, default=40, help="Number of concurrent HTTP connections")
+    parser.add_argument('--port', type=int, default=9099, help="Local HTTP port for the webhook")
+    parser.add_argument('--database', help="SQLAlchemy database URL. Must point to an empty database. Defaults to a "
+                                           "temporary SQLite database file.")
+    parser.add_argument('--timeout', type=float, default=60, help="Timeout for handling each update in seconds")
+    args = parser.parse_args()
+
+    if args.updates:
+        updates = [line.strip().encode('utf-8') for line in args.updates if line.strip()]
+    else:
+        updates = [json.dumps(update).encode('utf-8')
+                   for update in generate_updates(args.games, args.players, args.rounds, args.burst)]
+    with tempfile.TemporaryDirectory() as tempdir:
+        run(args.database or "sqlite:///" + os.path.join(tempdir, "benchmark.db"), updates, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Load test of the GameServer with many concurrent games and simulated players.
+
+The load generator creates a number of games with a number of players each and drives the GameServer from a thread
+pool, just like the Telegram frontend's handler threads do. Each simulated player reacts to the bot's requests for a
+new submission after a random think time, which is log-normally distributed around the given median. Optionally,
+additional players join the running games, some players leave them and some games are stopped early with /stop. At
+the end, the throughput of actions and the p50/p95/p99 latency of each GameServer action are reported. Run it from the
+repository root with:
+
+    python -m test.loadtest [--games 20] [--players 6] [--mode mixed] [--database mysql+mysqldb://...]
+
+The database must be empty. It defaults to a temporary SQLite database file.
+"""
+
+import argparse
+import heapq
+import itertools
+import logging
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Callable, Tuple, Set
+
+import sqlalchemy
+import sqlalchemy.engine
+
+from qaqa_bot import game, model
+from qaqa_bot.metrics import InMemorySink, ActionSample
+from .util import CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class LoadGenerator:
+    """ Event-driven simulation of the players and group chats of multiple games.
+
+    All actions are scheduled as timed events. The `run()` method hands due events over to the thread pool, whose
+    threads call the GameServer and schedule the players' reactions to the resulting messages. """
+    def __init__(self, game_server: game.GameServer, args: argparse.Namespace, seed: int = 0):
+        self.game_server = game_server
+        self.args = args
+        self.random = random.Random(seed)
+        self._condition = threading.Condition()
+        self._events: List[Tuple[float, int, Callable, tuple]] = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._message_ids: Dict[int, int] = {}
+        self.running_games: Set[int] = set()
+
+    # Scheduling
+
+    def schedule(self, delay: float, function: Callable, *args) -> None:
+        with self._condition:
+            heapq.heappush(self._events, (time.monotonic() + delay, next(self._sequence), function, args))
+            self._condition.notify()
+
+    def think_time(self) -> float:
+        return self.random.lognormvariate(math.log(self.args.think_time), self.args.think_sigma)
+
+    def run(self, executor: ThreadPoolExecutor, deadline: float) -> bool:
+        """ Execute scheduled events until no event is left (return True) or the deadline is reached (return False) """
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    if not self._events and not self._in_flight:
+                        return True
+                    if now >= deadline:
+                        return False
+                    if self._events and self._events[0][0] <= now:
+                        _due, _seq, function, args = heapq.heappop(self._events)
+                        self._in_flight += 1
+                        break
+                    self._condition.wait(min(self._events[0][0] if self._events else deadline, deadline) - now)
+            executor.submit(self._execute, function, args)
+
+    def _execute(self, function: Callable, args: tuple) -> None:
+        try:
+            self.handle_messages(function(*args))
+        except Exception as e:
+            # Failures are recorded by the GameServer's metrics sink
+            logger.debug("Action %s%s failed: %s", function.__name__, args, e)
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify()
+
+    # Simulated users
+
+    def handle_messages(self, messages: List[game.TranslatedMessage]) -> None:
+        for message in messages:
+            if message.chat_id > 0 and message.text.startswith("Please "):
+                self.schedule(self.think_time(), self.submit, message.chat_id)
+            elif message.chat_id < 0 and message.text.startswith("Game finished"):
+                self.running_games.discard(message.chat_id)
+
+    def submit(self, chat_id: int) -> List[game.TranslatedMessage]:
+        with self._condition:
+            message_id = self._message_ids.get(chat_id, 0) + 1
+            self._message_ids[chat_id] = message_id
+        return self.game_server.submit_text(chat_id, message_id, "Text {} of {}".format(message_id, chat_id))
+
+    def setup_game(self, group_chat_id: int, players: List[int], joiners: List[int], synchronous: bool
+                   ) -> List[game.TranslatedMessage]:
+        """ Create and start a game and schedule the random joins, leaves and stop of this game """
+        self.game_server.new_game(group_chat_id, "Load Test Group {}".format(-group_chat_id))
+        self.game_server.set_synchronous(group_chat_id, synchronous)
+        self.game_server.set_rounds(group_chat_id, self.args.rounds)
+        for user_id in players:
+            self.game_server.join_game(group_chat_id, user_id)
+        messages = self.game_server.start_game(group_chat_id)
+
+        for user_id in joiners:
+            self.schedule(self.random.uniform(0, self.args.event_window), self.game_server.join_game,
+                          group_chat_id, user_id)
+        for user_id in self.random.sample(players, min(self.args.leaves, len(players))):
+            self.schedule(self.random.uniform(0, self.args.event_window), self.game_server.leave_game,
+                          group_chat_id, user_id)
+        if self.random.random() < self.args.stop_fraction:
+            self.schedule(self.random.uniform(0, self.args.event_window), self.game_server.stop_game, group_chat_id)
+        return messages
+
+    def add_game(self, index: int) -> None:
+        """ Schedule the setup of a game within the ramp-up time """
+        group_chat_id = -(index + 1)
+        user_ids = [index * (self.args.players + self.args.joins) + i
+                    for i in range(self.args.players + self.args.joins)]
+        synchronous = (self.args.mode == 'sync' or self.args.mode == 'mixed' and index % 2 == 0)
+        self.running_games.add(group_chat_id)
+        self.schedule(self.random.uniform(0, self.args.ramp_up), self.setup_game, group_chat_id,
+                      user_ids[:self.args.players], user_ids[self.args.players:], synchronous)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """ Get the p-th percentile of a sorted list of values, using the nearest-rank method """
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run(database: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """ Run the load test against the given (empty) database and return the statistics. """
+    engine_args = {}
+    if sqlalchemy.engine.make_url(database).get_backend_name() != 'sqlite':
+        engine_args['pool_size'] = args.workers
+    engine = sqlalchemy.create_engine(database, isolation_level='SERIALIZABLE', **engine_args)
+    model.Base.metadata.create_all(engine)
+    num_users = args.games * (args.players + args.joins)
+    with engine.begin() as connection:
+        connection.execute(model.User.__table__.insert(),
+                           [{'api_id': i, 'chat_id': 1000 + i, 'first_name': "Player {}".format(i)}
+                            for i in range(num_users)])
+    sink = InMemorySink()
+    game_server = game.GameServer({**CONFIG, 'game': {'concurrency': args.concurrency}}, engine, metrics_sink=sink)
+
+    generator = LoadGenerator(game_server, args, args.seed)
+    for index in range(args.games):
+        generator.add_game(index)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as executor:
+        completed = generator.run(executor, time.monotonic() + args.timeout)
+    duration = time.perf_counter() - start
+    samples = list(sink.samples)
+    unfinished = len(generator.running_games)
+
+    # Clean up games, which did not finish until the timeout
+    for group_chat_id in generator.running_games:
+        game_server.immediately_stop_game(group_chat_id)
+    model.Base.metadata.drop_all(engine)
+    engine.dispose()
+    return {'samples': samples, 'duration': duration, 'completed': completed, 'unfinished': unfinished}
+
+
+def print_report(samples: List[ActionSample], duration: float, unfinished: int) -> None:
+    print("{:<24}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}{:>8}".format(
+        "action", "count", "failures", "retries", "p50 ms", "p95 ms", "p99 ms", "stmts"))
+    by_action: Dict[str, List[ActionSample]] = {}
+    for sample in samples:
+        by_action.setdefault(sample.action, []).append(sample)
+    for action, action_samples in sorted(by_action.items()):
+        latencies = sorted(s.wall_time * 1000 for s in action_samples)
+        print("{:<24}{:>8}{:>10}{:>10}{:>10.1f}{:>10.1f}{:>10.1f}{:>8.1f}".format(
+            action, len(action_samples), sum(1 for s in action_samples if not s.success),
+            sum(s.attempts - 1 for s in action_samples),
+            percentile(latencies, 50), percentile(latencies, 95), percentile(latencies, 99),
+            sum(s.statements for s in action_samples) / len(action_samples)))
+    print()
+    print("{} actions in {:.2f}s: {:.1f} actions/s, {} games unfinished".format(
+        len(samples), duration, len(samples) / duration, unfinished))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=20, help="Number of concurrent games")
+    parser.add_argument('--players', type=int, default=6, help="Number of players per game at game start")
+    parser.add_argument('--rounds', type=int, default=6, help="Number of rounds of each game")
+    parser.add_argument('--mode', choices=('sync', 'async', 'mixed'), default='mixed',
+                        help="Play synchronous or asynchronous games or both (alternating)")
+    parser.add_argument('--workers', type=int, default=16, help="Number of threads in the thread pool")
+    parser.add_argument('--think-time', type=float, default=0.05,
+                        help="Median think time of the players before each submission in seconds")
+    parser.add_argument('--think-sigma', type=float, default=0.5,
+                        help="Sigma of the log-normal think time distribution")
+    parser.add_argument('--ramp-up', type=float, default=1.0, help="Time span for starting all games in seconds")
+    parser.add_argument('--joins', type=int, default=1, help="Number of players joining each running game")
+    parser.add_argument('--leaves', type=int, default=1, help="Number of players leaving each running game")
+    parser.add_argument('--stop-fraction', type=float, default=0.25,
+                        help="Fraction of games to be stopped early with /stop")
+    parser.add_argument('--event-window', type=float, default=1.0,
+                        help="Time span after each game's start for joins, leaves and stops in seconds")
+    parser.add_argument('--concurrency', default=game.ConcurrencyMode.RETRY.value,
+                        choices=[mode.value for mode in game.ConcurrencyMode], help="The GameServer's concurrency mode")
+    parser.add_argument('--database', help="SQLAlchemy database URL. Must point to an empty database. Defaults to a "
+                                           "temporary SQLite database file.")
+    parser.add_argument('--timeout', type=float, default=300, help="Maximum duration of the load test in seconds")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the random number generator")
+    args = parser.parse_args()
+    log_handler = logging.StreamHandler()
+    log_handler.setLevel(logging.ERROR)
+    logging.getLogger().addHandler(log_handler)
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        database = args.database or "sqlite:///" + os.path.join(tempdir, "loadtest.db")
+        result = run(database, args)
+    print_report(result['samples'], result['duration'], result['unfinished'])
+    if not result['completed']:
+        print("Timeout reached before all games were finished.")
+
+
+if __name__ == '__main__':
+    main()
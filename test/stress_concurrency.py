@@ -0,0 +1,146 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Stress test of concurrent submissions into a single synchronous game.
+
+All players of the game submit their texts concurrently, each from its own thread, just like the Telegram frontend's
+handler threads do at the end of each round of a synchronous game. The stress test is run for each of the given
+concurrency modes (see `game.ConcurrencyMode`) and reports the throughput of submissions as well as the number of
+transaction retries and failed actions. Run it from the repository root with:
+
+    python -m test.stress_concurrency [--players 30] [--rounds 4] [--database mysql+mysqldb://...]
+
+The database must be empty. It defaults to a temporary SQLite database file.
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Dict, Any
+
+import sqlalchemy
+import sqlalchemy.engine
+
+from qaqa_bot import game, model
+from .util import CONFIG
+
+
+class RetryCounter(logging.Handler):
+    """ Logging handler to count the transaction retries, logged by `game.with_session` """
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.retries = 0
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if hasattr(record, 'transaction_retry'):
+            self.retries += 1
+
+
+def run(database: str, mode: game.ConcurrencyMode, num_players: int, rounds: int, timeout: float) -> Dict[str, Any]:
+    """ Play one synchronous game with `num_players` concurrently submitting players and return the statistics. """
+    engine_args = {}
+    if sqlalchemy.engine.make_url(database).get_backend_name() != 'sqlite':
+        engine_args['pool_size'] = num_players
+    engine = sqlalchemy.create_engine(database, isolation_level='SERIALIZABLE', **engine_args)
+    model.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(model.User.__table__.insert(),
+                           [{'api_id': i, 'chat_id': 1000 + i, 'first_name': "Player {}".format(i)}
+                            for i in range(num_players)])
+    game_server = game.GameServer({**CONFIG, 'game': {'concurrency': mode.value}}, engine)
+
+    game_server.new_game(-1, "Stress Test Group")
+    for i in range(num_players):
+        game_server.join_game(-1, i)
+    game_server.set_rounds(-1, rounds)
+
+    barrier = threading.Barrier(num_players + 1)
+    lock = threading.Lock()
+    stats = {'actions': 0, 'failures': 0, 'submissions': 0}
+
+    def play(chat_id: int) -> None:
+        barrier.wait()
+        deadline = time.monotonic() + timeout
+        message_id = 0
+        submitted = 0
+        while submitted < rounds and time.monotonic() < deadline:
+            message_id += 1
+            try:
+                result = game_server.submit_text(chat_id, message_id, "Text {} by {}".format(message_id, chat_id))
+            except Exception:
+                with lock:
+                    stats['actions'] += 1
+                    stats['failures'] += 1
+                continue
+            with lock:
+                stats['actions'] += 1
+            if game.TranslatedMessage(chat_id, "🆗") in result:
+                submitted += 1
+                with lock:
+                    stats['submissions'] += 1
+            else:
+                # We are waiting for the next round
+                time.sleep(0.002)
+
+    retry_counter = RetryCounter()
+    game_logger = logging.getLogger(game.__name__)
+    game_logger.addHandler(retry_counter)
+    game_logger.setLevel(logging.INFO)
+    threads = [threading.Thread(target=play, args=(1000 + i,)) for i in range(num_players)]
+    for thread in threads:
+        thread.start()
+    game_server.start_game(-1)
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    game_logger.removeHandler(retry_counter)
+
+    model.Base.metadata.drop_all(engine)
+    engine.dispose()
+    return {**stats, 'retries': retry_counter.retries, 'duration': duration,
+            'throughput': stats['submissions'] / duration}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=30, help="Number of players (and threads)")
+    parser.add_argument('--rounds', type=int, default=4, help="Number of rounds to play")
+    parser.add_argument('--database', help="SQLAlchemy database URL. Must point to an empty database. Defaults to a "
+                                           "temporary SQLite database file.")
+    parser.add_argument('--modes', nargs='+', default=[mode.value for mode in game.ConcurrencyMode],
+                        choices=[mode.value for mode in game.ConcurrencyMode],
+                        help="Concurrency modes to test")
+    parser.add_argument('--timeout', type=float, default=120, help="Timeout per player thread in seconds")
+    args = parser.parse_args()
+    # Only print errors, even though we need to enable INFO logging of the GameServer to count the retries
+    log_handler = logging.StreamHandler()
+    log_handler.setLevel(logging.ERROR)
+    logging.getLogger().addHandler(log_handler)
+
+    print("{:>14}{:>14}{:>12}{:>10}{:>10}{:>10}{:>12}".format(
+        "mode", "submissions", "duration", "actions", "retries", "failures", "subm./s"))
+    for mode in args.modes:
+        with tempfile.TemporaryDirectory() as tempdir:
+            database = args.database or "sqlite:///" + os.path.join(tempdir, "stress.db")
+            result = run(database, game.ConcurrencyMode(mode), args.players, args.rounds, args.timeout)
+        print("{:>14}{:>14}{:>11.2f}s{:>10}{:>10}{:>10}{:>12.1f}".format(
+            mode, result['submissions'], result['duration'], result['actions'], result['retries'], result['failures'],
+            result['throughput']))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,13 +21,15 @@ from .util import CONFIG, create_sample_users
 
 
 class FullGameTests(unittest.TestCase):
+    config = CONFIG
+
     def setUp(self) -> None:
         # Setup database schema
         engine = sqlalchemy.create_engine(CONFIG['database']['connection'], isolation_level='SERIALIZABLE', echo=True)
         model.Base.metadata.create_all(engine)
         create_sample_users(engine)
 
-        self.game_server = game.GameServer(CONFIG, engine)
+        self.game_server = game.GameServer(self.config, engine)
 
     TEXT_SUBMIT_RESPONSE = r"🆗"
 
@@ -60,6 +62,43 @@ class FullGameTests(unittest.TestCase):
         self.assertMessagesCorrect(msgs,
                                    {21: re.compile("one of the last two participants")})
 
+    def test_leave_running_game(self) -> None:
+        self.game_server.new_game(21, "Funny Group")
+        for user_id in (1, 2, 3, 4):
+            self.game_server.join_game(21, user_id)
+        self.game_server.set_rounds(21, 2)
+        self.game_server.start_game(21)
+        # Lukas leaves the synchronous game after his submission in the first round
+        self.assertMessagesEqual(self.game_server.submit_text(13, 1, "Question 3"), {13: ["🆗"]})
+        self.assertMessagesEqual(self.game_server.leave_game(21, 3), {21: ["👋 Bye!"]})
+        # Jannik leaves the game with his current sheet. He cannot submit to it afterwards.
+        self.assertMessagesEqual(self.game_server.leave_game(21, 4),
+                                 {21: ["👋 Bye!"],
+                                  14: ["You left the game. No answer required anymore."]})
+        self.assertMessagesEqual(self.game_server.submit_text(14, 2, "Question 4"), {14: ["Unexpected message."]})
+        # Lukas' sheet is passed on at the end of the round, though he has left the game: Michael gets it as second
+        # sheet, since he has the fewest sheets assigned in this round
+        self.assertMessagesEqual(self.game_server.submit_text(11, 3, "Question 1"), {11: ["🆗"]})
+        self.assertMessagesEqual(self.game_server.submit_text(12, 4, "Question 2"),
+                                 {11: ["Please answer the following question:\n“Question 2”"],
+                                  12: ["🆗", "Please answer the following question:\n“Question 1”"]})
+        self.assertMessagesEqual(self.game_server.get_user_status(11),
+                                 {11: ["You are currently participating in the following games: Funny Group\n\n"
+                                       "You have currently 2 pending sheets to ask or answer questions, including the "
+                                       "current one.",
+                                       "Please answer the following question:\n“Question 2”"]})
+        self.assertMessagesEqual(self.game_server.submit_text(11, 5, "Answer 2"),
+                                 {11: ["🆗", "Please answer the following question:\n“Question 3”"]})
+        self.assertMessagesEqual(self.game_server.submit_text(12, 6, "Answer 1"), {12: ["🆗"]})
+        msgs = self.game_server.submit_text(11, 7, "Answer 3")
+        self.assertMessagesCorrect(msgs, {11: re.compile("^🆗$"), 21: re.compile("^Game finished")})
+        self.assertEqual(2, len(msgs))
+
+    def test_leave_pending_game_as_last_participant(self) -> None:
+        self.game_server.new_game(21, "Funny Group")
+        self.game_server.join_game(21, 1)
+        self.assertMessagesEqual(self.game_server.leave_game(21, 1), {21: ["👋 Bye!"]})
+
     def test_simple_game(self) -> None:
         # Create new game in "Funny Group" chat (chat_id=21)
         self.game_server.new_game(21, "Funny Group")
@@ -116,6 +155,7 @@ class FullGameTests(unittest.TestCase):
              21: re.compile("example.com:9090/game/")})
         msgs = self.game_server.edit_submitted_message(13, 10, "Answer A3")
         self.assertMessagesCorrect(msgs, {13: re.compile(r"not accepted")})
+        self.assertSheetProgressConsistent()
 
     def test_asynchronous_game(self):
         # Create new game in "Funny Group" chat (chat_id=21)
@@ -263,9 +303,37 @@ class FullGameTests(unittest.TestCase):
         msgs = self.game_server.get_group_status(21)
         self.assertMessagesCorrect(msgs, {21: re.compile(r"(?s)Michael(?!.*Jenny.*Lukas.*Jannik)")})
 
+    def assertSheetProgressConsistent(self) -> None:
+        """ Check that the denormalized progress columns of all sheets match their actual entries. """
+        session = self.game_server.session_maker()
+        try:
+            for sheet in session.query(model.Sheet):
+                self.assertEqual(len(sheet.entries), sheet.num_entries)
+                self.assertEqual([e.position for e in sheet.entries], list(range(sheet.num_entries)))
+                last_entry = sheet.entries[-1] if sheet.entries else None
+                self.assertIs(last_entry, sheet.last_entry)
+                self.assertEqual(last_entry.type if last_entry else None, sheet.last_entry_type)
+        finally:
+            session.close()
+
     def assertMessagesCorrect(self, messages: List[game.TranslatedMessage], expected: Dict[int, Pattern]) -> None:
         for message in messages:
             self.assertIn(message.chat_id, expected, f"Message \"{message.text}\" to chat id {message.chat_id}")
             self.assertRegex(message.text, expected[message.chat_id])
         for chat in expected:
             self.assertIn(chat, list(m.chat_id for m in messages), f"No message to chat {chat} found")
+
+    def assertMessagesEqual(self, messages: List[game.TranslatedMessage], expected: Dict[int, List[str]]) -> None:
+        """ Check that exactly the expected messages (in the given order per chat) are sent to each chat """
+        actual: Dict[int, List[str]] = {}
+        for message in messages:
+            actual.setdefault(message.chat_id, []).append(message.text)
+        self.assertEqual(expected, actual)
+
+
+class ProcessLockFullGameTests(FullGameTests):
+    config = {**CONFIG, 'game': {'concurrency': 'process_lock'}}
+
+
+class RowLockFullGameTests(FullGameTests):
+    config = {**CONFIG, 'game': {'concurrency': 'row_lock'}}
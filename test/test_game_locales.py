@@ -0,0 +1,61 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import unittest
+
+import sqlalchemy
+
+from qaqa_bot import model, game
+from qaqa_bot.util import GetNoText
+from .util import CONFIG, create_sample_users
+
+
+class LocaleCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        engine = sqlalchemy.create_engine(CONFIG['database']['connection'], isolation_level='SERIALIZABLE')
+        model.Base.metadata.create_all(engine)
+        create_sample_users(engine)
+        self.game_server = game.GameServer(CONFIG, engine)
+        self.queries = []
+        sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                                lambda _conn, _cursor, statement, *args: self.queries.append(statement))
+
+    def locale_queries(self) -> int:
+        result = sum(1 for q in self.queries if 'FROM selected_locales' in q)
+        self.queries.clear()
+        return result
+
+    def get_locales(self, *chat_ids: int):
+        session = self.game_server.session_maker()
+        try:
+            return self.game_server._get_locales(chat_ids, session)
+        finally:
+            session.close()
+
+    def test_negative_caching(self) -> None:
+        self.assertEqual({11: None, 12: None}, self.get_locales(11, 12))
+        self.assertEqual(1, self.locale_queries())
+        self.assertEqual({11: None, 12: None}, self.get_locales(11, 12))
+        self.assertEqual(0, self.locale_queries())
+        self.assertEqual(2, self.game_server.locale_cache.hits)
+        self.assertEqual(2, self.game_server.locale_cache.misses)
+
+    def test_write_through(self) -> None:
+        self.game_server.translate_string(GetNoText("foo"), 11)
+        self.game_server.set_chat_locale(11, 'de')
+        self.assertEqual({11: 'de'}, self.get_locales(11))
+        # Without override, an existing locale is kept
+        self.game_server.set_chat_locale(11, 'en')
+        self.assertEqual({11: 'de'}, self.get_locales(11))
+        self.game_server.set_chat_locale(11, 'fr', override=True)
+        self.locale_queries()
+        self.assertEqual({11: 'fr'}, self.get_locales(11))
+        self.assertEqual(0, self.locale_queries())
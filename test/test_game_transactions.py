@@ -0,0 +1,115 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import sqlite3
+import unittest
+
+import sqlalchemy
+import sqlalchemy.exc
+import sqlalchemy.orm.exc
+
+from qaqa_bot import model, game
+from qaqa_bot.metrics import InMemorySink
+from qaqa_bot.util import is_retryable_error, RetryPolicy, engine_isolation_level
+from .util import CONFIG
+
+
+class FakeDriverError(Exception):
+    def __init__(self, *args, pgcode=None):
+        super().__init__(*args)
+        self.pgcode = pgcode
+
+
+def db_error(orig: Exception) -> sqlalchemy.exc.OperationalError:
+    return sqlalchemy.exc.OperationalError("SELECT 1", {}, orig)
+
+
+class FlakyGameServer(game.GameServer):
+    """ A GameServer with an additional action, which fails with the given exceptions before succeeding """
+    def __init__(self, *args, errors, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = list(errors)
+        self.calls = 0
+
+    @game.with_session
+    def flaky_action(self, session) -> int:
+        session.query(model.Game).count()
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.calls
+
+
+class RetryTest(unittest.TestCase):
+    def test_classifier(self) -> None:
+        self.assertTrue(is_retryable_error(db_error(FakeDriverError(1213, "Deadlock found")), 'mysql'))
+        self.assertFalse(is_retryable_error(db_error(FakeDriverError(1146, "Table doesn't exist")), 'mysql'))
+        self.assertTrue(is_retryable_error(db_error(FakeDriverError(pgcode='40001')), 'postgresql'))
+        self.assertTrue(is_retryable_error(db_error(FakeDriverError(pgcode='40P01')), 'postgresql'))
+        self.assertFalse(is_retryable_error(db_error(FakeDriverError(pgcode='23505')), 'postgresql'))
+        self.assertTrue(is_retryable_error(db_error(sqlite3.OperationalError("database is locked")), 'sqlite'))
+        self.assertFalse(is_retryable_error(db_error(sqlite3.OperationalError("no such table")), 'sqlite'))
+        self.assertFalse(is_retryable_error(db_error(sqlite3.OperationalError("database is locked")), 'oracle'))
+        self.assertFalse(is_retryable_error(ValueError("database is locked"), 'sqlite'))
+
+    def test_classifier_stale_data(self) -> None:
+        # Stale data is only retried, if the database cannot report the conflicting transaction itself
+        stale = sqlalchemy.orm.exc.StaleDataError("0 rows matched")
+        self.assertTrue(is_retryable_error(stale, 'sqlite', 'SERIALIZABLE'))
+        self.assertTrue(is_retryable_error(stale, 'postgresql', 'READ COMMITTED'))
+        self.assertTrue(is_retryable_error(stale, 'mysql', None))
+        self.assertFalse(is_retryable_error(stale, 'postgresql', 'SERIALIZABLE'))
+        self.assertFalse(is_retryable_error(stale, 'mysql', 'SERIALIZABLE'))
+
+        self.assertEqual('SERIALIZABLE', engine_isolation_level(
+            sqlalchemy.create_engine('sqlite://', isolation_level='SERIALIZABLE')))
+        self.assertEqual('READ COMMITTED', engine_isolation_level(
+            sqlalchemy.create_engine('sqlite://', execution_options={'isolation_level': 'READ COMMITTED'})))
+        self.assertIsNone(engine_isolation_level(sqlalchemy.create_engine('sqlite://')))
+
+    def test_backoff(self) -> None:
+        policy = RetryPolicy(base_delay=0.1, max_delay=0.5)
+        for _i in range(100):
+            self.assertLessEqual(policy.delay(1), 0.1)
+            self.assertLessEqual(policy.delay(3), 0.4)
+            self.assertLessEqual(policy.delay(10), 0.5)
+        self.assertEqual(RetryPolicy(max_attempts=3, time_budget=10.0),
+                         RetryPolicy.from_config({'retry_max_attempts': 3, 'concurrency': 'retry'}))
+
+    def create_game_server(self, errors, **retry_config) -> FlakyGameServer:
+        engine = sqlalchemy.create_engine(CONFIG['database']['connection'], isolation_level='SERIALIZABLE')
+        model.Base.metadata.create_all(engine)
+        config = {**CONFIG, 'game': {'retry_base_delay': 0.001, **retry_config}}
+        self.sink = InMemorySink()
+        return FlakyGameServer(config, engine, errors=errors, metrics_sink=self.sink)
+
+    def test_retry(self) -> None:
+        game_server = self.create_game_server([db_error(sqlite3.OperationalError("database is locked"))] * 2)
+        with self.assertLogs(game.logger, 'INFO') as logs:
+            self.assertEqual(3, game_server.flaky_action())
+        retries = [record.transaction_retry for record in logs.records if hasattr(record, 'transaction_retry')]
+        self.assertEqual([('flaky_action', 2), ('flaky_action', 3)], [(r.action, r.attempt) for r in retries])
+        self.assertEqual([('flaky_action', 3, True)], [(s.action, s.attempts, s.success) for s in self.sink.samples])
+        self.assertEqual(2, game_server.metrics.counter('qaqa_action_retries_total', action='flaky_action').value)
+
+    def test_give_up(self) -> None:
+        game_server = self.create_game_server([db_error(sqlite3.OperationalError("database is locked"))] * 5,
+                                              retry_max_attempts=3)
+        with self.assertRaises(sqlalchemy.exc.OperationalError):
+            game_server.flaky_action()
+        self.assertEqual(3, game_server.calls)
+        self.assertEqual([('flaky_action', 3, False)], [(s.action, s.attempts, s.success) for s in self.sink.samples])
+
+    def test_no_retry(self) -> None:
+        game_server = self.create_game_server([db_error(sqlite3.OperationalError("no such table"))])
+        with self.assertRaises(sqlalchemy.exc.OperationalError):
+            game_server.flaky_action()
+        self.assertEqual(1, game_server.calls)
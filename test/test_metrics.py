@@ -0,0 +1,87 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import unittest
+import unittest.mock
+
+import sqlalchemy
+
+from qaqa_bot import model, game
+from qaqa_bot.metrics import Histogram, MetricsRegistry, InMemorySink
+from .util import CONFIG, create_sample_users
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram(self) -> None:
+        histogram = Histogram((0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual((2, 3, 4), snapshot.counts)
+        self.assertEqual(4, snapshot.count)
+        self.assertAlmostEqual(2.65, snapshot.sum)
+
+    def test_registry(self) -> None:
+        registry = MetricsRegistry()
+        counter = registry.counter('foo_total', "Foo", action='a')
+        self.assertIs(counter, registry.counter('foo_total', action='a'))
+        self.assertIsNot(counter, registry.counter('foo_total', action='b'))
+        registry.histogram('bar_seconds')
+        with self.assertRaises(ValueError):
+            registry.counter('bar_seconds')
+        families = registry.collect()
+        self.assertEqual(['bar_seconds', 'foo_total'], [f.name for f in families])
+        self.assertEqual([(('action', 'a'),), (('action', 'b'),)], [labels for labels, _ in families[1].metrics])
+
+
+class ActionMetricsTest(unittest.TestCase):
+    def setUp(self) -> None:
+        engine = sqlalchemy.create_engine(CONFIG['database']['connection'], isolation_level='SERIALIZABLE')
+        model.Base.metadata.create_all(engine)
+        create_sample_users(engine)
+        self.sink = InMemorySink()
+        self.game_server = game.GameServer(CONFIG, engine, metrics_sink=self.sink)
+        self.statements = 0
+        sqlalchemy.event.listen(engine, 'after_cursor_execute', self.count_statement)
+
+    def count_statement(self, *_args) -> None:
+        self.statements += 1
+
+    def test_action_samples(self) -> None:
+        self.game_server.new_game(21, "Funny Group")
+        self.game_server.join_game(21, 1)
+        self.assertEqual(['new_game', 'join_game'], [s.action for s in self.sink.samples])
+        for sample in self.sink.samples:
+            self.assertEqual(1, sample.attempts)
+            self.assertTrue(sample.success)
+            self.assertGreater(sample.db_time, 0)
+            self.assertGreaterEqual(sample.wall_time, sample.db_time)
+        self.assertEqual(self.statements, sum(s.statements for s in self.sink.samples))
+
+        # Statements outside of GameServer actions must not be counted
+        with self.game_server.database_engine.connect() as connection:
+            connection.execute(sqlalchemy.select([model.Game.id]))
+        self.game_server.join_game(21, 2)
+        self.assertEqual(self.statements - 1, sum(s.statements for s in self.sink.samples))
+
+        histogram = self.game_server.metrics.histogram('qaqa_action_duration_seconds', action='join_game')
+        self.assertEqual(2, histogram.snapshot().count)
+
+    def test_failing_sink(self) -> None:
+        # Errors of the metrics sink must neither hide the action's result nor its exception
+        with unittest.mock.patch.object(self.sink, 'record_action', side_effect=RuntimeError("sink down")):
+            with self.assertLogs('qaqa_bot.game', 'ERROR'):
+                messages = self.game_server.new_game(21, "Funny Group")
+            self.assertTrue(messages)
+            with self.assertLogs('qaqa_bot.game', 'ERROR'), \
+                    unittest.mock.patch.object(game.GameServer, '_get_translations', side_effect=KeyError("boom")):
+                with self.assertRaises(KeyError):
+                    self.game_server.join_game(21, 1)
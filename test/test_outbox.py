@@ -0,0 +1,186 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import datetime
+import sqlite3
+import time
+import unittest
+from typing import List
+
+import sqlalchemy
+import sqlalchemy.exc
+
+from qaqa_bot import model, game
+from qaqa_bot.outgoing import OutboxDispatcher, OutboxEntry
+from qaqa_bot.util import session_scope
+from .util import CONFIG, create_sample_users
+
+OUTBOX_CONFIG = {**CONFIG, 'game': {'outbox': True, 'outbox_batch_size': 3, 'outbox_max_attempts': 2,
+                                    'outbox_retry_base_delay': 0}}
+
+
+class FailingGameServer(game.GameServer):
+    """ A GameServer with additional actions, which send messages via the outbox: One of them fails before committing
+    the first time """
+    calls = 0
+
+    @game.with_session
+    @game.via_outbox
+    def send_messages(self, session, messages: List[game.Message]) -> List[game.TranslatedMessage]:
+        return self._get_translations(messages, session)
+
+    @game.with_session
+    @game.via_outbox
+    def failing_action(self, session) -> List[game.TranslatedMessage]:
+        self.calls += 1
+        if self.calls == 1:
+            session.flush()
+            raise sqlalchemy.exc.OperationalError("SELECT 1", {}, sqlite3.OperationalError("database is locked"))
+        return [game.TranslatedMessage(11, "Hello")]
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.engine = sqlalchemy.create_engine(CONFIG['database']['connection'])
+        model.Base.metadata.create_all(self.engine)
+        create_sample_users(self.engine)
+        self.game_server = FailingGameServer(OUTBOX_CONFIG, self.engine)
+        self.delivered: List[OutboxEntry] = []
+        self.dispatcher = OutboxDispatcher(self.game_server, self.delivered.extend)
+
+    def outbox(self) -> List[model.OutboxMessage]:
+        with session_scope(self.game_server.session_maker) as session:
+            messages = session.query(model.OutboxMessage).order_by(model.OutboxMessage.id).all()
+            session.expunge_all()
+            return messages
+
+    def test_write_in_transaction(self) -> None:
+        notifications = []
+        self.game_server.outbox_notify = lambda: notifications.append(True)
+        self.assertEqual([], self.game_server.new_game(-1, "Test Group"))
+        self.assertEqual([], self.game_server.join_game(-1, 1))
+        texts = [(m.chat_id, m.text) for m in self.outbox()]
+        self.assertEqual(2, len(texts))
+        self.assertTrue(all(chat_id == -1 for chat_id, _text in texts))
+        self.assertEqual(2, len(notifications))
+        # Actions without messages don't notify the dispatcher
+        self.assertEqual([], self.game_server.send_messages([]))
+        self.assertEqual(2, len(notifications))
+
+        # The messages of the failed attempt are rolled back, the retried one is written only once
+        self.assertEqual([], self.game_server.failing_action())
+        self.assertEqual(2, self.game_server.calls)
+        messages = self.outbox()
+        self.assertEqual(3, len(messages))
+        self.assertEqual((11, "Hello"), (messages[-1].chat_id, messages[-1].text))
+        self.assertEqual(3, len(set(m.idempotency_key for m in messages)))
+
+        # Replies of actions, which don't change a game, are returned directly
+        self.assertEqual([game.TranslatedMessage(11, "Hello")],
+                         self.game_server.get_translations([game.Message(11, game.GetNoText("Hello"))]))
+        self.assertEqual(3, len(self.outbox()))
+        # Non-message results are returned unchanged
+        self.assertEqual("Hello", self.game_server.translate_string(game.GetNoText("Hello"), 11))
+
+    def test_dispatch(self) -> None:
+        for i in range(4):
+            self.game_server.send_messages([game.Message(11 + i % 2, game.GetNoText("Message {}".format(i)))])
+        self.assertEqual(3, self.dispatcher.run_once())
+        self.assertEqual(["Message 0", "Message 1", "Message 2"], [e.text for e in self.delivered])
+        # No more messages are claimed, until the delivered ones have been acknowledged
+        self.assertEqual(0, self.dispatcher.run_once())
+        for entry in self.delivered:
+            self.dispatcher.acknowledge(entry, True)
+        self.assertEqual(1, self.dispatcher.run_once())
+        self.assertEqual("Message 3", self.delivered[-1].text)
+        self.dispatcher.acknowledge(self.delivered[-1], True)
+        self.dispatcher.run_once()
+
+        messages = self.outbox()
+        self.assertTrue(all(m.sent is not None and m.attempts == 1 for m in messages))
+        self.assertEqual(4, self.game_server.metrics.counter('qaqa_outbox_sent_total').value)
+
+    def test_retries(self) -> None:
+        self.game_server.send_messages([game.Message(11, game.GetNoText("Hello"))])
+        self.dispatcher.run_once()
+        self.dispatcher.acknowledge(self.delivered[0], False)
+        self.assertEqual(1, self.dispatcher.run_once())
+        self.assertEqual(2, len(self.delivered))
+        self.assertEqual(self.delivered[0], self.delivered[1])
+        self.dispatcher.acknowledge(self.delivered[1], False)
+        self.assertEqual(0, self.dispatcher.run_once())
+        message = self.outbox()[0]
+        self.assertEqual(2, message.attempts)
+        self.assertIsNotNone(message.failed)
+        self.assertIsNone(message.sent)
+
+    def test_lease_and_release(self) -> None:
+        self.game_server.send_messages([game.Message(11, game.GetNoText("Hello")),
+                                        game.Message(12, game.GetNoText("Hello"))])
+        self.dispatcher.run_once()
+        self.dispatcher.acknowledge(self.delivered[0], True)
+        self.dispatcher.stop()
+
+        # Another dispatcher does not claim the leased message
+        other_dispatcher = OutboxDispatcher(self.game_server, self.delivered.extend)
+        self.assertEqual(0, other_dispatcher.run_once())
+
+        # ... but after the message has been released
+        self.dispatcher.release()
+        self.assertEqual(1, other_dispatcher.run_once())
+        self.assertEqual(self.delivered[1], self.delivered[2])
+
+        other_dispatcher.acknowledge(self.delivered[2], True)
+        self.assertEqual(0, other_dispatcher.run_once())
+
+        # Already delivered messages are skipped by their idempotency key (e.g. if writing the acknowledgement failed)
+        with session_scope(self.game_server.session_maker) as session:
+            session.query(model.OutboxMessage)\
+                .filter(model.OutboxMessage.chat_id == 12)\
+                .update({model.OutboxMessage.sent: None,
+                         model.OutboxMessage.next_attempt: datetime.datetime(2020, 1, 1)})
+        self.assertEqual(1, other_dispatcher.run_once())
+        self.assertEqual(3, len(self.delivered))
+        self.assertEqual(1, self.game_server.metrics.counter('qaqa_outbox_duplicates_total').value)
+
+    def test_lease_renewal_while_queued(self) -> None:
+        # The message waits in the delivery queue (e.g. the MessageScheduler's rate limit) longer than the lease
+        config = {**OUTBOX_CONFIG, 'game': {**OUTBOX_CONFIG['game'], 'outbox_lease': 1.0}}
+        dispatcher = OutboxDispatcher(game.GameServer(config, self.engine), self.delivered.extend)
+        other_dispatcher = OutboxDispatcher(game.GameServer(config, self.engine), self.delivered.extend)
+        self.game_server.send_messages([game.Message(11, game.GetNoText("Hello"))])
+        self.assertEqual(1, dispatcher.run_once())
+        time.sleep(0.6)
+        dispatcher.run_once()
+        self.assertEqual(1, dispatcher.metrics.counter('qaqa_outbox_lease_renewals_total').value)
+        time.sleep(0.6)
+        # The initial lease has expired, but it has been renewed
+        self.assertEqual(0, other_dispatcher.run_once())
+        self.assertEqual(1, len(self.delivered))
+
+        # Without renewals (e.g. after a crash of the first dispatcher), the message is claimed again
+        time.sleep(1.1)
+        self.assertEqual(1, other_dispatcher.run_once())
+        self.assertEqual(2, len(self.delivered))
+
+    def test_cleanup(self) -> None:
+        self.game_server.send_messages([game.Message(11, game.GetNoText("Hello")),
+                                        game.Message(12, game.GetNoText("Hello"))])
+        self.dispatcher.run_once()
+        for entry in self.delivered:
+            self.dispatcher.acknowledge(entry, True)
+        self.dispatcher.run_once()
+        with session_scope(self.game_server.session_maker) as session:
+            session.query(model.OutboxMessage)\
+                .filter(model.OutboxMessage.chat_id == 11)\
+                .update({model.OutboxMessage.sent: datetime.datetime(2020, 1, 1)})
+        self.dispatcher.cleanup_interval = 0
+        self.dispatcher.run_once()
+        self.assertEqual([12], [m.chat_id for m in self.outbox()])
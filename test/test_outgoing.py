@@ -0,0 +1,162 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import threading
+import time
+import unittest
+from typing import List, Tuple, Any
+
+import sqlalchemy
+
+from qaqa_bot import bot, game, model
+from qaqa_bot.game import TranslatedMessage
+from qaqa_bot.outgoing import TokenBucket, RateLimits, MessageScheduler, coalesce_messages
+from .util import CONFIG
+
+
+class RetryAfter(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("Flood control exceeded")
+        self.retry_after = retry_after
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_bucket(self) -> None:
+        bucket = TokenBucket(2.0, 3, now=100.0)
+        for _i in range(3):
+            self.assertTrue(bucket.available(100.0))
+            bucket.consume(100.0)
+        self.assertFalse(bucket.available(100.0))
+        self.assertAlmostEqual(0.5, bucket.wait_time(100.0))
+        self.assertTrue(bucket.available(100.5))
+        self.assertFalse(bucket.is_full(101.0))
+        self.assertTrue(bucket.is_full(110.0))
+        self.assertEqual(3, bucket.tokens)
+        bucket.consume(110.0)
+        self.assertAlmostEqual(0.5, bucket.full_time(110.0))
+
+    def test_rate_limits_from_config(self) -> None:
+        limits = RateLimits.from_config({'username': "bot", 'send_group_rate': 1.5, 'send_global_burst': 10})
+        self.assertEqual(1.5, limits.group_rate)
+        self.assertEqual(10, limits.global_burst)
+        self.assertEqual(RateLimits().private_rate, limits.private_rate)
+
+
+class MessageSchedulerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sent: List[Tuple[float, int, Any]] = []
+        self.lock = threading.Lock()
+        self.failures = {}
+
+    def send(self, chat_id: int, message: Any) -> None:
+        time.sleep(0.002)
+        with self.lock:
+            if self.failures.get(message):
+                raise self.failures.pop(message)
+            self.sent.append((time.monotonic(), chat_id, message))
+
+    def run_scheduler(self, messages: List[Tuple[int, Any]], limits: RateLimits) -> float:
+        scheduler = MessageScheduler(self.send, limits, workers=4)
+        start = time.monotonic()
+        scheduler.start()
+        for chat_id, message in messages:
+            scheduler.submit(chat_id, message)
+        scheduler.stop(timeout=10)
+        self.assertEqual(0, scheduler.pending)
+        return start
+
+    def test_order_within_chat(self) -> None:
+        messages = [(chat_id, (chat_id, i)) for i in range(20) for chat_id in (1, 2, -3)]
+        self.run_scheduler(messages, RateLimits(1000, 1000, 1000, 1000, 1000, 1000))
+        self.assertEqual(len(messages), len(self.sent))
+        for chat_id in (1, 2, -3):
+            self.assertEqual([(chat_id, i) for i in range(20)],
+                             [message for _t, c, message in self.sent if c == chat_id])
+
+    def test_chat_rate_limits(self) -> None:
+        start = self.run_scheduler([(1, i) for i in range(5)] + [(-1, i) for i in range(3)],
+                                   RateLimits(1000, 1000, private_rate=50, private_burst=1, group_rate=10,
+                                              group_burst=2))
+        private_times = [t - start for t, chat_id, _m in self.sent if chat_id == 1]
+        group_times = [t - start for t, chat_id, _m in self.sent if chat_id == -1]
+        self.assertGreaterEqual(private_times[-1], 4 / 50)
+        self.assertGreaterEqual(group_times[-1], 1 / 10)
+        self.assertLess(group_times[1], 1 / 10)
+
+    def test_fairness(self) -> None:
+        # A busy group chat must not delay the messages to other chats until its backlog has been sent
+        messages = [(-1, i) for i in range(30)] + [(chat_id, "hi") for chat_id in range(1, 6)]
+        self.run_scheduler(messages, RateLimits(global_rate=100, global_burst=1, private_rate=100,
+                                                private_burst=100, group_rate=100, group_burst=100))
+        order = [chat_id for _t, chat_id, _m in self.sent]
+        self.assertEqual(35, len(order))
+        last_private = max(i for i, chat_id in enumerate(order) if chat_id > 0)
+        self.assertLess(last_private, 15)
+
+    def test_retry_after(self) -> None:
+        self.failures = {"b": RetryAfter(0.1)}
+        start = self.run_scheduler([(1, "a"), (1, "b"), (1, "c"), (2, "x")], RateLimits(1000, 1000, 1000, 1000))
+        self.assertEqual(["a", "b", "c"], [message for _t, chat_id, message in self.sent if chat_id == 1])
+        times = {message: t - start for t, _c, message in self.sent}
+        self.assertGreaterEqual(times["b"], 0.1)
+        self.assertLess(times["x"], 0.1)
+
+    def test_errors(self) -> None:
+        self.failures = {"b": RuntimeError("Forbidden: bot was blocked by the user")}
+        with self.assertLogs('qaqa_bot.outgoing', 'ERROR'):
+            self.run_scheduler([(1, "a"), (1, "b"), (1, "c")], RateLimits(1000, 1000, 1000, 1000))
+        self.assertEqual(["a", "c"], [message for _t, _c, message in self.sent])
+
+    def test_idle_chat_eviction(self) -> None:
+        now = [0.0]
+        scheduler = MessageScheduler(self.send, RateLimits(1000, 1000, private_rate=100, private_burst=1), workers=4,
+                                     clock=lambda: now[0])
+        scheduler.start()
+        try:
+            for chat_id in range(1, 251):
+                scheduler.submit(chat_id, "hi")
+            with scheduler._condition:
+                while scheduler.pending:
+                    scheduler._condition.wait()
+            self.assertEqual(250, len(scheduler._chats))
+            # All buckets are refilled after 1/100s, so the idle chats are evicted on the next submit
+            now[0] = 1.0
+            scheduler.submit(1000, "hi")
+            self.assertEqual([1000], list(scheduler._chats))
+        finally:
+            scheduler.stop(timeout=10)
+        self.assertEqual(251, len(self.sent))
+
+
+class CoalesceMessagesTest(unittest.TestCase):
+    def test_coalesce(self) -> None:
+        messages = [TranslatedMessage(-1, "Let's go!"), TranslatedMessage(1, "📝"), TranslatedMessage(1, "<b>Hi</b>"),
+                    TranslatedMessage(-1, "Foo"), TranslatedMessage(-1, "Bar"), TranslatedMessage(1, "Baz")]
+        self.assertEqual([TranslatedMessage(-1, "Let's go!"), TranslatedMessage(1, "📝\n\n<b>Hi</b>"),
+                          TranslatedMessage(-1, "Foo\n\nBar"), TranslatedMessage(1, "Baz")],
+                         coalesce_messages(messages))
+
+    def test_max_length(self) -> None:
+        # Emojis count as two UTF-16 code units
+        messages = [TranslatedMessage(1, "a" * 4000), TranslatedMessage(1, "😀" * 47), TranslatedMessage(1, "b"),
+                    TranslatedMessage(1, "c" * 5000), TranslatedMessage(1, "d")]
+        result = coalesce_messages(messages)
+        self.assertEqual(["a" * 4000 + "\n\n" + "😀" * 47, "b", "c" * 5000, "d"], [m.text for m in result])
+
+    def test_frontend_counter(self) -> None:
+        config = {**CONFIG, 'bot': {**CONFIG['bot'], 'api_key': "123456:TEST-TOKEN", 'coalesce_messages': True}}
+        engine = sqlalchemy.create_engine(CONFIG['database']['connection'])
+        model.Base.metadata.create_all(engine)
+        frontend = bot.Frontend(config, game.GameServer(config, engine))
+        frontend.send_messages([TranslatedMessage(1, "🆗"), TranslatedMessage(1, "Please answer"),
+                                TranslatedMessage(2, "🆗"), TranslatedMessage(2, "Please ask"),
+                                TranslatedMessage(2, "Thanks")])
+        self.assertEqual(2, frontend._message_queue.pending)
+        self.assertEqual(3, frontend.gs.metrics.counter('qaqa_message_coalesced_total').value)
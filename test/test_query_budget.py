@@ -0,0 +1,135 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+"""
+Regression tests for the number of SQL statements issued by each GameServer action.
+
+Each action is given a budget of SELECT statements and of writing statements (INSERT/UPDATE/DELETE), which must not
+be exceeded at any game size. Thus, a lazy-load of a relationship per player (N+1 queries) makes these tests fail. Only
+the INSERTs of new sheets at game start are allowed to scale with the number of players.
+"""
+
+import unittest
+from typing import Dict, List, NamedTuple, Any
+
+import sqlalchemy
+
+from qaqa_bot import model, game
+from .util import CONFIG, StatementCounter
+
+
+class Budget(NamedTuple):
+    selects: int
+    writes: int
+    #: Additional writing statements allowed per player
+    writes_per_player: int = 0
+
+
+BUDGETS: Dict[str, Budget] = {
+    'new_game': Budget(2, 1),
+    'join_game': Budget(4, 1),
+    'set_rounds': Budget(1, 1),
+    'set_synchronous': Budget(1, 1),
+    'start_game': Budget(5, 3, writes_per_player=1),
+    'submit_text': Budget(11, 7),  # incl. the check for duplicate messages
+    'edit_submitted_message': Budget(3, 1),
+    'get_group_status': Budget(3, 0),
+    'get_user_status': Budget(4, 0),
+    'shuffle_players': Budget(2, 1),
+    'leave_game': Budget(11, 3),
+    'stop_game': Budget(3, 4),
+    'immediately_stop_game': Budget(6, 4),  # incl. the result snapshot
+    'get_game_result_summary': Budget(2, 0),
+    'get_game_result_sheets': Budget(3, 0),  # one chunk, from the tables
+    'get_game_result': Budget(1, 0),  # from the result snapshot
+}
+
+GAME_SIZES = (2, 10, 50)
+
+
+class QueryBudgetTest(unittest.TestCase):
+    def _setup_game_server(self, num_players: int) -> None:
+        self.engine = sqlalchemy.create_engine(CONFIG['database']['connection'], isolation_level='SERIALIZABLE')
+        model.Base.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(model.User.__table__.insert(),
+                               [{'api_id': i, 'chat_id': 1000 + i, 'first_name': "Player {}".format(i)}
+                                for i in range(num_players)])
+        self.game_server = game.GameServer(CONFIG, self.engine)
+        self.statements: Dict[str, List[StatementCounter]] = {}
+
+    def _call(self, action: str, *args) -> Any:
+        with StatementCounter(self.engine) as counter:
+            result = getattr(self.game_server, action)(*args)
+        self.statements.setdefault(action, []).append(counter)
+        return result
+
+    def _play_game(self, num_players: int, synchronous: bool) -> None:
+        """ Play two games with all actions: The first one with a player leaving and a normal stop after the 4th
+        round (which is forced in asynchronous games), the second one is stopped immediately after the first
+        submission. """
+        self._call('new_game', -1, "Budget Test Group")
+        for i in range(num_players):
+            self._call('join_game', -1, i)
+        self._call('set_rounds', -1, 10)
+        self._call('set_synchronous', -1, synchronous)
+        self._call('get_group_status', -1)
+        self._call('start_game', -1)
+        for i in range(num_players):
+            self._call('submit_text', 1000 + i, 1, "Question {}".format(i))
+        self._call('edit_submitted_message', 1000, 1, "Edited question 0")
+        for i in range(num_players):
+            self._call('submit_text', 1000 + i, 2, "Answer {}".format(i))
+        self._call('get_group_status', -1)
+        self._call('get_user_status', 1000)
+        self._call('shuffle_players', -1)
+        self._call('leave_game', -1, num_players - 1)
+        for i in range(num_players - 1):
+            self._call('submit_text', 1000 + i, 3, "Question {}".format(i))
+        self._call('stop_game', -1)
+        for i in range(num_players - 1):
+            self._call('submit_text', 1000 + i, 4, "Answer {}".format(i))
+        self._call('immediately_stop_game', -1)
+        self._call('get_game_result_summary', 1)
+        self._call('get_game_result_sheets', 1, 0, 20)
+        self._call('get_game_result', 1)
+
+        # Another game, which is stopped immediately
+        self._call('new_game', -1, "Budget Test Group")
+        for i in range(num_players):
+            self._call('join_game', -1, i)
+        self._call('start_game', -1)
+        self._call('submit_text', 1000, 5, "Question")
+        self._call('immediately_stop_game', -1)
+
+    def _check_budgets(self, num_players: int) -> None:
+        for action, counters in self.statements.items():
+            budget = BUDGETS[action]
+            with self.subTest(action=action, players=num_players):
+                self.assertLessEqual(max(len(c.selects) for c in counters), budget.selects,
+                                     "\n\n".join(max(counters, key=lambda c: len(c.selects)).selects))
+                self.assertLessEqual(max(len(c.writes) for c in counters),
+                                     budget.writes + num_players * budget.writes_per_player,
+                                     "\n\n".join(max(counters, key=lambda c: len(c.writes)).writes))
+
+    def test_synchronous_game(self) -> None:
+        for num_players in GAME_SIZES:
+            self._setup_game_server(num_players)
+            self._play_game(num_players, True)
+            self._check_budgets(num_players)
+            self.engine.dispose()
+
+    def test_asynchronous_game(self) -> None:
+        for num_players in GAME_SIZES:
+            self._setup_game_server(num_players)
+            self._play_game(num_players, False)
+            self._check_budgets(num_players)
+            self.engine.dispose()
@@ -0,0 +1,173 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+
+import gettext
+import os.path
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from babel.messages.catalog import Catalog
+from babel.messages.mofile import write_mo
+
+from qaqa_bot.util import TranslationRegistry, LRUCache, PartitionedExecutor
+
+
+class TranslationRegistryTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.write_catalog('de', "Hallo")
+        self.registry = TranslationRegistry('qaqa_bot', self.tempdir.name)
+
+    def tearDown(self) -> None:
+        self.tempdir.cleanup()
+
+    def write_catalog(self, locale: str, translation: str) -> None:
+        catalog = Catalog(locale=locale)
+        catalog.add("Hello", translation)
+        directory = os.path.join(self.tempdir.name, locale, 'LC_MESSAGES')
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'qaqa_bot.mo'), 'wb') as fp:
+            write_mo(fp, catalog)
+
+    def test_caching(self) -> None:
+        translations = self.registry.get('de')
+        self.assertEqual("Hallo", translations.gettext("Hello"))
+        self.assertIs(translations, self.registry.get('de'))
+
+    def test_fallback(self) -> None:
+        self.assertEqual("Hallo", self.registry.get('de_DE').gettext("Hello"))
+        missing = self.registry.get('fr')
+        self.assertIsInstance(missing, gettext.NullTranslations)
+        self.assertEqual("Hello", missing.gettext("Hello"))
+        self.assertIs(missing, self.registry.get('fr'))
+        self.assertIs(missing, self.registry.get('xx'))
+        self.assertNotIn('fr', self.registry._catalogs)
+
+    def test_catalog_lookups(self) -> None:
+        # The filesystem is searched only once per matched locale, even without catalog for the default locale
+        with unittest.mock.patch('gettext.find', wraps=gettext.find) as find:
+            for _i in range(3):
+                for locale in ('de', 'en', 'de_DE', 'fr'):
+                    self.registry.get(self.registry.match(locale))
+        self.assertEqual(2, find.call_count)
+        self.assertEqual({'de', 'en'}, set(self.registry._catalogs))
+
+    def test_match(self) -> None:
+        self.assertEqual(frozenset({'de'}), self.registry.available_locales())
+        self.assertEqual('de', self.registry.match('de'))
+        self.assertEqual('de', self.registry.match('de_DE'))
+        self.assertEqual('en', self.registry.match('fr'))
+        self.assertEqual('en', self.registry.match('../../etc'))
+
+    def test_reload(self) -> None:
+        self.assertEqual("Hallo", self.registry.get('de').gettext("Hello"))
+        self.write_catalog('de', "Servus")
+        self.assertEqual("Hallo", self.registry.get('de').gettext("Hello"))
+        self.registry.reload()
+        self.assertEqual("Servus", self.registry.get('de').gettext("Hello"))
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_eviction(self) -> None:
+        cache = LRUCache(2)
+        cache.put(1, 'a')
+        cache.put(2, None)
+        self.assertEqual('a', cache.get(1))
+        cache.put(3, 'c')
+        self.assertIs(LRUCache.MISSING, cache.get(2))
+        self.assertIsNone(cache.get(2, None))
+        self.assertEqual(({1: 'a', 3: 'c'}, [4]), cache.get_many([1, 3, 4]))
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(3, cache.misses)
+
+    def test_fill(self) -> None:
+        cache = LRUCache(10)
+        token = cache.fill_token()
+        cache.fill({1: 'a', 2: None}, token)
+        self.assertEqual(({1: 'a', 2: None}, []), cache.get_many([1, 2]))
+        # A fill with outdated values must not overwrite concurrent updates
+        token = cache.fill_token()
+        cache.put(1, 'b')
+        cache.fill({1: 'a', 3: 'c'}, token)
+        self.assertEqual(({1: 'b'}, [3]), cache.get_many([1, 3]))
+        cache.invalidate(1)
+        self.assertIs(LRUCache.MISSING, cache.get(1))
+
+
+class PartitionedExecutorTest(unittest.TestCase):
+    def test_ordering(self) -> None:
+        executor = PartitionedExecutor(4, 100)
+        executor.start()
+        results = []
+        lock = threading.Lock()
+        running = set()
+        overlaps = []
+
+        def task(key, i):
+            with lock:
+                if key in running:
+                    overlaps.append(key)
+                running.add(key)
+            time.sleep(0.001)
+            with lock:
+                running.discard(key)
+                results.append((key, i))
+        for i in range(20):
+            for key in ('a', 'b', 'c'):
+                executor.submit(key, task, key, i)
+        executor.shutdown()
+        self.assertEqual([], overlaps)
+        for key in ('a', 'b', 'c'):
+            self.assertEqual(list(range(20)), [i for k, i in results if k == key])
+        self.assertEqual(0, executor.pending)
+
+    def test_parallel_partitions(self) -> None:
+        # A blocked partition must not block the others
+        executor = PartitionedExecutor(2, 100)
+        executor.start()
+        blocker = threading.Event()
+        done = threading.Event()
+        executor.submit(1, blocker.wait)
+        executor.submit(1, lambda: None)
+        executor.submit(2, done.set)
+        self.assertTrue(done.wait(5))
+        self.assertEqual(2, executor.pending)
+        blocker.set()
+        executor.shutdown()
+
+    def test_backpressure(self) -> None:
+        executor = PartitionedExecutor(1, 2)
+        blocker = threading.Event()
+        executor.submit(1, blocker.wait)
+        executor.submit(2, lambda: None)
+        submitted = threading.Event()
+        thread = threading.Thread(target=lambda: (executor.submit(3, lambda: None), submitted.set()))
+        thread.start()
+        self.assertFalse(submitted.wait(0.1))
+        executor.start()
+        blocker.set()
+        self.assertTrue(submitted.wait(5))
+        thread.join()
+        executor.shutdown()
+        self.assertEqual(1, executor.blocked_submissions)
+
+    def test_errors(self) -> None:
+        errors = []
+        executor = PartitionedExecutor(1, 10, error_callback=errors.append)
+        executor.start()
+        executor.submit(1, int, "x")
+        executor.submit(1, int, "1")
+        executor.shutdown()
+        self.assertEqual(1, len(errors))
+        self.assertIsInstance(errors[0], ValueError)
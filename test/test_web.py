@@ -8,17 +8,24 @@
 # Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
 # "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
 # specific language governing permissions and limitations under the License.
+import datetime
+import gzip
+import os
 import re
+import tempfile
 import unittest
+import unittest.mock
 from typing import List, Optional
 
 import sqlalchemy
 import sqlalchemy.orm
 import cherrypy
+import webob
 from webtest import TestApp
 
 from qaqa_bot import model, game, web
-from .util import CONFIG, create_sample_users
+from qaqa_bot.util import session_scope
+from .util import CONFIG, create_sample_users, use_compiled_catalogs
 
 
 class TestWeb(unittest.TestCase):
@@ -34,7 +41,8 @@ class TestWeb(unittest.TestCase):
         cherrypy.server.unsubscribe()
         cherrypy.engine.start()
 
-        self.wsgiapp = cherrypy.tree.mount(web.WebRoot(web.WebEnvironment(CONFIG, self.game_server)))
+        self.env = web.WebEnvironment(CONFIG, self.game_server)
+        self.wsgiapp = cherrypy.tree.mount(web.WebRoot(self.env))
         self.app = TestApp(self.wsgiapp)
 
     def tearDown(self) -> None:
@@ -91,3 +99,318 @@ class TestWeb(unittest.TestCase):
         resp = resp.click(href=re.compile(r'/game/(?!.*authors=1)'), index=0)
         resp.mustcontain("Question 1")
         resp.mustcontain(no=["Michael"])
+
+    def test_metrics(self) -> None:
+        result_path = self._find_result_url(self._simple_sample_game(), 21)
+        self.app.get(result_path)
+        # Metrics are disabled without token
+        self.app.get('/metrics', status=404)
+
+        cherrypy.tree.apps.clear()
+        config = {**CONFIG, 'web': {**CONFIG['web'], 'metrics_token': "s3cr3t"}}
+        app = TestApp(cherrypy.tree.mount(web.WebRoot(web.WebEnvironment(config, self.game_server))))
+        app.get('/metrics', status=401)
+        app.get('/metrics', headers={'Authorization': "Bearer wrong"}, status=401)
+        resp = app.get('/metrics', headers={'Authorization': "Bearer s3cr3t"})
+        self.assertEqual("text/plain", resp.content_type)
+        resp.mustcontain('# TYPE qaqa_action_duration_seconds histogram',
+                         'qaqa_action_duration_seconds_bucket{action="submit_text",le="+Inf"} 6',
+                         'qaqa_action_retries_total{action="submit_text"} 0.0')
+
+        # Without token, but via the separate metrics application, which serves nothing else
+        cherrypy.tree.apps.clear()
+        config = {**CONFIG, 'web': {**CONFIG['web'], 'metrics_socket_port': 9091}}
+        env = web.WebEnvironment(config, self.game_server)
+        app = TestApp(cherrypy.tree.mount(web.WebRoot(env)))
+        app.get('/metrics', status=404)
+        app.get('/metrics', extra_environ={'SERVER_PORT': '9091'}, status=404)
+        metrics_app = TestApp(cherrypy.Application(web.MetricsRoot(env), ''))
+        resp = metrics_app.get('/metrics')
+        resp.mustcontain('qaqa_web_render_seconds_count{template="game_result.mako.html"}')
+        metrics_app.get('/', status=404)
+        metrics_app.get(result_path, status=404)
+
+    def test_result_cache(self) -> None:
+        use_compiled_catalogs(self)
+        self.env.update_render_version()
+        result_path = self._find_result_url(self._simple_sample_game(), 21)
+        resp = self.app.get(result_path)
+        etag = resp.headers['ETag']
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('Last-Modified', resp.headers)
+        body = resp.body
+
+        # Subsequent (conditional) requests are served without accessing the database
+        with unittest.mock.patch.object(self.game_server, 'get_game_result', side_effect=AssertionError):
+            resp = self.app.get(result_path)
+            self.assertEqual(body, resp.body)
+            self.assertEqual(etag, resp.headers['ETag'])
+            self.app.get(result_path, headers={'If-None-Match': etag}, status=304)
+            self.app.get(result_path, headers={'If-Modified-Since': resp.headers['Last-Modified']}, status=304)
+            self.app.get(result_path, headers={'If-None-Match': '"other"'}, status=200)
+
+        # Other languages are cached separately
+        resp = self.app.get(result_path.replace("lang=en", "lang=de"))
+        self.assertNotEqual(etag, resp.headers['ETag'])
+
+        # Unknown languages are served (and cached) as English
+        misses = self.env.result_cache.misses
+        with unittest.mock.patch.object(self.game_server, 'get_game_result', side_effect=AssertionError):
+            resp = self.app.get(result_path.replace("lang=en", "lang=xx"))
+            self.assertEqual(body, resp.body)
+            self.assertEqual(etag, resp.headers['ETag'])
+        self.assertEqual(misses, self.env.result_cache.misses)
+
+    def test_result_cache_on_disk(self) -> None:
+        result_path = self._find_result_url(self._simple_sample_game(), 21)
+        with tempfile.TemporaryDirectory() as tempdir:
+            cherrypy.tree.apps.clear()
+            config = {**CONFIG, 'web': {**CONFIG['web'], 'result_cache_dir': tempdir}}
+            resp = TestApp(cherrypy.tree.mount(web.WebRoot(web.WebEnvironment(config, self.game_server)))) \
+                .get(result_path)
+
+            # A new WebEnvironment (e.g. after a restart) finds the page on disk
+            cherrypy.tree.apps.clear()
+            with unittest.mock.patch.object(self.game_server, 'get_game_result', side_effect=AssertionError):
+                app = TestApp(cherrypy.tree.mount(web.WebRoot(web.WebEnvironment(config, self.game_server))))
+                resp2 = app.get(result_path)
+            self.assertEqual(resp.body, resp2.body)
+            self.assertEqual(resp.headers['ETag'], resp2.headers['ETag'])
+            self.assertEqual(resp.headers['Last-Modified'], resp2.headers['Last-Modified'])
+
+    def test_result_cache_version(self) -> None:
+        result_path = self._find_result_url(self._simple_sample_game(), 21)
+        with tempfile.TemporaryDirectory() as tempdir:
+            cherrypy.tree.apps.clear()
+            config = {**CONFIG, 'web': {**CONFIG['web'], 'result_cache_dir': tempdir}}
+            env = web.WebEnvironment(config, self.game_server)
+            app = TestApp(cherrypy.tree.mount(web.WebRoot(env)))
+            etag = app.get(result_path).headers['ETag']
+            self.assertEqual(1, len(os.listdir(tempdir)))
+
+            # After a deployment with changed templates, translations or static files, the old pages are neither
+            # served from memory or disk nor validated by their ETag
+            with unittest.mock.patch.object(env, '_compute_render_version', return_value="0123456789ab"):
+                env.update_render_version()
+            self.assertEqual([], os.listdir(tempdir))
+            resp = app.get(result_path, headers={'If-None-Match': etag})
+            self.assertEqual(200, resp.status_int)
+            self.assertNotEqual(etag, resp.headers['ETag'])
+            self.assertTrue(os.listdir(tempdir)[0].startswith("0123456789ab-"))
+
+    def test_result_cache_disk_limit(self) -> None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            cache = web.ResultPageCache(0, tempdir, max_files=10, version="v1")
+            for i in range(11):
+                cache.put(('game', i, 'en', False), "Page {}".format(i), datetime.datetime(2020, 1, 1))
+            self.assertEqual(9, len(os.listdir(tempdir)))
+            self.assertIsNone(cache.get(('game', 0, 'en', False)))
+            self.assertEqual(b"Page 10", cache.get(('game', 10, 'en', False)).body)
+            # A new cache object with another version removes the outdated files
+            web.ResultPageCache(0, tempdir, max_files=10, version="v2")
+            self.assertEqual([], os.listdir(tempdir))
+
+    def test_static_files(self) -> None:
+        cherrypy.tree.apps.clear()
+        env = web.WebEnvironment(CONFIG, self.game_server)
+        web.setup_cherrypy_engine(env, CONFIG)
+        app = TestApp(cherrypy.tree.apps[''])
+        resp = app.get('/')
+        match = re.search(r'href="' + re.escape(CONFIG['web']['base_url']) + r'(/static/(\w+)/style\.css)"', resp.text)
+        self.assertIsNotNone(match)
+        self.assertEqual(env.static_files.version, match[2])
+
+        resp = app.get(match[1])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertEqual('text/css', resp.content_type)
+        resp.mustcontain("url('fonts/caroni-regular-webfont.woff2')")
+        # WebTest decodes compressed responses, so we use the plain WSGI interface here
+        resp = webob.Request.blank(match[1], headers={'Accept-Encoding': 'gzip, deflate'}).get_response(app.app)
+        self.assertEqual('gzip', resp.headers['Content-Encoding'])
+        self.assertEqual('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn(b"url('fonts/caroni-regular-webfont.woff2')", gzip.decompress(resp.body))
+        resp = app.get('/static/{}/fonts/caroni-regular-webfont.woff'.format(env.static_files.version))
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+
+        # Outdated versions are served without long-term caching, unversioned paths as before
+        resp = app.get('/static/0123456789ab/style.css')
+        self.assertEqual('no-cache', resp.headers['Cache-Control'])
+        app.get('/static/style.css')
+        app.get('/static/{}/../../web.py'.format(env.static_files.version), status=[403, 404])
+
+    def test_template_warm_up(self) -> None:
+        with tempfile.TemporaryDirectory() as tempdir:
+            config = {**CONFIG, 'web': {**CONFIG['web'], 'template_cache_dir': tempdir}}
+            env = web.WebEnvironment(config, self.game_server)
+            self.assertEqual(5, env.warm_up())
+            self.assertIn('game_result.mako.html.py', os.listdir(tempdir))
+
+    def test_streamed_result(self) -> None:
+        result_path = self._find_result_url(self._simple_sample_game(with_authors=True), 21)
+        expected = self.app.get(result_path)
+        tempdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        cherrypy.tree.apps.clear()
+        config = {**CONFIG, 'web': {**CONFIG['web'], 'stream_min_entries': 1, 'stream_chunk_size': 2,
+                                    'result_cache_dir': tempdir.name}}
+        app = TestApp(cherrypy.tree.mount(web.WebRoot(web.WebEnvironment(config, self.game_server))))
+
+        # The sheets of the streamed page are read from the tables in chunks, not as a whole
+        self.game_server.result_snapshot_cache.clear()
+        with unittest.mock.patch.object(self.game_server, 'get_game_result', side_effect=AssertionError), \
+                unittest.mock.patch.object(self.game_server, 'get_game_result_sheets',
+                                           wraps=self.game_server.get_game_result_sheets) as get_game_result_sheets:
+            resp = app.get(result_path)
+        self.assertEqual(2, get_game_result_sheets.call_count)
+        self.assertEqual([], [name for name in os.listdir(tempdir.name) if name.endswith('.tmp')])
+        # It has the same validators as the cached page
+        self.assertEqual(expected.headers['ETag'], resp.headers['ETag'])
+        self.assertEqual(expected.headers['Last-Modified'], resp.headers['Last-Modified'])
+        self.assertEqual(3, resp.text.count('<section class="sheet">'))
+        self.assertEqual(re.findall(r'<li class="entry.*?</li>', expected.text, re.S),
+                         re.findall(r'<li class="entry.*?</li>', resp.text, re.S))
+        resp.mustcontain("Michael", "Results without authors", "</html>")
+
+        # The streamed page has been written to the disk cache
+        with unittest.mock.patch.object(self.game_server, 'get_game_result_summary', side_effect=AssertionError):
+            resp2 = app.get(result_path)
+        self.assertEqual(resp.headers['ETag'], resp2.headers['ETag'])
+        self.assertEqual(resp.body, resp2.body)
+
+        # Conditional requests for pages to be streamed are answered without rendering them
+        cherrypy.tree.apps.clear()
+        app = TestApp(cherrypy.tree.mount(web.WebRoot(web.WebEnvironment(config, self.game_server))))
+        app.get(result_path, headers={'If-None-Match': resp.headers['ETag']}, status=304)
+
+    def test_json_api(self) -> None:
+        result_path = self._find_result_url(self._simple_sample_game(with_authors=True), 21)
+        game_id = re.match(r'/game/([^/]+)/', result_path)[1]
+        with unittest.mock.patch.object(web.ApiGame, 'PAGE_SIZES', (2, 100)), \
+                unittest.mock.patch.object(web.ApiSheet, 'PAGE_SIZES', (1, 100)):
+            resp = self.app.get('/api/game/{}?authors=1&limit=2'.format(game_id))
+            self.assertEqual('application/json', resp.content_type)
+            data = resp.json
+            self.assertEqual("Funny Group", data['name'])
+            self.assertEqual(2, len(data['sheets']))
+            self.assertEqual(['question', 'answer'], [e['type'] for e in data['sheets'][0]['entries']])
+            self.assertIn(data['sheets'][0]['entries'][0]['author'], ("Michael", "Jenny", "Lukas"))
+            resp2 = self.app.get('/api/game/{}?authors=1&limit=2&cursor={}'.format(game_id, data['next_cursor']))
+            self.assertEqual(1, len(resp2.json['sheets']))
+            self.assertIsNone(resp2.json['next_cursor'])
+            texts = {e['text'] for sheet in data['sheets'] + resp2.json['sheets'] for e in sheet['entries']}
+            self.assertEqual({"Question 1", "Question 2", "Question 3", "Answer 1", "Answer 2", "Answer 3"}, texts)
+
+            # Conditional requests
+            self.app.get('/api/game/{}?authors=1&limit=2'.format(game_id),
+                         headers={'If-None-Match': resp.headers['ETag']}, status=304)
+
+            # Sheets with paginated entries
+            sheet_id = data['sheets'][0]['id']
+            resp = self.app.get('/api/sheet/{}?authors=1&limit=1'.format(sheet_id))
+            self.assertEqual("Funny Group", resp.json['game']['name'])
+            self.assertEqual(2, resp.json['num_entries'])
+            self.assertEqual(data['sheets'][0]['entries'][:1], resp.json['entries'])
+            resp = self.app.get('/api/sheet/{}?authors=1&limit=1&cursor={}'.format(sheet_id, resp.json['next_cursor']))
+            self.assertEqual(data['sheets'][0]['entries'][1:], resp.json['entries'])
+            # The last page has no cursor, even if it is full
+            self.assertIsNone(resp.json['next_cursor'])
+        with unittest.mock.patch.object(web.ApiGame, 'PAGE_SIZES', (3, 100)):
+            resp = self.app.get('/api/game/{}?authors=1&limit=3'.format(game_id))
+            self.assertEqual(3, len(resp.json['sheets']))
+            self.assertIsNone(resp.json['next_cursor'])
+
+        # Limits are rounded up to the allowed page sizes and the pages are not stored in the result page cache
+        cache_lookups = (self.env.result_cache.hits, self.env.result_cache.misses)
+        for limit in ('3', '20', '1000000'):
+            resp = self.app.get('/api/game/{}?authors=1&limit={}'.format(game_id, limit))
+            self.assertEqual(3, len(resp.json['sheets']))
+            self.assertIsNone(resp.json['next_cursor'])
+        self.assertEqual(resp.headers['ETag'],
+                         self.app.get('/api/game/{}?authors=1&limit=100'.format(game_id)).headers['ETag'])
+        self.assertNotEqual(resp.headers['ETag'],
+                            self.app.get('/api/game/{}?authors=1&limit=50'.format(game_id)).headers['ETag'])
+        self.assertEqual(cache_lookups, (self.env.result_cache.hits, self.env.result_cache.misses))
+
+        # Errors
+        self.app.get('/api/game/{}'.format(game_id), status=404)  # The id's realm includes the authors
+        self.app.get('/api/game/{}?authors=1&cursor=invalid'.format(game_id), status=400)
+        self.app.get('/api/game/{}?authors=1&limit=many'.format(game_id), status=400)
+        self.app.get('/api/sheet/{}'.format(sheet_id), status=404)
+
+    def test_result_snapshot(self) -> None:
+        result_path = self._find_result_url(self._simple_sample_game(with_authors=True), 21)
+        expected = self.app.get(result_path).text
+        with session_scope(self.game_server.session_maker) as session:
+            game_result = session.query(model.GameResult).one()
+            game_id = game_result.game_id
+            snapshot = game.decode_result_snapshot(game_result.data)
+            # The snapshot equals the game's result from the tables
+            self.assertEqual(self.game_server._result_game(session, game_id)
+                             ._replace(sheets=self.game_server._result_sheets(session, game_id)),
+                             snapshot)
+            session.query(model.GameResult).delete()
+
+        # Without snapshot, the result is read from the tables. The snapshot can be backfilled.
+        self.game_server.result_snapshot_cache.clear()
+        cherrypy.tree.apps.clear()
+        app = TestApp(cherrypy.tree.mount(web.WebRoot(web.WebEnvironment(CONFIG, self.game_server))))
+        self.assertEqual(expected, app.get(result_path).text)
+        self.assertEqual(1, self.game_server.backfill_result_snapshots(10))
+        self.assertEqual(0, self.game_server.backfill_result_snapshots(10))
+        self.assertEqual(snapshot, self.game_server.get_game_result(game_id))
+
+    def test_archived_game(self) -> None:
+        messages = self._simple_sample_game(with_authors=True)
+        result_path = self._find_result_url(messages, 21)
+        expected = self.app.get(result_path).text
+        sheet_path = re.search(r'href="' + re.escape(CONFIG['web']['base_url']) + r'(/sheet/[^"]+)"', expected)[1]
+        sheet_path = sheet_path.replace('&amp;', '&')
+        expected_sheet = self.app.get(sheet_path).text
+        game_id = re.match(r'/game/([^/]+)/', result_path)[1]
+        expected_api = self.app.get('/api/game/{}?authors=1'.format(game_id)).json
+        with session_scope(self.game_server.session_maker) as session:
+            expected_rows = {table: sorted(tuple(getattr(row, column.name) for column in table.__table__.columns)
+                                           for row in session.query(table))
+                             for table in (model.Sheet, model.Entry, model.Participant)}
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.assertEqual(0, self.game_server.archive_games(now - datetime.timedelta(days=1), 10))
+        self.assertEqual(1, self.game_server.archive_games(now + datetime.timedelta(seconds=1), 10))
+        self.assertEqual(0, self.game_server.archive_games(now + datetime.timedelta(seconds=1), 10))
+        with session_scope(self.game_server.session_maker) as session:
+            for table in (model.Participant, model.Sheet, model.Entry):
+                self.assertEqual(0, session.query(table).count())
+            self.assertIsNotNone(session.query(model.Game).one().archived)
+
+            # The raw data is kept in the archive tables
+            for table, archive_table in ((model.Sheet, model.ArchivedSheet), (model.Entry, model.ArchivedEntry),
+                                         (model.Participant, model.ArchivedParticipant)):
+                with self.subTest(table=archive_table.__tablename__):
+                    self.assertEqual(expected_rows[table],
+                                     sorted(tuple(getattr(row, column.name) for column in table.__table__.columns)
+                                            for row in session.query(archive_table)))
+            entry = session.query(model.ArchivedEntry).filter(model.ArchivedEntry.text == "Answer 3").one()
+            self.assertEqual((13, 5), (entry.chat_id, entry.message_id))
+            self.assertEqual(3, session.query(model.ArchivedSheet).count())
+
+        # The results are still available
+        self.game_server.result_snapshot_cache.clear()
+        cherrypy.tree.apps.clear()
+        app = TestApp(cherrypy.tree.mount(web.WebRoot(web.WebEnvironment(CONFIG, self.game_server))))
+        self.assertEqual(expected, app.get(result_path).text)
+        self.assertEqual(expected_sheet, app.get(sheet_path).text)
+        self.assertEqual(expected_api, app.get('/api/game/{}?authors=1'.format(game_id)).json)
+        # Streamed pages of archived games are read from the snapshot
+        self.game_server.result_snapshot_cache.clear()
+        cherrypy.tree.apps.clear()
+        config = {**CONFIG, 'web': {**CONFIG['web'], 'stream_min_entries': 1, 'stream_chunk_size': 2}}
+        app = TestApp(cherrypy.tree.mount(web.WebRoot(web.WebEnvironment(config, self.game_server))))
+        self.assertEqual(re.findall(r'<li class="entry.*?</li>', expected, re.S),
+                         re.findall(r'<li class="entry.*?</li>', app.get(result_path).text, re.S))
+
+        # New games of the same users are not affected
+        self.game_server.new_game(21, "Funny Group")
+        self.game_server.join_game(21, 1)
+        self.game_server.join_game(21, 2)
+        self.game_server.start_game(21)
+        self.game_server.submit_text(11, 11, "New question")
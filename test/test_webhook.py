@@ -0,0 +1,151 @@
+# Copyright 2020 Michael Thies
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+import datetime
+import json
+import unittest
+import unittest.mock
+
+import cherrypy
+import sqlalchemy
+import sqlalchemy.exc
+import telegram
+from telegram.ext import DispatcherHandlerStop
+from webtest import TestApp
+
+from qaqa_bot import bot, game, model
+from .util import CONFIG
+
+WEBHOOK_CONFIG = {**CONFIG, 'bot': {**CONFIG['bot'], 'api_key': "123456:TEST-TOKEN",
+                                    'webhook_url': "https://example.com/telegram", 'webhook_secret': "s3cr3t"}}
+
+SAMPLE_UPDATE = {
+    'update_id': 1001,
+    'message': {'message_id': 5, 'date': 1600000000, 'text': "/help",
+                'chat': {'id': 11, 'type': 'private', 'first_name': "Michael"},
+                'from': {'id': 1, 'is_bot': False, 'first_name': "Michael"},
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}]},
+}
+
+
+class WebhookTest(unittest.TestCase):
+    def setUp(self) -> None:
+        engine = sqlalchemy.create_engine(CONFIG['database']['connection'])
+        model.Base.metadata.create_all(engine)
+        self.frontend = bot.Frontend(WEBHOOK_CONFIG, game.GameServer(WEBHOOK_CONFIG, engine))
+
+        cherrypy.config.update({'engine.autoreload.on': False})
+        cherrypy.server.unsubscribe()
+        cherrypy.engine.start()
+        self.app = TestApp(cherrypy.tree.mount(self.frontend.webhook, '/telegram'))
+
+    def tearDown(self) -> None:
+        cherrypy.engine.exit()
+        cherrypy.tree.apps.clear()
+
+    def post_update(self, update, token: str = "s3cr3t", status: int = 200):
+        return self.app.post('/telegram', json.dumps(update), content_type='application/json',
+                             headers={'X-Telegram-Bot-Api-Secret-Token': token}, status=status)
+
+    def test_secret_token(self) -> None:
+        self.post_update(SAMPLE_UPDATE, token="wrong", status=403)
+        self.app.post('/telegram', json.dumps(SAMPLE_UPDATE), content_type='application/json', status=403)
+        self.app.get('/telegram', status=405)
+        self.assertTrue(self.frontend.dispatcher.update_queue.empty())
+
+    def test_invalid_update(self) -> None:
+        self.app.post('/telegram', "{no json", content_type='application/json',
+                      headers={'X-Telegram-Bot-Api-Secret-Token': "s3cr3t"}, status=400)
+        self.assertTrue(self.frontend.dispatcher.update_queue.empty())
+
+    def test_update_handover(self) -> None:
+        self.post_update(SAMPLE_UPDATE)
+        update = self.frontend.dispatcher.update_queue.get_nowait()
+        self.assertIsInstance(update, telegram.Update)
+        self.assertEqual(1001, update.update_id)
+        self.assertEqual("/help", update.message.text)
+        self.assertIs(self.frontend.updater.bot, update.message.bot)
+        self.assertEqual(1, self.frontend.gs.metrics.counter('qaqa_webhook_updates_total', result='accepted').value)
+
+    def test_secret_required(self) -> None:
+        config = {**WEBHOOK_CONFIG, 'bot': {**WEBHOOK_CONFIG['bot'], 'webhook_secret': ""}}
+        with self.assertRaises(ValueError):
+            bot.Frontend(config, self.frontend.gs)
+
+    def test_backpressure(self) -> None:
+        self.frontend.webhook.max_pending = 1
+        self.post_update(SAMPLE_UPDATE)
+        self.post_update(SAMPLE_UPDATE, status=503)
+        self.assertEqual(1, self.frontend.dispatcher.update_queue.qsize())
+        self.assertEqual(1, self.frontend.gs.metrics.counter('qaqa_webhook_updates_total', result='rejected').value)
+
+    def test_persisted_duplicate_in_handler(self) -> None:
+        self.frontend.deduplicator.persist = True
+        handler = unittest.mock.Mock()
+        update = telegram.Update.de_json(SAMPLE_UPDATE, self.frontend.updater.bot)
+        self.frontend._run_handler(handler, update, None, 0.0)
+        self.frontend._run_handler(handler, update, None, 0.0)
+        handler.assert_called_once_with(self.frontend, update, None)
+        self.assertEqual(1, self.frontend.gs.metrics.counter('qaqa_duplicate_updates_total').value)
+
+        # Persisted update ids are detected after a restart
+        config = {**WEBHOOK_CONFIG, 'bot': {**WEBHOOK_CONFIG['bot'], 'dedupe_persist': True}}
+        frontend = bot.Frontend(config, self.frontend.gs)
+        frontend.deduplicator(update, None)
+        frontend._run_handler(handler, update, None, 0.0)
+        handler.assert_called_once()
+        self.assertEqual(0, self.frontend.gs.cleanup_processed_updates(datetime.datetime(2020, 1, 1)))
+        self.assertEqual(1, self.frontend.gs.cleanup_processed_updates(datetime.datetime(2100, 1, 1)))
+
+    def test_persistence_off_dispatcher_thread(self) -> None:
+        self.frontend.deduplicator.persist = True
+        game_server = self.frontend.gs
+        handler = unittest.mock.Mock()
+        update = telegram.Update.de_json(SAMPLE_UPDATE, self.frontend.updater.bot)
+
+        # The Dispatcher's callback only checks the in-memory cache
+        with unittest.mock.patch.object(game_server, 'mark_update_processed', side_effect=AssertionError):
+            self.frontend.deduplicator(update, None)
+            with self.assertRaises(DispatcherHandlerStop):
+                self.frontend.deduplicator(update, None)
+        # The database is checked separately (in the handler thread)
+        self.frontend._run_handler(handler, update, None, 0.0)
+        handler.assert_called_once()
+
+        # Failures of the database are logged and the update is handled as new
+        update = telegram.Update.de_json({**SAMPLE_UPDATE, 'update_id': 1002}, self.frontend.updater.bot)
+        error = sqlalchemy.exc.OperationalError("INSERT", {}, Exception("server has gone away"))
+        with unittest.mock.patch.object(game_server, 'mark_update_processed', side_effect=error):
+            with self.assertLogs('qaqa_bot.bot', 'ERROR'):
+                self.frontend._run_handler(handler, update, None, 0.0)
+        self.assertEqual(2, handler.call_count)
+
+
+class UpdateDeduplicatorTest(unittest.TestCase):
+    def test_deduplication(self) -> None:
+        engine = sqlalchemy.create_engine(CONFIG['database']['connection'])
+        model.Base.metadata.create_all(engine)
+        game_server = game.GameServer(CONFIG, engine)
+        deduplicator = bot.UpdateDeduplicator(game_server, 2, False, 3600)
+
+        def is_duplicate(update_id: int) -> bool:
+            try:
+                deduplicator(telegram.Update.de_json({**SAMPLE_UPDATE, 'update_id': update_id}, None), None)
+            except DispatcherHandlerStop:
+                return True
+            return False
+
+        self.assertFalse(is_duplicate(1))
+        self.assertFalse(is_duplicate(2))
+        self.assertTrue(is_duplicate(1))
+        self.assertFalse(is_duplicate(3))
+        # The memory is bounded, so update 2 has been forgotten
+        self.assertFalse(is_duplicate(2))
+        self.assertEqual(1, game_server.metrics.counter('qaqa_duplicate_updates_total').value)
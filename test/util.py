@@ -10,9 +10,16 @@
 # specific language governing permissions and limitations under the License.
 
 import os.path
+import tempfile
+import unittest
+import unittest.mock
+from pathlib import Path
 from typing import List
 
 import toml
+from babel.messages.mofile import write_mo
+from babel.messages.pofile import read_po
+import sqlalchemy.event
 import sqlalchemy.orm
 
 from qaqa_bot import game, model
@@ -30,3 +37,51 @@ def create_sample_users(engine):
     with session_scope(Session) as session:
         for user in users:
             session.add(user)
+
+
+def use_compiled_catalogs(test_case: unittest.TestCase) -> None:
+    """ Compile the message catalogs of the package into a temporary directory and use them in the translation
+    registry for the rest of the test, so tests with translations don't depend on the catalogs being compiled in the
+    source tree. """
+    tempdir = tempfile.TemporaryDirectory()
+    test_case.addCleanup(tempdir.cleanup)
+    for po_file in Path(game.LOCALE_DIR).glob('*/LC_MESSAGES/*.po'):
+        directory = Path(tempdir.name, po_file.relative_to(game.LOCALE_DIR)).parent
+        directory.mkdir(parents=True)
+        with open(po_file, 'rb') as fp:
+            catalog = read_po(fp)
+        with open(directory / (po_file.stem + '.mo'), 'wb') as fp:
+            write_mo(fp, catalog)
+    patcher = unittest.mock.patch.object(game.TRANSLATIONS, 'localedir', tempdir.name)
+    patcher.start()
+    test_case.addCleanup(game.TRANSLATIONS.reload)
+    test_case.addCleanup(patcher.stop)
+    game.TRANSLATIONS.reload()
+
+
+class StatementCounter:
+    """ Context manager to record all SQL statements executed via the given engine, using SQLAlchemy's engine events.
+
+    Each call of the DBAPI cursor is recorded once, i.e. an `executemany()` with multiple parameter sets counts as a
+    single statement. """
+    def __init__(self, engine: sqlalchemy.engine.Engine):
+        self.engine = engine
+        self.statements: List[str] = []
+
+    def __enter__(self) -> "StatementCounter":
+        sqlalchemy.event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        sqlalchemy.event.remove(self.engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, _conn, _cursor, statement: str, _parameters, _context, _executemany) -> None:
+        self.statements.append(statement)
+
+    @property
+    def selects(self) -> List[str]:
+        return [s for s in self.statements if s.lstrip().upper().startswith('SELECT')]
+
+    @property
+    def writes(self) -> List[str]:
+        return [s for s in self.statements if not s.lstrip().upper().startswith('SELECT')]